@@ -0,0 +1,121 @@
+"""
+Persistent script -> transaction history index, for "all transactions touching
+this address" lookups.
+
+Each block adds one row (script hash, height, tx offset) for every script a
+transaction pays to, and, given the UTXO set, every script it spends from.
+The tx offset is the byte offset of the transaction inside its block, so a
+history entry is turned back into a TxMessage with one BlockStore read and a
+parse_from at that offset. Rows are buffered and written to a sqlite file
+every flush_every blocks; history queries page through them by (height,
+offset) cursor.
+"""
+import sqlite3
+
+from MessageHandler import TxMessage
+from Scripts import OP_RETURN, address_to_script, classify, script_hash
+from UtxoSet import is_coinbase
+from Utils import encode_varint
+
+KEY_BYTES = 16  # of the script's SHA256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    scripthash BLOB, height INTEGER, tx_offset INTEGER, PRIMARY KEY (scripthash, height, tx_offset)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB);
+"""
+
+
+def block_rows(block, height, utxos=None):
+    """
+    The set of (script hash, height, tx offset) rows for block. Scripts spent
+    from are only included with utxos, looked up before the block is applied.
+    """
+    offset = 80 + len(encode_varint(len(block.transactions)))
+    rows = set()
+    created = {}  # (txid, index) -> script of this block's outputs, for spends within the block
+    for tx in block.transactions:
+        if utxos is not None and not is_coinbase(tx):
+            for tx_in in tx.inputs:
+                script = created.get((bytes(tx_in.prevout_hash), tx_in.prevout_index))
+                if script is None:
+                    output = utxos.get(tx_in.prevout_hash, tx_in.prevout_index)
+                    script = None if output is None else output.script_pubkey
+                if script is not None:
+                    rows.add((script_hash(script)[:KEY_BYTES], height, offset))
+        txid = tx.txid
+        for index, tx_out in enumerate(tx.outputs):
+            if classify(tx_out.script_pubkey)[0] == OP_RETURN:
+                continue
+            if utxos is not None:
+                created[(txid, index)] = tx_out.script_pubkey
+            rows.add((script_hash(tx_out.script_pubkey)[:KEY_BYTES], height, offset))
+        offset += tx.size
+    return rows
+
+
+def load_tx(store, height, tx_offset):
+    """ The transaction of a history entry, read from a BlockStore.BlockStore """
+    raw = store.get_raw(store.heights[height])
+    return TxMessage.parse_from(raw, tx_offset)[0]
+
+
+class AddressIndex:
+    def __init__(self, path: str, flush_every: int = 100, net: str = 'main'):
+        self.flush_every = flush_every
+        self.net = net
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.pending = []  # rows not written yet
+        self.blocks_since_flush = 0
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'height'").fetchone()
+        self.height = -1 if row is None else int(row[0])
+
+    def add_block(self, block, utxos=None):
+        """
+        Index the block on top of the current height. Pass the UtxoSet.UtxoSet to
+        also index the scripts the block spends from; it must not have applied the
+        block yet.
+        """
+        self.height += 1
+        self.pending += block_rows(block, self.height, utxos)
+        self.blocks_since_flush += 1
+        if self.blocks_since_flush >= self.flush_every:
+            self.flush()
+
+    def remove_block(self, block, utxos=None):
+        """ Drop the rows of the top block on a reorg; utxos as for add_block, after undoing the block """
+        self.flush()
+        with self.db:
+            self.db.executemany('DELETE FROM history WHERE scripthash = ? AND height = ? AND tx_offset = ?',
+                                block_rows(block, self.height, utxos))
+        self.height -= 1
+        self.flush()
+
+    def flush(self):
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO history VALUES (?, ?, ?)', self.pending)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('height', ?)", (str(self.height),))
+        self.pending = []
+        self.blocks_since_flush = 0
+
+    def history(self, script, limit: int = 25, after=None):
+        """
+        Up to limit (height, tx offset) entries touching script (a scriptPubKey or an
+        address), oldest first. Pass the last entry of a page as after to get the next one.
+        """
+        if isinstance(script, str):
+            script = address_to_script(script, self.net)
+        if self.pending:
+            self.flush()
+        height, tx_offset = after if after is not None else (-1, -1)
+        return self.db.execute('SELECT height, tx_offset FROM history WHERE scripthash = ? '
+                               'AND (height, tx_offset) > (?, ?) ORDER BY height, tx_offset LIMIT ?',
+                               (script_hash(script)[:KEY_BYTES], height, tx_offset, limit)).fetchall()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,256 @@
+"""
+asyncio counterpart of Connect2Net.SimpleNode.
+
+Reading, writing and dispatching run as separate tasks connected by bounded
+queues, so a slow consumer pushes back on the socket instead of buffering
+without limit, and CPU-heavy block decoding runs in an executor so ping/pong
+and inv handling keep flowing while a block is parsed.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from CompactBlocks import CompactBlockRelay, build_partial, serialize_block
+from Handshake import EnvelopeFramer, NetworkEnvelope, PingMessage, PongMessage, VersionMessage, VerAckMessage
+from MessageHandler import (BlockMessage, BlockTxnMessage, CmpctBlockMessage, GetDataMessage, InvMessage,
+                            SendCmpctMessage, TxMessage)
+from Metrics import METRICS
+from Utils import hash256
+
+
+def decode_block(payload):
+    """ Executor entry point for block decoding, return the block or None if its merkle root doesn't match """
+    block, _ = BlockMessage.parse_from(payload)
+    return block if block.check_merkle_root() else None
+
+
+class AsyncNode:
+    def __init__(self, host: str, port: int = None, net: str = 'main', verbose: int = 0,
+                 send_queue_size: int = 64, recv_queue_size: int = 64, executor=None, max_decoding: int = 2,
+                 block_store=None, mempool=None, explorer=None, snapshot=None):
+        self.host = host
+        self.port = port or {'main': 8333, 'test': 18333}[net]
+        self.net = net
+        self.verbose = verbose
+        self.send_queue = asyncio.Queue(send_queue_size)
+        self.recv_queue = asyncio.Queue(recv_queue_size)
+        # None is the loop's default thread pool, which only keeps the loop responsive: parsing holds the GIL.
+        # A ProcessPoolExecutor takes it off this process, at the cost of copying each payload to it.
+        self.executor = executor
+        self.decoding = asyncio.Semaphore(max_decoding)  # blocks being decoded at once
+        self.block_store = block_store  # optional BlockStore.BlockStore keeping every received block
+        self.mempool = mempool  # optional Mempool.Mempool mirroring unconfirmed transactions
+        self.explorer = explorer  # optional ExplorerAPI.Explorer answering queries about received data
+        self.snapshot = snapshot  # optional Snapshot.Snapshot: peer latency, inventory already seen, last tip
+        self.connect_started = None
+        self.handshake_done = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.reader = self.writer = None
+        self.framer = EnvelopeFramer(net, verbose=verbose)
+        self.tasks = []
+        self.pending = set()  # decode tasks in flight
+        self.malformed = 0  # messages (or blocks) dropped because their handler or decoding failed
+        self.compact = CompactBlockRelay(mempool)  # used once the peer sends sendcmpct
+        self.handlers = {
+            VersionMessage.command: self.handle_version,
+            VerAckMessage.command: self.handle_verack,
+            PingMessage.command: self.handle_ping,
+            InvMessage.command: self.handle_inv,
+            b'tx': self.handle_tx,
+            b'block': self.handle_block,
+            SendCmpctMessage.command: self.handle_sendcmpct,
+            CmpctBlockMessage.command: self.handle_cmpctblock,
+            BlockTxnMessage.command: self.handle_blocktxn,
+        }
+
+    async def connect(self, handshake: bool = True):
+        self.connect_started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.verbose:
+            print("Connected to Bitcoin node at {}:{}".format(self.host, self.port))
+        self.tasks = [asyncio.create_task(coro) for coro in (self.read_loop(), self.write_loop(), self.dispatch_loop())]
+        if handshake:
+            await self.send(VersionMessage(timestamp=0, nonce=b'\x00' * 8, user_agent=b'/programmingbitcoin:0.1/'))
+        return self
+
+    async def send(self, message):
+        """ Queue a message for the writer task; waits while the send queue is full """
+        env = NetworkEnvelope(message.command, message.encode(), net=self.net)
+        # queued with its enqueue time, so the writer can record how long it waited
+        await self.send_queue.put((env, time.perf_counter() if METRICS.enabled else None))
+        if METRICS.enabled:
+            METRICS.queue_depth.set(self.send_queue.qsize(), 'send')
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(len(self.framer.recv_buffer))
+                if not data:
+                    raise ConnectionError("Connection was reset")
+                for env in self.framer.feed(data):
+                    # a full receive queue stops the reads, which pushes back on the peer through TCP
+                    await self.recv_queue.put(env)
+                if METRICS.enabled:
+                    METRICS.queue_depth.set(self.recv_queue.qsize(), 'recv')
+        except (ConnectionError, AssertionError, ValueError) as e:
+            if self.verbose:
+                print(f"Stopped listening due to error: {e!r}")
+        finally:
+            self.closed.set()
+
+    async def write_loop(self):
+        try:
+            while True:
+                env, queued_at = await self.send_queue.get()
+                if self.verbose:
+                    print(f"sending: {env}")
+                self.writer.write(env.encode())
+                await self.writer.drain()
+                if METRICS.enabled and queued_at is not None:
+                    METRICS.send_latency.observe(time.perf_counter() - queued_at)
+                    METRICS.queue_depth.set(self.send_queue.qsize(), 'send')
+        except ConnectionError:
+            self.closed.set()
+
+    async def dispatch_loop(self):
+        while True:
+            env = await self.recv_queue.get()
+            handler = self.handlers.get(env.command)
+            if handler is None:
+                continue
+            try:
+                await handler(env)
+            except Exception as e:  # a malformed payload must not end the dispatch loop
+                self.malformed += 1
+                if self.verbose:
+                    print(f"Dropped {env.command.decode(errors='replace')} message: {e!r}")
+
+    async def handle_version(self, env):
+        await self.send(VerAckMessage())
+
+    async def handle_verack(self, env):
+        self.handshake_done.set()
+        if self.snapshot is not None:
+            host, port = self.writer.get_extra_info('peername')[:2]  # the address connected to, self.host may be a name
+            self.snapshot.record_peer(host, port, time.perf_counter() - self.connect_started)
+        if self.verbose:
+            print("Connection established!")
+
+    async def handle_ping(self, env):
+        await self.send(PongMessage(env.payload))
+
+    async def handle_inv(self, env):
+        inv = InvMessage.parse(env.stream())
+        getdata_items = [(type, hash) for type, hash in inv.items if type in [1, 2]]  # 1 for TX, 2 for Block
+        if self.snapshot is not None:
+            getdata_items = [(type, hash) for type, hash in getdata_items if self.snapshot.seen.add(hash)]
+        getdata_items = [(self.compact.block_type() if type == 2 else type, hash) for type, hash in getdata_items]
+        if getdata_items:
+            await self.send(GetDataMessage(getdata_items))
+
+    async def handle_tx(self, env):
+        if METRICS.enabled:
+            tx = METRICS.time_call(METRICS.tx_parse, 'message', TxMessage.parse_from, env.payload)[0]
+        else:
+            tx = TxMessage.parse_from(env.payload)[0]
+        if self.mempool is not None:
+            self.mempool.add(tx)
+        if self.explorer is not None:
+            self.explorer.add_tx(tx)
+        self.on_tx(tx)
+
+    async def handle_block(self, env):
+        # decode in the background so the dispatch loop can keep answering pings; with max_decoding blocks in
+        # flight this waits, which stops dispatching and, once the receive queue is full, reading from the peer
+        await self.decoding.acquire()
+        task = asyncio.create_task(self.decode_block(env.payload))
+        self.pending.add(task)
+        task.add_done_callback(self.decoded)
+
+    def decoded(self, task):
+        self.pending.discard(task)
+        self.decoding.release()
+        if not task.cancelled() and task.exception() is not None:
+            self.malformed += 1
+            if self.verbose:
+                print(f"Dropped block that failed to decode: {task.exception()!r}")
+
+    async def decode_block(self, payload):
+        # a memoryview can't be pickled to a worker process
+        arg = bytes(payload) if isinstance(self.executor, ProcessPoolExecutor) else payload
+        try:
+            block = await asyncio.get_running_loop().run_in_executor(self.executor, decode_block, arg)
+        except Exception:
+            self.on_bad_block(hash256(payload[:80]))
+            raise
+        if block is None:
+            if self.verbose:
+                print("Dropped block with an invalid merkle root")
+            self.on_bad_block(hash256(payload[:80]))
+            return
+        if self.block_store is not None:
+            self.block_store.put(payload)  # only once the merkle root matched
+        self.accept_block(block)
+
+    async def handle_sendcmpct(self, env):
+        reply = self.compact.on_sendcmpct(env.payload)
+        if reply is not None:
+            await self.send(reply)
+
+    async def handle_cmpctblock(self, env):
+        if not self.compact.enabled:  # unasked for: fetch the full block instead
+            await self.compact_result(*self.compact.on_cmpctblock(env.payload))
+            return
+        # the short ID table covers the whole mempool, so build it in the executor from a snapshot; the relay's
+        # pending reconstructions are only touched back on the loop. A process pool would have to be sent the whole
+        # mempool, so that case uses the default thread pool.
+        candidates = self.compact.candidates()
+        executor = None if isinstance(self.executor, ProcessPoolExecutor) else self.executor
+        cmpct, partial = await asyncio.get_running_loop().run_in_executor(
+            executor, build_partial, env.payload, candidates)
+        await self.compact_result(*self.compact.on_partial(cmpct, partial, len(env.payload)))
+
+    async def handle_blocktxn(self, env):
+        await self.compact_result(*self.compact.on_blocktxn(env.payload))
+
+    async def compact_result(self, block, reply):
+        if reply is not None:
+            await self.send(reply)
+        if block is not None:
+            if self.block_store is not None:
+                self.block_store.put(serialize_block(block.header(), block.transactions))
+            self.accept_block(block)
+
+    def accept_block(self, block):
+        if self.mempool is not None:
+            self.mempool.remove_for_block(block)
+        if self.explorer is not None:
+            self.explorer.add_block(block)
+        if self.snapshot is not None:
+            self.snapshot.set_tip(block.hash())
+        self.on_block(block)
+
+    def on_tx(self, tx):
+        """ Called with every received transaction; override or replace to consume them """
+        if self.verbose:
+            tx.print_TXreadable()
+
+    def on_block(self, block):
+        """ Called with every decoded block; override or replace to consume them """
+        if self.verbose:
+            block.print_blockReadable()
+
+    def on_bad_block(self, block_hash):
+        """ Called with the header hash of a block that failed to decode or to match its merkle root """
+
+    async def close(self):
+        for task in self.tasks + list(self.pending):
+            task.cancel()
+        await asyncio.gather(*self.tasks, *self.pending, return_exceptions=True)
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.closed.set()
@@ -0,0 +1,198 @@
+"""
+Reproducible parser (and serializer) benchmark suite with machine-readable results.
+
+Every case runs on fixed inputs: the BlockExample.txt block and seeded
+SampleData.synthetic_block blocks. Results are JSON with, per case, operations
+per second, MB/s and the peak memory Python allocates for one operation, so
+runs can be stored and compared:
+
+    python BenchSuite.py --out baseline.json
+    ... change the parser ...
+    python BenchSuite.py --compare baseline.json
+
+--compare exits with status 1 when a case got slower (or its peak memory grew)
+by more than --threshold, 10% by default.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from io import BytesIO
+
+from Handshake import EnvelopeFramer, NetworkEnvelope
+from MessageHandler import BlockMessage, InvMessage, TxMessage
+from SampleData import load_block_example, sample_transactions, split_transactions, synthetic_block
+from Utils import decode_varint, encode_varint, read_varint
+
+SEED = 1
+MIN_TIME = 0.2  # seconds per timed repeat
+
+
+def varint_stream(count=1000):
+    """ count varints cycling through the 1, 3, 5 and 9 byte encodings """
+    values = (0x20, 0x1234, 0x12345678, 0x123456789a)
+    return b''.join(encode_varint(values[i % 4]) for i in range(count))
+
+
+def block_transactions(block):
+    """ Raw bytes of each transaction of a serialized block """
+    return split_transactions(block[read_varint(block, 80)[1]:])
+
+
+def inv_payload(count=1000):
+    return InvMessage([(1 + i % 2, i.to_bytes(32, 'little')) for i in range(count)]).encode()
+
+
+def cases(seed=SEED, quick=False):
+    """ name -> (function to time, bytes processed per call, operations per call) """
+    sample = load_block_example()
+    synthetic = synthetic_block(seed, tx_count=500 if quick else 2000)
+    legacy = synthetic_block(seed, tx_count=500 if quick else 2000, witness_share=0.0)
+    wire = NetworkEnvelope(b'block', sample, 'main').encode()
+    chunks = [wire[i:i + 64 * 1024] for i in range(0, len(wire), 64 * 1024)]
+    txs = list(sample_transactions())
+    segwit_txs = [tx for tx in block_transactions(synthetic) if tx[4] == 0]  # segwit marker
+    varints = varint_stream()
+    inv = inv_payload()
+    envelope = NetworkEnvelope(b'block', sample, 'main')
+
+    def decode_varints():
+        s = BytesIO(varints)
+        for _ in range(1000):
+            decode_varint(s)
+
+    def framer():
+        f = EnvelopeFramer('main')
+        for chunk in chunks:
+            f.feed(chunk)
+
+    def parse_txs(raw_txs):
+        def run():
+            for raw in raw_txs:
+                TxMessage.parse(BytesIO(raw))
+        return run
+
+    def parse_from_txs(raw_txs):
+        def run():
+            for raw in raw_txs:
+                TxMessage.parse_from(raw)
+        return run
+
+    parsed = BlockMessage.parse_from(synthetic)[0]
+
+    def serialize_block():
+        for tx in parsed.transactions:
+            tx.serialize()
+
+    return {
+        'envelope_decode': (lambda: NetworkEnvelope.decode(BytesIO(wire), 'main'), len(wire), 1),
+        'envelope_encode': (envelope.encode, len(wire), 1),
+        'envelope_framer': (framer, len(wire), 1),
+        'decode_varint': (decode_varints, len(varints), 1000),
+        'inv_parse': (lambda: InvMessage.parse(BytesIO(inv)), len(inv), 1),
+        'tx_parse': (parse_txs(txs), sum(map(len, txs)), len(txs)),
+        'tx_parse_from': (parse_from_txs(txs), sum(map(len, txs)), len(txs)),
+        'tx_parse_segwit': (parse_txs(segwit_txs), sum(map(len, segwit_txs)), len(segwit_txs)),
+        'block_parse_sample': (lambda: BlockMessage.parse(BytesIO(sample)), len(sample), 1),
+        'block_parse_from_sample': (lambda: BlockMessage.parse_from(sample), len(sample), 1),
+        'block_parse_synthetic': (lambda: BlockMessage.parse(BytesIO(synthetic)), len(synthetic), 1),
+        'block_parse_from_synthetic': (lambda: BlockMessage.parse_from(synthetic), len(synthetic), 1),
+        'block_parse_from_legacy': (lambda: BlockMessage.parse_from(legacy), len(legacy), 1),
+        'tx_serialize_synthetic': (serialize_block, len(synthetic), len(parsed.transactions)),
+    }
+
+
+def calibrate(fn):
+    """ Calls of fn per timed repeat, so that a repeat lasts at least MIN_TIME """
+    number = 1
+    while timeit.timeit(fn, number=number) < MIN_TIME:
+        number *= 2
+    return number
+
+
+def peak_memory(fn):
+    """ Peak bytes allocated by Python during one call of fn """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(seed=SEED, quick=False, only=None, rounds=5):
+    """
+    Run the cases (those named in only, if given) and return the JSON-ready
+    results. Each round times every case once and the best round counts, so a
+    slow spell of the machine hits all cases alike instead of one of them.
+    """
+    selected = {name: case for name, case in cases(seed, quick).items() if only is None or name in only}
+    numbers = {name: calibrate(fn) for name, (fn, _, _) in selected.items()}
+    best = dict.fromkeys(selected, float('inf'))
+    for _ in range(rounds):
+        for name, (fn, _, _) in selected.items():
+            best[name] = min(best[name], timeit.timeit(fn, number=numbers[name]) / numbers[name])
+    results = {name: {'ops_per_sec': ops / best[name], 'mb_per_sec': nbytes / best[name] / 1e6,
+                      'peak_bytes': peak_memory(fn), 'seconds_per_call': best[name]}
+               for name, (fn, nbytes, ops) in selected.items()}
+    return {
+        'meta': {'seed': seed, 'quick': quick, 'python': platform.python_version(), 'machine': platform.machine(),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold=0.10):
+    """
+    Lines comparing current to baseline results, and whether any case regressed:
+    ops/s down or peak memory up by more than threshold.
+    """
+    lines, regressed = [], False
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            lines.append(f"{name:28} {result['ops_per_sec']:14,.1f} ops/s  (new)")
+            continue
+        speed = result['ops_per_sec'] / base['ops_per_sec'] - 1
+        memory = result['peak_bytes'] / base['peak_bytes'] - 1 if base['peak_bytes'] else 0.0
+        flags = []
+        if speed < -threshold:
+            flags.append('SLOWER')
+        if memory > threshold:
+            flags.append('MORE MEMORY')
+        regressed = regressed or bool(flags)
+        lines.append(f"{name:28} {result['ops_per_sec']:14,.1f} ops/s {speed:+7.1%}  "
+                     f"peak {result['peak_bytes']:>11,} B {memory:+7.1%}  {' '.join(flags)}".rstrip())
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parser benchmark suite")
+    parser.add_argument('--out', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare against a stored JSON result")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative change flagged as a regression")
+    parser.add_argument('--seed', type=int, default=SEED, help="seed of the synthetic blocks")
+    parser.add_argument('--quick', action='store_true', help="smaller synthetic blocks")
+    parser.add_argument('cases', nargs='*', help="only run these cases")
+    args = parser.parse_args(argv)
+
+    current = run(args.seed, args.quick, set(args.cases) or None)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=2)
+    elif not args.compare:
+        print(json.dumps(current, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(current, baseline, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,509 @@
+"""
+Micro benchmarks for the parser and the other hot paths of the viewer.
+Run: python Benchmark.py
+"""
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+from io import BytesIO
+
+from AddressIndex import AddressIndex
+from BlockStore import BlockStore
+from CompactBlocks import PartialBlock, compact_block, short_id_key, short_id_table
+from CompactTx import FrozenTxMessage, SlotTxMessage, TxBatch
+from Handshake import EnvelopeFramer, NetworkEnvelope
+from Hashing import hash256_batch, merkle_root, siphash24
+from HeaderChain import HeaderChain
+from Mempool import Mempool
+from Metrics import METRICS
+from MessageHandler import BlockMessage, Input, LazyBlock, Output, TxMessage
+from Pipeline import DecodePipeline, summarize
+from Renderer import Renderer
+from SampleData import (build_block, build_chain, build_spending_chain, load_block_example,
+                        merkle_root as naive_merkle_root, mine_headers, p2pkh_script, sample_transactions,
+                        synthetic_block)
+from Snapshot import Snapshot
+from UtxoSet import UtxoSet
+from Utils import hash256
+
+
+def best_of(fn, repeat=10):
+    """ Run fn repeat times and return the fastest wall-clock time in seconds """
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench_block_parse(repeat=20):
+    """ BytesIO based BlockMessage.parse vs the zero-copy BlockMessage.parse_from """
+    data = load_block_example()
+    stream_time = best_of(lambda: BlockMessage.parse(BytesIO(data)), repeat)
+    buffer_time = best_of(lambda: BlockMessage.parse_from(data), repeat)
+    mb = len(data) / 1e6
+    print(f"Block parse ({len(data)} bytes):")
+    print(f"  BlockMessage.parse:      {stream_time * 1000:8.2f} ms  {mb / stream_time:7.1f} MB/s")
+    print(f"  BlockMessage.parse_from: {buffer_time * 1000:8.2f} ms  {mb / buffer_time:7.1f} MB/s")
+    print(f"  Speedup: {stream_time / buffer_time:.2f}x")
+
+
+def peak_memory(fn):
+    """ Peak bytes allocated by Python while running fn """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_first_page(page_size=20, repeat=20):
+    """ Time and memory to get the header and the first page of transactions of a block """
+    data = load_block_example()
+
+    def eager():
+        block, _ = BlockMessage.parse_from(data)
+        return block.transactions[:page_size]
+
+    def lazy():
+        block, _ = LazyBlock.parse_from(data)
+        return block.transactions[:page_size]
+
+    print(f"First page of {page_size} transactions:")
+    for name, fn in (("BlockMessage.parse_from", eager), ("LazyBlock.parse_from", lazy)):
+        print(f"  {name + ':':24} {best_of(fn, repeat) * 1000:8.2f} ms  peak {peak_memory(fn) / 1e6:7.2f} MB")
+
+
+def retained_memory(fn):
+    """ Bytes still allocated by Python for the result of fn, and the result """
+    tracemalloc.start()
+    try:
+        result = fn()
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+
+def bench_tx_memory():
+    """
+    Bytes per tx of the dataclass, slotted, frozen and columnar representations.
+    Each one is built over the fields of the same parsed txs (shared bytes
+    objects, not counted), so only the layouts differ; a parsed TxMessage also
+    keeps the serialized tx (_raw), shown separately.
+    """
+    data = load_block_example()
+    block = BlockMessage.parse(BytesIO(data))  # bytes fields, not views of the block buffer
+    txs = block.transactions
+
+    def dataclass_txs():
+        return [TxMessage(tx.version, [Input(i.prevout_hash, i.prevout_index, i.script_sig, i.sequence, i.witness)
+                                       for i in tx.inputs],
+                          [Output(o.value, o.script_pubkey) for o in tx.outputs], tx.locktime) for tx in txs]
+
+    representations = (
+        ("parsed TxMessage (+ field bytes, _raw)", lambda: BlockMessage.parse(BytesIO(data)).transactions),
+        ("TxMessage (dataclass)", dataclass_txs),
+        ("SlotTxMessage", lambda: [SlotTxMessage.from_tx(tx) for tx in txs]),
+        ("FrozenTxMessage", lambda: [FrozenTxMessage.from_tx(tx) for tx in txs]),
+        ("TxBatch", lambda: TxBatch.from_txs(txs)),
+    )
+    print(f"Memory of {len(txs)} transactions:")
+    for name, fn in representations:
+        size, result = retained_memory(fn)
+        print(f"  {name + ':':40} {size / len(txs):8.1f} bytes/tx")
+        del result
+
+
+def bench_framing(repeat=20, chunk_size=64 * 1024):
+    """ NetworkEnvelope.decode on a whole stream vs EnvelopeFramer fed socket-sized chunks """
+    data = load_block_example()
+    wire = NetworkEnvelope(b'block', data, 'main').encode()
+    chunks = [wire[i:i + chunk_size] for i in range(0, len(wire), chunk_size)]
+
+    def framer():
+        f = EnvelopeFramer('main')
+        for chunk in chunks:
+            f.feed(chunk)
+
+    decode_time = best_of(lambda: NetworkEnvelope.decode(BytesIO(wire), 'main'), repeat)
+    framer_time = best_of(framer, repeat)
+    mb = len(wire) / 1e6
+    print(f"Envelope framing ({len(wire)} bytes in {len(chunks)} chunks):")
+    print(f"  NetworkEnvelope.decode: {decode_time * 1000:8.2f} ms  {mb / decode_time:7.1f} MB/s")
+    print(f"  EnvelopeFramer.feed:    {framer_time * 1000:8.2f} ms  {mb / framer_time:7.1f} MB/s")
+
+
+def percentiles(samples):
+    """ p50 and p99 of a list of latencies """
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49], cuts[98]
+
+
+def bench_block_store(count=5000, lookups=20000):
+    """ Random-access lookup latency of a BlockStore holding count blocks """
+    chain = build_chain(count)
+    with tempfile.TemporaryDirectory() as directory:
+        store = BlockStore(directory)
+        start = time.perf_counter()
+        hashes = [store.put(raw) for raw in chain]
+        write_time = time.perf_counter() - start
+        store.close()
+
+        start = time.perf_counter()
+        store = BlockStore(directory)
+        open_time = time.perf_counter() - start
+        rng = random.Random(1)
+        raw_latency, header_latency = [], []
+        for _ in range(lookups):
+            block_hash = rng.choice(hashes)
+            t0 = time.perf_counter()
+            store.get_raw(block_hash)
+            t1 = time.perf_counter()
+            store.get_block(block_hash).transactions[0]
+            t2 = time.perf_counter()
+            raw_latency.append(t1 - t0)
+            header_latency.append(t2 - t1)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        store.close()
+    print(f"Block store ({count} blocks, {size / 1e6:.1f} MB on disk):")
+    print(f"  put: {count / write_time:10.0f} blocks/s   reopen (index load): {open_time * 1000:.2f} ms")
+    for name, samples in (("get_raw", raw_latency), ("get_block + first tx", header_latency)):
+        p50, p99 = percentiles(samples)
+        print(f"  {name + ':':22} p50 {p50 * 1e6:7.1f} us  p99 {p99 * 1e6:7.1f} us")
+
+
+def bench_header_chain(count=100_000, mainnet_height=900_000):
+    """ Header validation speed, memory per header and checkpoint resume time """
+    headers = mine_headers(count)
+    tracemalloc.start()
+    start = time.perf_counter()
+    chain = HeaderChain(headers[0])
+    for i in range(1, count, 2000):
+        chain.add_headers(headers[i:i + 2000])
+    add_time = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'headers.dat')
+        chain.save(path)
+        load_time = best_of(lambda: HeaderChain.load(path), 3)
+    per_header = size / count
+    print(f"Header chain ({count} headers):")
+    print(f"  add_headers: {count / add_time:10.0f} headers/s")
+    print(f"  memory: {per_header:.0f} bytes/header, "
+          f"~{per_header * mainnet_height / 1e6:.0f} MB for {mainnet_height} headers")
+    print(f"  load checkpoint: {load_time * 1000:.1f} ms")
+
+
+def bench_pipeline(count=24, worker_counts=None):
+    """ Blocks/s and MB/s of DecodePipeline for several worker counts, vs decoding inline """
+    chain = build_chain(count, txs_per_block=1000)
+    mb = sum(len(raw) for raw in chain) / 1e6
+    print(f"Decode pipeline ({count} blocks, {mb:.1f} MB, {os.cpu_count()} cores):")
+    start = time.perf_counter()
+    for height, raw in enumerate(chain):
+        summarize(raw, height)
+    elapsed = time.perf_counter() - start
+    print(f"  {'inline:':12} {count / elapsed:8.1f} blocks/s  {mb / elapsed:7.1f} MB/s")
+    for workers in worker_counts or sorted({1, 2, os.cpu_count() or 1}):
+        with DecodePipeline(workers) as pipeline:
+            list(pipeline.decode(enumerate(chain[:workers])))  # start the worker processes
+            start = time.perf_counter()
+            for _ in pipeline.decode(enumerate(chain)):
+                pass
+            elapsed = time.perf_counter() - start
+        print(f"  {f'{workers} workers:':12} {count / elapsed:8.1f} blocks/s  {mb / elapsed:7.1f} MB/s")
+
+
+def bench_merkle(tx_count=6000, repeat=10):
+    """ Merkle root over a contiguous hash buffer vs a list of bytes, for a block-sized tx count """
+    txs = sample_transactions()
+    raw_txs = [txs[i % len(txs)] + i.to_bytes(4, 'little') for i in range(tx_count)]
+    txids = [hash256(tx) for tx in raw_txs]
+    packed = b''.join(txids)
+    assert merkle_root(packed) == naive_merkle_root(txids)
+    naive_time = best_of(lambda: naive_merkle_root(txids), repeat)
+    packed_time = best_of(lambda: merkle_root(packed), repeat)
+    loop_time = best_of(lambda: [hash256(tx) for tx in raw_txs], repeat)
+    batch_time = best_of(lambda: hash256_batch(raw_txs), repeat)
+    print(f"Merkle root ({tx_count} transactions):")
+    print(f"  naive list of bytes: {naive_time * 1000:8.2f} ms")
+    print(f"  contiguous buffer:   {packed_time * 1000:8.2f} ms  ({naive_time / packed_time:.2f}x)")
+    print(f"  txids, hash256 loop: {loop_time * 1000:8.2f} ms")
+    print(f"  txids, batch:        {batch_time * 1000:8.2f} ms")
+
+
+def synthetic_tx(i):
+    """ A minimal one input, one P2PKH output transaction, unique per i """
+    return (b'\x02\x00\x00\x00\x01' + hash256(i.to_bytes(8, 'little')) + b'\x00\x00\x00\x00\x00\xff\xff\xff\xff'
+            + b'\x01' + (1000 + i).to_bytes(8, 'little') + b'\x19\x76\xa9\x14' + b'\x00' * 20 + b'\x88\xac'
+            + b'\x00\x00\x00\x00')
+
+
+def bench_mempool(count=300_000, ops=20_000):
+    """ Mempool add / evict / top-N / removal latency at count entries """
+    rng = random.Random(1)
+    txs = [TxMessage.parse_from(synthetic_tx(i))[0] for i in range(count + ops)]
+    fees = [rng.randrange(100, 100_000) for _ in txs]
+    mempool = Mempool(max_bytes=sum(tx.size for tx in txs[:count]))
+    start = time.perf_counter()
+    for tx, fee in zip(txs[:count], fees):
+        mempool.add(tx, fee)
+    fill_time = time.perf_counter() - start
+    latencies = {"add (evicting)": [], "top 100": [], "remove": []}
+    for tx, fee in zip(txs[count:], fees[count:]):
+        t0 = time.perf_counter()
+        mempool.add(tx, fee)  # over budget: every add evicts the lowest fee rate
+        t1 = time.perf_counter()
+        mempool.top(100)
+        t2 = time.perf_counter()
+        mempool.remove(txs[rng.randrange(count)].txid)
+        t3 = time.perf_counter()
+        latencies["add (evicting)"].append(t1 - t0)
+        latencies["top 100"].append(t2 - t1)
+        latencies["remove"].append(t3 - t2)
+    print(f"Mempool ({len(mempool)} entries, {mempool.total_bytes / 1e6:.1f} MB of transactions):")
+    print(f"  fill: {count / fill_time:10.0f} tx/s")
+    for name, samples in latencies.items():
+        p50, p99 = percentiles(samples)
+        print(f"  {name + ':':16} p50 {p50 * 1e6:7.1f} us  p99 {p99 * 1e6:7.1f} us")
+
+
+def bench_utxo_apply(count=200, txs_per_block=500, flush_settings=(1, 10, 100)):
+    """ Block-apply throughput of UtxoSet for several flush intervals """
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in build_spending_chain(count, txs_per_block)]
+    for block in blocks:
+        for tx in block.transactions:
+            tx.txid  # hash up front, so only the UTXO work is timed
+    tx_count = sum(len(block.transactions) for block in blocks)
+    print(f"UTXO set ({count} blocks, {tx_count} transactions):")
+    for flush_every in flush_settings:
+        with tempfile.TemporaryDirectory() as directory:
+            utxos = UtxoSet(os.path.join(directory, 'utxo.sqlite'), flush_every=flush_every)
+            start = time.perf_counter()
+            for block in blocks:
+                utxos.apply_block(block)
+            utxos.flush()
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(10):
+                utxos.undo_block()
+            undo_time = (time.perf_counter() - start) / 10
+            utxos.close()
+        print(f"  flush every {flush_every:3} blocks: {count / elapsed:8.1f} blocks/s  {tx_count / elapsed:8.0f} tx/s"
+              f"   undo: {undo_time * 1000:.2f} ms/block")
+
+
+def bench_address_index(count=200, txs_per_block=500, lookups=5000):
+    """ Indexing speed of AddressIndex (outputs and spent scripts) and history page latency """
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in build_spending_chain(count, txs_per_block)]
+    tx_count = sum(len(block.transactions) for block in blocks)
+    with tempfile.TemporaryDirectory() as directory:
+        utxos = UtxoSet(os.path.join(directory, 'utxo.sqlite'))
+        index = AddressIndex(os.path.join(directory, 'index.sqlite'))
+        index_time = 0
+        for block in blocks:
+            start = time.perf_counter()
+            index.add_block(block, utxos)
+            index_time += time.perf_counter() - start
+            utxos.apply_block(block)
+        start = time.perf_counter()
+        index.flush()
+        index_time += time.perf_counter() - start
+        rng = random.Random(1)
+        scripts = [p2pkh_script(b'cb%d' % j) for j in range(txs_per_block)]  # paid in every block
+        scripts += [p2pkh_script(b'b%d' % h) for h in range(1, count)]  # paid in one block
+        latency = []
+        for _ in range(lookups):
+            script = rng.choice(scripts)
+            t0 = time.perf_counter()
+            index.history(script, limit=25)
+            latency.append(time.perf_counter() - t0)
+        size = os.path.getsize(os.path.join(directory, 'index.sqlite'))
+        index.close()
+        utxos.close()
+    print(f"Address index ({count} blocks, {tx_count} transactions, {size / 1e6:.1f} MB):")
+    print(f"  indexing: {count / index_time:8.1f} blocks/s  {tx_count / index_time:8.0f} tx/s")
+    p50, p99 = percentiles(latency)
+    print(f"  history page of 25: p50 {p50 * 1e6:7.1f} us  p99 {p99 * 1e6:7.1f} us")
+
+
+def per_line_print(block):
+    """ The block printed the way print_blockReadable used to: one print() call per field """
+    for line in block.readable_lines():
+        print(line)
+
+
+def bench_render(repeat=5):
+    """ Time to print the sample block per field vs through a Renderer, and the cost of submit on the caller """
+    block = BlockMessage.parse_from(load_block_example())[0]
+    for tx in block.transactions:
+        tx.txid
+    print(f"Rendering ({len(block.transactions)} transactions, to {os.devnull}):")
+    with open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull):
+            print_time = best_of(lambda: per_line_print(block), repeat)
+        print(f"  {'print() per field:':22} {print_time * 1000:8.1f} ms")
+        for mode in ('full', 'truncated', 'summary', 'json'):
+            def render():
+                renderer = Renderer(mode, devnull)
+                renderer.submit(block)
+                renderer.close()
+            print(f"  {mode + ' renderer:':22} {best_of(render, repeat) * 1000:8.1f} ms")
+        renderer = Renderer('full', devnull, queue_size=64)
+        submit_time = best_of(lambda: renderer.submit(block), 1000)
+        renderer.close()
+    print(f"  submit (network loop side): {submit_time * 1e6:.1f} us")
+
+
+def bench_compact_blocks(mempool_size=100_000, block_txs=3000, missing=150):
+    """ Short ID table rebuild and compact block reconstruction against a mempool of mempool_size txs """
+    raw_txs = [synthetic_tx(i) for i in range(mempool_size + missing)]
+    mempool = Mempool()
+    for raw in raw_txs[missing:]:
+        mempool.add(TxMessage.parse_from(raw)[0], fee=1000)
+    raw = build_block(raw_txs[:block_txs])  # the first missing txs are not in the mempool
+    block = BlockMessage.parse_from(raw)[0]
+    cmpct = compact_block(block, nonce=1)
+    encoded = cmpct.encode()
+    candidates = {txid: entry.tx for txid, entry in mempool.entries.items()}
+    key = short_id_key(cmpct.header, cmpct.nonce)
+    scalar_time = best_of(lambda: [siphash24(key[0], key[1], txid) for txid in list(candidates)[:10_000]], 1)
+    table_time = best_of(lambda: short_id_table(key, candidates), 3)
+    partial = PartialBlock(cmpct, candidates)
+    rebuild_time = best_of(lambda: PartialBlock(cmpct, candidates), 3)
+    filled = len(encoded) + sum(block.transactions[i].size for i in partial.missing)
+    print(f"Compact blocks ({block_txs} txs, {len(partial.missing)} missing, mempool of {len(mempool)}):")
+    scalar_time *= len(candidates) / 10_000
+    print(f"  short ID table, scalar SipHash: {scalar_time * 1000:8.1f} ms (extrapolated from 10k txs)")
+    print(f"  short ID table, batch SipHash:  {table_time * 1000:8.1f} ms")
+    print(f"  reconstruction incl. table:     {rebuild_time * 1000:8.1f} ms")
+    print(f"  bytes: {filled} (cmpctblock + blocktxn) vs {len(raw)} full block, {1 - filled / len(raw):.1%} saved")
+
+
+def bench_metrics(repeat=20, chunk_size=64 * 1024):
+    """ Cost of the instrumentation on framing and block parsing: metrics off, on, and with a profiler """
+    data = load_block_example()
+    wire = NetworkEnvelope(b'block', data, 'main').encode()
+    chunks = [wire[i:i + chunk_size] for i in range(0, len(wire), chunk_size)]
+
+    def receive():
+        f = EnvelopeFramer('main')
+        for chunk in chunks:
+            for env in f.feed(chunk):
+                BlockMessage.parse_from(env.payload)
+
+    off_time = best_of(receive, repeat)
+    METRICS.enable()
+    times = {'enabled': best_of(receive, repeat)}
+    for mode in ('sampling', 'cprofile'):
+        METRICS.profile_block_parse(mode)
+        times[mode + ' profiler'] = best_of(receive, repeat)
+        METRICS.profile_block_parse(None)
+    METRICS.enable(False)
+    METRICS.reset()
+    print(f"Metrics overhead (frame and parse a {len(data)} byte block):")
+    print(f"  {'disabled:':18} {off_time * 1000:8.2f} ms")
+    for name, elapsed in times.items():
+        print(f"  {name + ':':18} {elapsed * 1000:8.2f} ms  ({(elapsed / off_time - 1) * 100:+.1f}%)")
+
+
+def import_time(statement, repeat=5):
+    """ Fastest time to run statement in a fresh interpreter, imports included """
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True,
+                                    check=True).stdout) for _ in range(repeat))
+
+
+def bench_startup(old_txs=2000, repeat=5, hashes=50_000):
+    """
+    Time to the first useful message: a FakePeer announces old_txs transactions
+    fetched in an earlier session plus a new one, announced last. A cold start
+    fetches them all before the new one arrives; a warm start maps the
+    snapshot and asks for the new one only. Also Main's import time, lazy vs
+    with the optional modules, and the load time of a snapshot of hashes.
+    """
+    import asyncio
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+
+    txs = BlockMessage.parse_from(synthetic_block(1, tx_count=old_txs + 1))[0].transactions
+    new = txs[-1].txid
+    inventory = {(1, tx.txid): tx.encode() for tx in txs}
+
+    async def first_new_tx(snapshot_path):
+        peer = await FakePeer(inventory=inventory).start()
+        arrived = asyncio.Event()
+        start = time.perf_counter()
+        snapshot = Snapshot.load(snapshot_path) if snapshot_path else None
+        node = AsyncNode('127.0.0.1', peer.port, snapshot=snapshot)
+        node.on_tx = lambda tx: tx.txid == new and arrived.set()
+        await node.connect()
+        try:
+            await asyncio.wait_for(arrived.wait(), 60)
+            return time.perf_counter() - start
+        finally:
+            await node.close()
+            await peer.close()
+            await asyncio.sleep(0)  # let the peer's connection handler see the close
+            if snapshot is not None:
+                snapshot.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.snapshot')
+        previous = Snapshot()
+        for tx in txs[:-1]:
+            previous.seen.add(tx.txid)
+        previous.save(path)
+        cold = min(asyncio.run(first_new_tx(None)) for _ in range(repeat))
+        warm = min(asyncio.run(first_new_tx(path)) for _ in range(repeat))
+
+        big = Snapshot()
+        for i in range(hashes):
+            big.seen.add(hash256(i.to_bytes(4, 'little')))
+        size = big.save(path)
+        load_time = best_of(lambda: Snapshot.load(path).close(), repeat * 4)
+        with open(path, 'rb') as f:
+            data = f.read()
+        set_time = best_of(lambda: {data[i:i + 32] for i in range(len(data) - hashes * 32, len(data), 32)}, repeat * 4)
+        probe = hash256((hashes // 2).to_bytes(4, 'little'))
+        snapshot = Snapshot.load(path)
+        lookup_time = best_of(lambda: probe in snapshot.seen, 1000)
+        snapshot.close()
+
+    lazy = import_time("import Main")
+    eager = import_time("import Main, asyncio, ExplorerAPI, cProfile, pstats, http.server, concurrent.futures")
+    print(f"Startup (FakePeer announcing {old_txs} old transactions and a new one, first new tx received):")
+    print(f"  cold, no snapshot:   {cold * 1000:8.1f} ms")
+    print(f"  warm, snapshot:      {warm * 1000:8.1f} ms  ({cold / warm:.1f}x faster)")
+    print(f"  import Main, lazy:   {lazy * 1000:8.1f} ms")
+    print(f"  with optional parts: {eager * 1000:8.1f} ms")
+    print(f"  snapshot of {hashes} hashes ({size / 1e6:.1f} MB): mmap load {load_time * 1e6:.0f} us, "
+          f"building a set {set_time * 1000:.1f} ms, lookup {lookup_time * 1e6:.1f} us")
+
+
+def main():
+    bench_block_parse()
+    bench_first_page()
+    bench_tx_memory()
+    bench_framing()
+    bench_block_store()
+    bench_header_chain()
+    bench_pipeline()
+    bench_merkle()
+    bench_mempool()
+    bench_utxo_apply()
+    bench_address_index()
+    bench_render()
+    bench_compact_blocks()
+    bench_metrics()
+    bench_startup()
+
+
+if __name__ == "__main__":
+    main()
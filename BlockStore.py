@@ -0,0 +1,265 @@
+"""
+Append-only on-disk block store, laid out like Bitcoin Core's blocks directory.
+
+ - blk00000.dat, blk00001.dat, ...: segment files of raw serialized blocks, each
+   record prefixed with the network magic and the block length
+ - index.dat: fixed-size records of (hash, prev hash, height, file, offset, length),
+   appended as blocks are stored and loaded into a dict keyed by block hash on open;
+   a later record for the same hash replaces an earlier one
+
+A block's height is one above its stored parent's, else the height its coinbase
+commits to (BIP34), else unknown until its parent is stored: the parent then gives
+it and its stored descendants their heights, recorded by appending their records again.
+
+Reads go through mmap, so getting a stored block back is a memoryview of the
+page cache rather than a file read.
+
+Usage: python BlockStore.py rebuild <directory>
+"""
+import mmap
+import os
+import struct
+import sys
+from dataclasses import dataclass
+
+from Handshake import MAGICS
+from MessageHandler import LazyBlock
+from Utils import hash256
+
+INDEX_RECORD = struct.Struct('<32s32siIQI')  # hash, prev_block, height, file, offset, length
+RECORD_HEADER = struct.Struct('<4sI')  # magic, length
+MAX_SEGMENT_SIZE = 128 * 1024 * 1024
+UNKNOWN_HEIGHT = -1
+
+
+@dataclass(slots=True)
+class BlockLocation:
+    prev_block: bytes
+    height: int
+    file: int
+    offset: int  # of the raw block, after its record header
+    length: int
+
+
+def write_record(f, block_hash, location):
+    f.write(INDEX_RECORD.pack(block_hash, location.prev_block, location.height,
+                              location.file, location.offset, location.length))
+
+
+def parse_block(raw):
+    """ LazyBlock over raw, raising ValueError unless raw is exactly one well-formed block """
+    block, end = LazyBlock.parse_from(raw, cache_size=1)
+    if end != len(raw):
+        raise ValueError("%d bytes after the block" % (len(raw) - end,))
+    return block
+
+
+class BlockStore:
+    def __init__(self, directory: str, net: str = 'main', max_segment_size: int = MAX_SEGMENT_SIZE):
+        self.directory = directory
+        self.magic = MAGICS[net]
+        self.max_segment_size = max_segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.index = {}  # block hash -> BlockLocation
+        self.heights = {}  # height -> block hash
+        self.orphans = {}  # prev block hash -> hashes of stored blocks whose height is still unknown
+        self.maps = {}  # file number -> mmap of that segment
+        self.load_index()
+        self.index_file = open(self.index_path(), 'ab')
+        self.file_number = max([loc.file for loc in self.index.values()], default=0)
+        self.segment = open(self.segment_path(self.file_number), 'ab')
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, 'blk%05d.dat' % number)
+
+    def index_path(self):
+        return os.path.join(self.directory, 'index.dat')
+
+    def load_index(self):
+        if not os.path.exists(self.index_path()):
+            return
+        with open(self.index_path(), 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size  # ignore a torn last record
+        for block_hash, prev_block, height, file, offset, length in INDEX_RECORD.iter_unpack(data[:usable]):
+            self.add_location(block_hash, BlockLocation(prev_block, height, file, offset, length))
+
+    def add_location(self, block_hash, location, out=None):
+        """
+        Index a block; if its height is known, give it to the stored descendants
+        still waiting for it, appending their new records to out if given
+        """
+        self.index[block_hash] = location
+        if location.height == UNKNOWN_HEIGHT:
+            self.orphans.setdefault(location.prev_block, []).append(block_hash)
+            return
+        self.heights[location.height] = block_hash
+        stack = [block_hash]
+        while stack:
+            parent_hash = stack.pop()
+            height = self.index[parent_hash].height + 1
+            for child_hash in self.orphans.pop(parent_hash, ()):
+                child = self.index[child_hash]
+                if child.height != UNKNOWN_HEIGHT:
+                    continue  # a later record gave it a height already
+                child.height = height
+                self.heights[height] = child_hash
+                if out is not None:
+                    write_record(out, child_hash, child)
+                stack.append(child_hash)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def height_of(self, raw, height=None, block=None):
+        """
+        Height of a new block: given, one above its stored parent, 0 for a genesis
+        block, else BIP34's. block is raw already parsed, if it was.
+        """
+        if height is not None:
+            return height
+        prev_block = bytes(raw[4:36])
+        parent = self.index.get(prev_block)
+        if parent is not None and parent.height != UNKNOWN_HEIGHT:
+            return parent.height + 1
+        if prev_block == b'\x00' * 32:
+            return 0
+        if block is None:
+            block = LazyBlock.parse_from(raw, cache_size=1)[0]
+        coinbase_height = block.coinbase_height()
+        return UNKNOWN_HEIGHT if coinbase_height is None else coinbase_height
+
+    def put(self, raw, height: int = None):
+        """
+        Append a serialized block unless it is already stored, return its hash.
+        Raises ValueError, writing nothing, if raw is not exactly one block.
+        """
+        block_hash = hash256(raw[:80])
+        if block_hash in self.index:
+            return block_hash
+        height = self.height_of(raw, height, parse_block(raw))
+        if self.segment.tell() > 0 and self.segment.tell() + RECORD_HEADER.size + len(raw) > self.max_segment_size:
+            self.segment.close()
+            self.file_number += 1
+            self.segment = open(self.segment_path(self.file_number), 'ab')
+        self.segment.write(RECORD_HEADER.pack(self.magic, len(raw)))
+        offset = self.segment.tell()
+        self.segment.write(raw)
+        self.segment.flush()
+        location = BlockLocation(bytes(raw[4:36]), height, self.file_number, offset, len(raw))
+        write_record(self.index_file, block_hash, location)
+        self.add_location(block_hash, location, self.index_file)
+        self.index_file.flush()
+        return block_hash
+
+    def segment_map(self, number, end):
+        """ mmap of segment file number, remapped if it doesn't reach end yet """
+        m = self.maps.get(number)
+        if m is None or len(m) < end:
+            if m is not None:
+                try:
+                    m.close()
+                except BufferError:
+                    pass  # still referenced by a returned block, released with it
+            with open(self.segment_path(number), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[number] = m
+        return m
+
+    def get_raw(self, block_hash):
+        """ The serialized block as a memoryview into the mapped segment file, or None """
+        location = self.index.get(block_hash)
+        if location is None:
+            return None
+        end = location.offset + location.length
+        return memoryview(self.segment_map(location.file, end))[location.offset:end]
+
+    def get_block(self, block_hash, cache_size=64):
+        """ A LazyBlock over the mapped bytes, or None """
+        raw = self.get_raw(block_hash)
+        return None if raw is None else LazyBlock.parse_from(raw, cache_size=cache_size)[0]
+
+    def get_by_height(self, height):
+        block_hash = self.heights.get(height)
+        return None if block_hash is None else self.get_block(block_hash)
+
+    def rebuild_index(self):
+        """
+        Recreate index.dat by scanning the segment files, return the number of
+        blocks found. New blocks then go to the last segment, cut back to its
+        last whole record so a torn one doesn't hide them from the next rebuild.
+        If the scan fails, the store is left as it was.
+        """
+        previous = self.index, self.heights, self.orphans
+        self.index, self.heights, self.orphans = {}, {}, {}
+        tmp = self.index_path() + '.tmp'
+        try:
+            with open(tmp, 'wb') as out:
+                last, end = self.scan_segments(out)
+        except BaseException:
+            self.index, self.heights, self.orphans = previous
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.index_file.close()
+        os.replace(tmp, self.index_path())
+        self.index_file = open(self.index_path(), 'ab')
+        self.segment.close()
+        self.file_number = last
+        self.segment = open(self.segment_path(last), 'ab')
+        self.segment.truncate(end)
+        self.segment.seek(0, os.SEEK_END)
+        return len(self.index)
+
+    def scan_segments(self, out):
+        """ Index every whole block of the segment files, writing the records to out; return (last file, its end) """
+        number = end = 0
+        while os.path.exists(self.segment_path(number)):
+            with open(self.segment_path(number), 'rb') as f:
+                data = f.read()
+            pos = 0
+            while pos + RECORD_HEADER.size <= len(data):
+                magic, length = RECORD_HEADER.unpack_from(data, pos)
+                offset = pos + RECORD_HEADER.size
+                if magic != self.magic or offset + length > len(data):
+                    break  # unused or torn tail of the segment
+                raw = data[offset:offset + length]
+                pos = offset + length
+                try:
+                    height = self.height_of(raw, block=parse_block(raw))
+                except ValueError:
+                    continue  # not a block: left unindexed
+                location = BlockLocation(raw[4:36], height, number, offset, length)
+                block_hash = hash256(raw[:80])
+                write_record(out, block_hash, location)
+                self.add_location(block_hash, location, out)
+            end = pos
+            number += 1
+        return max(number - 1, 0), end
+
+    def close(self):
+        for m in self.maps.values():
+            try:
+                m.close()
+            except BufferError:
+                pass  # a returned block still points into it; the map is released with that view
+        self.maps.clear()
+        self.segment.close()
+        self.index_file.close()
+
+
+def main(argv):
+    if len(argv) != 3 or argv[1] != 'rebuild':
+        print("Usage: python BlockStore.py rebuild <directory>")
+        return 1
+    store = BlockStore(argv[2])
+    print(f"Indexed {store.rebuild_index()} blocks")
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,220 @@
+"""
+BIP152 compact block reconstruction.
+
+A cmpctblock carries a 6-byte short ID per transaction instead of the
+transaction itself. Short IDs are SipHash-2-4 of the txid (version 1) or wtxid
+(version 2), keyed by the block header and a nonce, so the receiver hashes
+every transaction it already holds (its mempool) with that block's key, looks
+the short IDs up in the resulting table, and asks with getblocktxn for the few
+it didn't find. The key changes with every block, so the table is rebuilt per
+block; siphash24_hashes does that for the whole mempool in one batch.
+
+CompactBlockRelay wraps the message exchange for SimpleNode and AsyncNode:
+each handler returns the finished block (if any) and the message to send next
+(if any).
+"""
+import hashlib
+import struct
+import time
+from collections import Counter
+from io import BytesIO
+
+from Hashing import siphash24_hashes
+from MessageHandler import (BLOCK_HEADER, BlockMessage, BlockTxnMessage, CmpctBlockMessage, GetBlockTxnMessage,
+                            GetDataMessage, SendCmpctMessage)
+from Utils import encode_varint
+
+MSG_BLOCK, MSG_CMPCT_BLOCK = 2, 4  # getdata types of a full and a compact block
+SHORT_ID_BYTES = 6
+
+
+def short_id_key(header, nonce):
+    """ SipHash key (k0, k1) of a compact block: the first 16 bytes of SHA256(header || nonce) """
+    return struct.unpack_from('<QQ', hashlib.sha256(bytes(header) + nonce.to_bytes(8, 'little')).digest())
+
+
+def short_ids(key, hashes):
+    return siphash24_hashes(key[0], key[1], hashes, SHORT_ID_BYTES)
+
+
+def short_id_table(key, candidates):
+    """
+    short ID -> tx for candidates, a dict of txid (or wtxid) -> TxMessage.
+    Short IDs shared by several candidates map to None: those txs have to be requested.
+    """
+    ids = short_ids(key, candidates)
+    table = dict(zip(ids, candidates.values()))
+    if len(table) != len(ids):
+        for short_id, count in Counter(ids).items():
+            if count > 1:
+                table[short_id] = None
+    return table
+
+
+def mempool_candidates(mempool, use_wtxid=False):
+    """ The mempool's transactions keyed the way short IDs are computed """
+    if not use_wtxid:
+        return {txid: entry.tx for txid, entry in mempool.entries.items()}
+    return {entry.tx.wtxid: entry.tx for entry in mempool.entries.values()}
+
+
+def compact_block(block, nonce, use_wtxid=False, prefill=(0,)):
+    """ CmpctBlockMessage for a parsed block, with the transactions at indexes prefill sent in full """
+    header = block.header()
+    key = short_id_key(header, nonce)
+    prefill = set(prefill)
+    hashes = [tx.wtxid if use_wtxid else tx.txid for i, tx in enumerate(block.transactions) if i not in prefill]
+    return CmpctBlockMessage(header, nonce, short_ids(key, hashes),
+                             [(i, block.transactions[i]) for i in sorted(prefill)])
+
+
+def serialize_block(header, transactions):
+    return b''.join([bytes(header), encode_varint(len(transactions))] + [tx.encode() for tx in transactions])
+
+
+class PartialBlock:
+    """ A compact block being filled in from local transactions and then a blocktxn """
+
+    def __init__(self, cmpct: CmpctBlockMessage, candidates):
+        if len(set(cmpct.short_ids)) != len(cmpct.short_ids):
+            raise ValueError("compact block has duplicate short IDs")
+        self.header = cmpct.header
+        self.block_hash = cmpct.block_hash
+        self.transactions = [None] * cmpct.tx_count
+        for index, tx in cmpct.prefilled:
+            if index >= len(self.transactions):
+                raise ValueError("prefilled transaction index out of range")
+            self.transactions[index] = tx
+        table = short_id_table(short_id_key(cmpct.header, cmpct.nonce), candidates)
+        slots = (i for i, tx in enumerate(self.transactions) if tx is None)
+        self.missing = []
+        for index, short_id in zip(slots, cmpct.short_ids):
+            tx = table.get(short_id)
+            if tx is None:
+                self.missing.append(index)
+            else:
+                self.transactions[index] = tx
+        self.from_mempool = len(cmpct.short_ids) - len(self.missing)
+        self.bytes_received = 0
+
+    def fill(self, transactions):
+        """ Put the transactions of a blocktxn in the missing slots """
+        if len(transactions) != len(self.missing):
+            raise ValueError("blocktxn has %d transactions, %d were asked for" % (len(transactions), len(self.missing)))
+        for index, tx in zip(self.missing, transactions):
+            self.transactions[index] = tx
+        self.missing = []
+
+    def block(self):
+        """ The reconstructed BlockMessage, or None if it doesn't match its merkle root (a short ID collision) """
+        block = BlockMessage(*BLOCK_HEADER.unpack(self.header), self.transactions)
+        return block if block.check_merkle_root() else None
+
+
+def build_partial(payload, candidates):
+    """
+    The CPU-heavy half of CompactBlockRelay.on_cmpctblock, safe to run in an
+    executor: (cmpctblock, PartialBlock or None if it can't be reconstructed)
+    """
+    cmpct = CmpctBlockMessage.parse_from(payload)[0]
+    try:
+        return cmpct, PartialBlock(cmpct, candidates)
+    except ValueError:
+        return cmpct, None
+
+
+class CompactBlockRelay:
+    """
+    Receiving side of compact block relay (low-bandwidth mode: blocks are still
+    announced by inv, then fetched as cmpctblock). Enabled once the peer sends
+    sendcmpct, if there is a mempool to reconstruct from. Reconstructions
+    waiting for a blocktxn are dropped after pending_timeout seconds, and the
+    oldest beyond max_pending, so a peer that never answers can't grow them.
+    """
+
+    def __init__(self, mempool=None, pending_timeout: float = 60.0, max_pending: int = 16):
+        self.mempool = mempool
+        self.version = None  # negotiated compact block version, None until the peer sends sendcmpct
+        self.pending = {}  # block hash -> (PartialBlock waiting for a blocktxn, time.monotonic() deadline)
+        self.pending_timeout = pending_timeout
+        self.max_pending = max_pending
+        self.expired = 0  # reconstructions dropped without their blocktxn
+        self.bytes_received = 0  # cmpctblock and blocktxn payloads
+        self.bytes_full = 0  # size of the same blocks as full block messages
+        self.blocks = 0
+
+    @property
+    def enabled(self):
+        return self.version is not None
+
+    def block_type(self):
+        """ getdata type to use for announced blocks """
+        return MSG_CMPCT_BLOCK if self.enabled else MSG_BLOCK
+
+    def on_sendcmpct(self, payload):
+        """ Return the sendcmpct to answer with, or None if compact blocks stay off """
+        message = SendCmpctMessage.parse(BytesIO(bytes(payload)))
+        if self.mempool is None or message.version not in (1, 2) or self.enabled:
+            return None
+        self.version = message.version
+        return SendCmpctMessage(False, self.version)
+
+    def candidates(self):
+        return mempool_candidates(self.mempool, self.version == 2)
+
+    def on_cmpctblock(self, payload, candidates=None):
+        """
+        Return (block or None, message to send or None). candidates defaults to
+        the mempool's transactions. A cmpctblock received while compact blocks
+        are off is answered with a getdata for the full block.
+        """
+        if not self.enabled:
+            return None, GetDataMessage([(MSG_BLOCK, CmpctBlockMessage.parse_from(payload)[0].block_hash)])
+        cmpct, partial = build_partial(payload, self.candidates() if candidates is None else candidates)
+        return self.on_partial(cmpct, partial, len(payload))
+
+    def on_partial(self, cmpct, partial, size):
+        """
+        The bookkeeping half of on_cmpctblock, for the result of build_partial
+        over a payload of size bytes; call it from the thread that owns the relay
+        """
+        if partial is None:
+            return None, GetDataMessage([(MSG_BLOCK, cmpct.block_hash)])
+        partial.bytes_received = size
+        if partial.missing:
+            self.expire()
+            self.pending[partial.block_hash] = (partial, time.monotonic() + self.pending_timeout)
+            while len(self.pending) > self.max_pending:
+                del self.pending[next(iter(self.pending))]
+                self.expired += 1
+            return None, GetBlockTxnMessage(partial.block_hash, partial.missing)
+        return self.finish(partial)
+
+    def on_blocktxn(self, payload):
+        message = BlockTxnMessage.parse_from(payload)[0]
+        self.expire()
+        partial, _ = self.pending.pop(message.block_hash, (None, None))
+        if partial is None:
+            return None, None
+        partial.bytes_received += len(payload)
+        try:
+            partial.fill(message.transactions)
+        except ValueError:
+            return None, GetDataMessage([(MSG_BLOCK, partial.block_hash)])
+        return self.finish(partial)
+
+    def expire(self, now: float = None):
+        """ Drop the reconstructions whose blocktxn is overdue """
+        now = time.monotonic() if now is None else now
+        for block_hash in [h for h, (_, deadline) in self.pending.items() if deadline < now]:
+            del self.pending[block_hash]
+            self.expired += 1
+
+    def finish(self, partial):
+        block = partial.block()
+        if block is None:
+            return None, GetDataMessage([(MSG_BLOCK, partial.block_hash)])
+        self.blocks += 1
+        self.bytes_received += partial.bytes_received
+        self.bytes_full += 80 + len(encode_varint(len(block.transactions))) + sum(tx.size for tx in block.transactions)
+        return block, None
@@ -0,0 +1,222 @@
+"""
+Compact in-memory representations of transactions, for when many of them are
+kept alive at once (busy blocks, the mempool mirror).
+
+ - SlotInput / SlotOutput / SlotTxMessage: same fields as the MessageHandler
+   dataclasses, but with __slots__ instead of a per-instance __dict__
+ - FrozenInput / FrozenOutput / FrozenTxMessage: slotted, immutable and hashable
+ - TxBatch: columnar storage of many transactions in a handful of arrays
+
+All conversions copy scripts and hashes into bytes, so the compact objects do
+not keep the memoryview'd block buffer of a parse_from() alive.
+"""
+from array import array
+from dataclasses import dataclass
+from io import BytesIO
+from typing import List, Tuple
+
+from MessageHandler import Input, Output, TxMessage, decode_script
+from Utils import UINT32, decode_varint, encode_varint
+
+
+@dataclass(slots=True)
+class SlotInput:
+    prevout_hash: bytes
+    prevout_index: int
+    script_sig: bytes
+    sequence: int
+    witness: Tuple[bytes, ...] = ()
+
+    @classmethod
+    def from_input(cls, tx_in):
+        return cls(bytes(tx_in.prevout_hash), tx_in.prevout_index, bytes(tx_in.script_sig), tx_in.sequence,
+                   tuple(bytes(item) for item in tx_in.witness))
+
+    def to_input(self):
+        return Input(self.prevout_hash, self.prevout_index, self.script_sig, self.sequence, self.witness)
+
+
+@dataclass(slots=True)
+class SlotOutput:
+    value: int  # Value in satoshis
+    script_pubkey: bytes
+
+    @classmethod
+    def from_output(cls, tx_out):
+        return cls(tx_out.value, bytes(tx_out.script_pubkey))
+
+    def to_output(self):
+        return Output(self.value, self.script_pubkey)
+
+
+@dataclass(slots=True)
+class SlotTxMessage:
+    version: int
+    inputs: List[SlotInput]
+    outputs: List[SlotOutput]
+    locktime: int
+
+    @classmethod
+    def from_tx(cls, tx):
+        return cls(tx.version, [SlotInput.from_input(i) for i in tx.inputs],
+                   [SlotOutput.from_output(o) for o in tx.outputs], tx.locktime)
+
+    def to_tx(self):
+        return TxMessage(self.version, [i.to_input() for i in self.inputs],
+                         [o.to_output() for o in self.outputs], self.locktime)
+
+
+@dataclass(slots=True, frozen=True)
+class FrozenInput:
+    prevout_hash: bytes
+    prevout_index: int
+    script_sig: bytes
+    sequence: int
+    witness: Tuple[bytes, ...] = ()
+
+    @classmethod
+    def from_input(cls, tx_in):
+        return cls(bytes(tx_in.prevout_hash), tx_in.prevout_index, bytes(tx_in.script_sig), tx_in.sequence,
+                   tuple(bytes(item) for item in tx_in.witness))
+
+    def to_input(self):
+        return Input(self.prevout_hash, self.prevout_index, self.script_sig, self.sequence, self.witness)
+
+
+@dataclass(slots=True, frozen=True)
+class FrozenOutput:
+    value: int  # Value in satoshis
+    script_pubkey: bytes
+
+    @classmethod
+    def from_output(cls, tx_out):
+        return cls(tx_out.value, bytes(tx_out.script_pubkey))
+
+    def to_output(self):
+        return Output(self.value, self.script_pubkey)
+
+
+@dataclass(slots=True, frozen=True)
+class FrozenTxMessage:
+    version: int
+    inputs: Tuple[FrozenInput, ...]
+    outputs: Tuple[FrozenOutput, ...]
+    locktime: int
+
+    @classmethod
+    def from_tx(cls, tx):
+        return cls(tx.version, tuple(FrozenInput.from_input(i) for i in tx.inputs),
+                   tuple(FrozenOutput.from_output(o) for o in tx.outputs), tx.locktime)
+
+    def to_tx(self):
+        return TxMessage(self.version, [i.to_input() for i in self.inputs],
+                         [o.to_output() for o in self.outputs], self.locktime)
+
+
+class TxBatch:
+    """
+    Columnar storage for many transactions. Per-object overhead is replaced by:
+     - versions, locktimes: array('L'), one entry per tx
+     - input_start, output_start: array('Q') of len(self) + 1 entries; the inputs
+       of tx t are input_start[t]:input_start[t + 1] (same for outputs)
+     - prevouts: 36 bytes per input (32-byte hash + 4-byte little endian index)
+     - sequences: array('L'), values: array('q') per input / output
+     - scripts: one shared bytearray. Per tx the input scripts come first, then the
+       output scripts; script_offsets[k]:script_offsets[k + 1] is script k
+     - witnesses: serialized witness stack per input (empty if none), delimited
+       by witness_offsets
+    """
+
+    def __init__(self):
+        self.versions = array('L')
+        self.locktimes = array('L')
+        self.input_start = array('Q', [0])
+        self.output_start = array('Q', [0])
+        self.prevouts = bytearray()
+        self.sequences = array('L')
+        self.values = array('q')
+        self.scripts = bytearray()
+        self.script_offsets = array('Q', [0])
+        self.witnesses = bytearray()
+        self.witness_offsets = array('Q', [0])
+
+    @classmethod
+    def from_txs(cls, txs):
+        batch = cls()
+        batch.extend(txs)
+        return batch
+
+    def __len__(self):
+        return len(self.versions)
+
+    def append(self, tx):
+        self.versions.append(tx.version)
+        self.locktimes.append(tx.locktime)
+        for tx_in in tx.inputs:
+            self.prevouts += tx_in.prevout_hash
+            self.prevouts += UINT32.pack(tx_in.prevout_index)
+            self.sequences.append(tx_in.sequence)
+            self._add_script(tx_in.script_sig)
+            if tx_in.witness:
+                self.witnesses += encode_varint(len(tx_in.witness))
+                for item in tx_in.witness:
+                    self.witnesses += encode_varint(len(item))
+                    self.witnesses += item
+            self.witness_offsets.append(len(self.witnesses))
+        for tx_out in tx.outputs:
+            self.values.append(tx_out.value)
+            self._add_script(tx_out.script_pubkey)
+        self.input_start.append(self.input_start[-1] + len(tx.inputs))
+        self.output_start.append(self.output_start[-1] + len(tx.outputs))
+
+    def extend(self, txs):
+        for tx in txs:
+            self.append(tx)
+
+    def _add_script(self, script):
+        self.scripts += script
+        self.script_offsets.append(len(self.scripts))
+
+    def _script(self, k):
+        return bytes(self.scripts[self.script_offsets[k]:self.script_offsets[k + 1]])
+
+    def input(self, t, k):
+        """ The k-th input (global index) of tx t as an Input """
+        prevout = self.prevouts[36 * k:36 * k + 36]
+        witness = ()
+        start, end = self.witness_offsets[k], self.witness_offsets[k + 1]
+        if end > start:
+            s = BytesIO(self.witnesses[start:end])
+            witness = tuple(decode_script(s) for _ in range(decode_varint(s)))
+        return Input(bytes(prevout[:32]), UINT32.unpack_from(prevout, 32)[0],
+                     self._script(k + self.output_start[t]), self.sequences[k], witness)
+
+    def output(self, t, m):
+        """ The m-th output (global index) of tx t as an Output """
+        return Output(self.values[m], self._script(m + self.input_start[t + 1]))
+
+    def tx(self, t):
+        """ Convert transaction t back to a TxMessage """
+        if t < 0:
+            t += len(self)
+        inputs = [self.input(t, k) for k in range(self.input_start[t], self.input_start[t + 1])]
+        outputs = [self.output(t, m) for m in range(self.output_start[t], self.output_start[t + 1])]
+        return TxMessage(self.versions[t], inputs, outputs, self.locktimes[t])
+
+    def __getitem__(self, t):
+        return self.tx(t)
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self.tx(t)
+
+    def total_value(self, t):
+        """ Sum of the output values of tx t, straight from the value column """
+        return sum(self.values[self.output_start[t]:self.output_start[t + 1]])
+
+    def nbytes(self):
+        """ Bytes held by the columns (excluding the constant per-object overhead) """
+        columns = (self.versions, self.locktimes, self.input_start, self.output_start, self.sequences,
+                   self.values, self.script_offsets, self.witness_offsets)
+        return sum(c.itemsize * len(c) for c in columns) + len(self.prevouts) + len(self.scripts) + \
+            len(self.witnesses)
@@ -1,38 +1,73 @@
 import socket
+import time
+from collections import deque
 
-from Handshake import NetworkEnvelope, PingMessage, PongMessage, VersionMessage, VerAckMessage
-from MessageHandler import GetDataMessage, InvMessage, TxMessage, BlockMessage
+from Handshake import EnvelopeFramer, NetworkEnvelope, PingMessage, PongMessage, VersionMessage, VerAckMessage
+from MessageHandler import (GetDataMessage, InvMessage, TxMessage, BlockMessage, BlockTxnMessage, CmpctBlockMessage,
+                            SendCmpctMessage)
+from Metrics import METRICS
+
+MSG_BLOCK = 2  # getdata type of a full block
 
 
 class SimpleNode:
-    def __init__(self, host: str, net: str, verbose: int = 0):
+    def __init__(self, host: str, net: str, verbose: int = 0, block_store=None, mempool=None, renderer=None,
+                 explorer=None, snapshot=None, port: int = None, connect_timeout: float = None):
         self.net = net
         self.verbose = verbose
+        self.block_store = block_store  # optional BlockStore.BlockStore keeping every received block
+        self.mempool = mempool  # optional Mempool.Mempool mirroring unconfirmed transactions
+        if renderer is None:
+            from Renderer import Renderer  # optional parts are imported when used, to keep startup short
+
+            renderer = Renderer('full')
+        self.renderer = renderer  # prints blocks/txs off the network loop
+        self.explorer = explorer  # optional ExplorerAPI.Explorer answering queries about received data
+        self.snapshot = snapshot  # optional Snapshot.Snapshot: peer latency, inventory already seen, last tip
+        self.compact = None  # CompactBlocks.CompactBlockRelay, used once the peer sends sendcmpct
+        if mempool is not None:  # compact blocks are reconstructed from the mempool, so need one
+            from CompactBlocks import CompactBlockRelay
+
+            self.compact = CompactBlockRelay(mempool)
 
         # DNS resolution of the host name
         resolved_ip = socket.gethostbyname(host)
-        port = {'main': 8333, 'test': 18333}[net]
+        port = port or {'main': 8333, 'test': 18333}[net]
+        self.address = (resolved_ip, port)
 
         # Set up the socket connection
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((resolved_ip, port))
+        self.connect_started = time.perf_counter()
+        self.socket = socket.create_connection(self.address, connect_timeout)
+        self.socket.settimeout(None)
         print("Connected to Bitcoin node at {}:{}".format(resolved_ip, port))
-        self.stream = self.socket.makefile('rb', None)
+        self.framer = EnvelopeFramer(net, verbose=verbose)
+        self.received = deque()  # envelopes decoded by the framer but not read yet
 
     def send(self, message):
         env = NetworkEnvelope(message.command, message.encode(), net=self.net)
         if self.verbose:
             print(f"sending: {env}")
-        self.socket.sendall(env.encode())
+        if METRICS.enabled:
+            start = time.perf_counter()
+            self.socket.sendall(env.encode())
+            METRICS.send_latency.observe(time.perf_counter() - start)
+        else:
+            self.socket.sendall(env.encode())
 
     def read(self):
-        env = NetworkEnvelope.decode(self.stream, net=self.net)
-        # print("Received message:", env)
-
-        return env
+        while not self.received:
+            nbytes = self.socket.recv_into(self.framer.recv_view)
+            if nbytes == 0:
+                raise ConnectionError("Connection was reset")
+            self.received.extend(self.framer.feed_received(nbytes))
+        return self.received.popleft()
 
     def handle_inv(self, inv):
         getdata_items = [(type, hash) for type, hash in inv.items if type in [1, 2]]  # 1 for TX, 2 for Block
+        if self.snapshot is not None:
+            getdata_items = [(type, hash) for type, hash in getdata_items if self.snapshot.seen.add(hash)]
+        if self.compact is not None:
+            getdata_items = [(self.compact.block_type() if type == 2 else type, hash) for type, hash in getdata_items]
         if getdata_items:
             getdata = GetDataMessage(getdata_items)
             self.send(getdata)
@@ -47,12 +82,14 @@ class SimpleNode:
         try:
             # Call the appropriate handler function according to the message type
             while True:
-                env = NetworkEnvelope.decode(self.stream, net=self.net)  # Reading a message from the network
+                env = self.read()  # Reading a message from the network
                 command = env.command
 
                 # respond to Version with VerAck
                 if command == VersionMessage.command:
                     self.send(VerAckMessage())  # Send verack message
+                    if self.snapshot is not None:
+                        self.snapshot.record_peer(*self.address, time.perf_counter() - self.connect_started)
 
                     print("Connection established!")
 
@@ -66,18 +103,61 @@ class SimpleNode:
                     self.handle_inv(inv)
 
                 elif env.command == b'tx':
-                    tx = TxMessage.parse(env.stream())
-                    TxMessage.print_TXreadable(tx)  # Parsing Tx Messages
+                    if METRICS.enabled:
+                        tx = METRICS.time_call(METRICS.tx_parse, 'message', TxMessage.parse, env.stream())
+                    else:
+                        tx = TxMessage.parse(env.stream())
+                    if self.mempool is not None:
+                        self.mempool.add(tx)
+                    if self.explorer is not None:
+                        self.explorer.add_tx(tx)
+                    self.renderer.submit(tx)
 
                 elif env.command == b'block':
                     block = BlockMessage.parse(env.stream())
-                    BlockMessage.print_blockReadable(block)  # Parsing Block Messages
+                    if not block.check_merkle_root():
+                        print("Received block with an invalid merkle root")
+                        continue
+                    if self.block_store is not None:
+                        self.block_store.put(env.payload)  # only once the merkle root matched
+                    self.accept_block(block)
+
+                elif env.command == SendCmpctMessage.command:
+                    reply = None if self.compact is None else self.compact.on_sendcmpct(env.payload)
+                    if reply is not None:
+                        self.send(reply)
+
+                elif env.command == CmpctBlockMessage.command and self.compact is None:
+                    # unasked for: fetch the full block instead
+                    self.send(GetDataMessage([(MSG_BLOCK, CmpctBlockMessage.parse_from(env.payload)[0].block_hash)]))
+
+                elif env.command in (CmpctBlockMessage.command, BlockTxnMessage.command) and self.compact is not None:
+                    if env.command == CmpctBlockMessage.command:
+                        block, reply = self.compact.on_cmpctblock(env.payload)
+                    else:
+                        block, reply = self.compact.on_blocktxn(env.payload)
+                    if reply is not None:
+                        self.send(reply)  # the missing transactions, or the full block if reconstruction failed
+                    if block is not None:
+                        if self.block_store is not None:
+                            self.block_store.put(block.encode())
+                        self.accept_block(block)
 
         except Exception as e:
             print(f"Stopped listening due to error: {e}")
         finally:
             self.socket.close()
+            self.renderer.close()
             print("Connection closed.")
 
+    def accept_block(self, block):
+        if self.mempool is not None:
+            self.mempool.remove_for_block(block)
+        if self.explorer is not None:
+            self.explorer.add_block(block)
+        if self.snapshot is not None:
+            self.snapshot.set_tip(block.hash())
+        self.renderer.submit(block)
+
     def close(self):
         self.socket.close()
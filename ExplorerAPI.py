@@ -0,0 +1,357 @@
+"""
+Local HTTP/JSON query API over what the client has already received.
+
+Explorer holds the data: the blocks and transactions a node hands it (pass
+explorer= to SimpleNode or AsyncNode), plus an optional BlockStore and
+HeaderChain for everything stored earlier. ExplorerAPI serves it from a
+ThreadingHTTPServer:
+
+ - GET /tip
+ - GET /block/<hash or height>  header fields and txids
+ - GET /tx/<txid>               a transaction, with its block if confirmed
+ - GET /headers/<start>?count=N up to 2000 headers from height start
+ - GET /txs/latest?n=N          the N transactions received last, newest first
+
+Hashes are hex in the usual display (reversed) byte order. Responses are
+cached as serialized JSON bytes in a size-bounded LRU with their ETag, and a
+request whose If-None-Match matches gets a bodyless 304. Answers that can
+change are cached along with a stamp of what they depend on, and replaced once
+it changes: the tip for /tip and /headers, the count of transactions received
+for /txs/latest, the blocks added for anything by height, and both for
+unconfirmed transactions. Block by hash and confirmed transactions are cached
+for good.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from MessageHandler import BLOCK_HEADER
+from Renderer import block_dict, tx_dict
+from Utils import hash256
+
+MAX_HEADERS = 2000
+MAX_LATEST = 1000
+
+
+def hex_hash(h):
+    """ Display hex of an internal byte order hash """
+    return bytes(h)[::-1].hex()
+
+
+def parse_hash(s):
+    """ Internal byte order hash from display hex; raises ValueError """
+    if len(s) != 64:
+        raise ValueError("expected a 64 character hex hash")
+    return bytes.fromhex(s)[::-1]
+
+
+def non_negative(s, name):
+    """ int of a path or query value; raises ValueError if it isn't a non-negative integer """
+    value = int(s)
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return value
+
+
+class Explorer:
+    def __init__(self, block_store=None, chain=None, net: str = 'main', recent_txs: int = MAX_LATEST,
+                 recent_blocks: int = 64):
+        self.block_store = block_store  # optional BlockStore.BlockStore with the blocks received before
+        self.chain = chain  # optional HeaderChain.HeaderChain for heights and headers
+        self.net = net
+        self.recent_txs = recent_txs
+        self.recent_blocks = recent_blocks
+        self.txs = OrderedDict()  # txid -> TxMessage, the latest recent_txs received
+        self.blocks = OrderedDict()  # block hash -> BlockMessage, the latest recent_blocks added
+        self.heights = {}  # height -> block hash of blocks added with a known height
+        self.confirmed = {}  # txid -> (block hash, index in the block) of every block added or indexed
+        self.tip = None  # (height, block hash) of the highest block added
+        self.tx_count = 0  # transactions added
+        self.block_count = 0  # blocks added or indexed
+        self.lock = threading.Lock()
+
+    def add_tx(self, tx):
+        with self.lock:
+            self.txs[tx.txid] = tx
+            self.txs.move_to_end(tx.txid)
+            if len(self.txs) > self.recent_txs:
+                self.txs.popitem(last=False)
+            self.tx_count += 1
+
+    def add_block(self, block, height: int = None):
+        """
+        Make a block and its transactions queryable. height defaults to what the
+        store or chain knows, else one more than its parent's, else the height
+        its coinbase commits to (BIP34).
+        """
+        block_hash = block.hash()
+        if height is None:
+            height = self.height_of(block_hash)
+        if height is None:
+            parent = self.height_of(block.prev_block)
+            height = block.coinbase_height() if parent is None else parent + 1
+        txids = [tx.txid for tx in block.transactions]
+        with self.lock:
+            self.blocks[block_hash] = block
+            if len(self.blocks) > self.recent_blocks:
+                evicted_hash, evicted = self.blocks.popitem(last=False)
+                if self.block_store is None or evicted_hash not in self.block_store:
+                    for tx in evicted.transactions:  # nothing left to answer from
+                        self.confirmed.pop(tx.txid, None)
+            for i, txid in enumerate(txids):
+                self.confirmed[txid] = (block_hash, i)
+            if height is not None:
+                self.heights[height] = block_hash
+                if self.tip is None or height >= self.tip[0]:
+                    self.tip = (height, block_hash)
+            self.block_count += 1
+
+    def index_store(self):
+        """ Index the transactions of every stored block, for tx lookups; return how many blocks were read """
+        count = 0
+        for height in sorted(self.block_store.heights):
+            block = self.block_store.get_by_height(height)
+            confirmed = {tx.txid: (self.block_store.heights[height], i) for i, tx in enumerate(block.transactions)}
+            with self.lock:
+                self.confirmed.update(confirmed)
+                if self.tip is None or height >= self.tip[0]:
+                    self.tip = (height, self.block_store.heights[height])
+                self.block_count += 1
+            count += 1
+        return count
+
+    def height_of(self, block_hash):
+        if self.block_store is not None:
+            location = self.block_store.index.get(block_hash)
+            if location is not None and location.height >= 0:
+                return location.height
+        if self.chain is not None:
+            return self.chain.heights.get(block_hash)
+        for height, known in list(self.heights.items()):
+            if known == block_hash:
+                return height
+        return None
+
+    def hash_at(self, height):
+        block_hash = self.heights.get(height)
+        if block_hash is None and self.block_store is not None:
+            block_hash = self.block_store.heights.get(height)
+        if block_hash is None and self.chain is not None and 0 <= height < len(self.chain):
+            block_hash = self.chain.hash_at(height)
+        return block_hash
+
+    def get_block(self, block_hash):
+        block = self.blocks.get(block_hash)
+        if block is None and self.block_store is not None:
+            block = self.block_store.get_block(block_hash)
+        return block
+
+    def block(self, block_hash):
+        block = self.get_block(block_hash)
+        if block is None:
+            return None
+        result = block_dict(block)
+        result['height'] = self.height_of(block_hash)
+        result['txids'] = [hex_hash(tx.txid) for tx in block.transactions]
+        return result
+
+    def tx(self, txid):
+        """ The transaction as a dict, and whether it is confirmed; None if unknown """
+        location = self.confirmed.get(txid)
+        if location is not None:
+            block = self.get_block(location[0])
+            if block is not None:
+                result = tx_dict(block.transactions[location[1]], self.net)
+                result['block'] = hex_hash(location[0])
+                result['height'] = self.height_of(location[0])
+                return result, True
+        tx = self.txs.get(txid)
+        if tx is None:
+            return None, False
+        result = tx_dict(tx, self.net)
+        result['block'] = None
+        return result, False
+
+    def headers(self, start, count):
+        result = []
+        for height in range(start, start + count):
+            if self.chain is not None and height < len(self.chain):
+                header = bytes(self.chain.header(height))
+            else:
+                block_hash = self.hash_at(height)
+                block = None if block_hash is None else self.get_block(block_hash)
+                if block is None:
+                    break
+                header = block.header()
+            version, prev_block, merkle_root, timestamp, bits, nonce = BLOCK_HEADER.unpack(header)
+            result.append({'height': height, 'hash': hex_hash(hash256(header)), 'prev_block': hex_hash(prev_block),
+                           'timestamp': timestamp, 'bits': bits, 'nonce': nonce, 'header': header.hex()})
+        return result
+
+    def latest_txs(self, n):
+        with self.lock:
+            txs = list(self.txs.values())[-n:] if n > 0 else []
+        return [{'txid': hex_hash(tx.txid), 'size': tx.size, 'vsize': tx.vsize, 'inputs': len(tx.inputs),
+                 'outputs': len(tx.outputs), 'value': sum(output.value for output in tx.outputs)}
+                for tx in reversed(txs)]
+
+    def tip_stamp(self):
+        """ Changes whenever the tip or the header chain does """
+        return self.tip, None if self.chain is None else (len(self.chain), self.chain.tip)
+
+    def tip_dict(self):
+        tip = self.tip
+        if tip is None and self.chain is not None:
+            tip = (self.chain.height, self.chain.tip)
+        return {'height': None, 'hash': None} if tip is None else {'height': tip[0], 'hash': hex_hash(tip[1])}
+
+
+IMMUTABLE = 'immutable'  # stamp of a cached response that can't change
+
+
+class ResponseCache:
+    """
+    LRU of serialized responses, bounded by their total size in bytes. Each is
+    kept with a stamp and only served while the caller's stamp still matches.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (body, etag, stamp)
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp=IMMUTABLE):
+        """ (body, etag) cached for key under stamp (or for good), or None; an outdated entry is dropped """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] not in (stamp, IMMUTABLE):
+                self.size -= len(self.entries.pop(key)[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def put(self, key, body, etag, stamp=IMMUTABLE):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, etag, stamp)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][0])
+
+
+class ExplorerAPI:
+    def __init__(self, explorer: Explorer, host: str = '127.0.0.1', port: int = 8080,
+                 cache_bytes: int = 16 * 1024 * 1024):
+        self.explorer = explorer
+        self.host = host
+        self.port = port
+        self.cache = ResponseCache(cache_bytes)
+        self.server = None
+
+    def route(self, path, query):
+        """ (status, JSON-ready result, whether the result can never change) for a GET """
+        explorer = self.explorer
+        parts = [part for part in path.split('/') if part]
+        if parts == ['tip']:
+            return 200, explorer.tip_dict(), False
+        # answers embedding a height are only cached for good once the height is known
+        if len(parts) == 2 and parts[0] == 'block':
+            by_height = len(parts[1]) != 64
+            block_hash = explorer.hash_at(non_negative(parts[1], 'height')) if by_height else parse_hash(parts[1])
+            result = None if block_hash is None else explorer.block(block_hash)
+            if result is None:
+                return 404, {'error': "block not found"}, False
+            return 200, result, not by_height and result['height'] is not None
+        if len(parts) == 2 and parts[0] == 'tx':
+            result, confirmed = explorer.tx(parse_hash(parts[1]))
+            if result is None:
+                return 404, {'error': "transaction not found"}, False
+            return 200, result, confirmed and result['height'] is not None
+        if len(parts) == 2 and parts[0] == 'headers':
+            count = min(non_negative(query.get('count', ['100'])[0], 'count'), MAX_HEADERS)
+            return 200, explorer.headers(non_negative(parts[1], 'start'), count), False
+        if parts == ['txs', 'latest']:
+            n = min(non_negative(query.get('n', ['25'])[0], 'n'), MAX_LATEST)
+            return 200, explorer.latest_txs(n), False
+        return 404, {'error': "unknown path"}, False
+
+    def stamp(self, path):
+        """ What the answer for path depends on, if it can change """
+        explorer = self.explorer
+        kind = path.strip('/').split('/')[0]
+        if kind in ('tip', 'headers'):
+            return explorer.tip_stamp()
+        if kind == 'txs':
+            return explorer.tx_count
+        if kind == 'block':
+            return explorer.block_count
+        return explorer.block_count, explorer.tx_count  # an unconfirmed tx: until confirmed or forgotten
+
+    def respond(self, target, if_none_match=None):
+        """ (status, body, etag) for a GET of target, a path with an optional query string """
+        url = urlsplit(target)
+        stamp = self.stamp(url.path)
+        entry = self.cache.get(target, stamp)
+        if entry is None:
+            try:
+                status, result, immutable = self.route(url.path, parse_qs(url.query))
+            except ValueError as e:
+                status, result, immutable = 400, {'error': str(e)}, False
+            except Exception as e:  # answer instead of dropping the connection
+                status, result, immutable = 500, {'error': f"internal error: {e!r}"}, False
+            body = json.dumps(result, separators=(',', ':')).encode()
+            etag = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+            if status != 200:
+                return status, body, None
+            entry = (body, etag)
+            self.cache.put(target, body, etag, IMMUTABLE if immutable else stamp)
+        body, etag = entry
+        if if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(',')):
+            return 304, b'', etag
+        return 200, body, etag
+
+    def start(self):
+        """ Serve from a daemon thread; port 0 picks a free port (see self.port afterwards) """
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_GET(self):
+                status, body, etag = api.respond(self.path, self.headers.get('If-None-Match'))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='explorer-api', daemon=True).start()
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,108 @@
+"""
+A local fake Bitcoin peer for tests and benchmarks.
+
+It listens on a loopback port, completes the version/verack handshake, then
+announces its inventory with an inv message and serves the announced payloads
+(e.g. the sample block from BlockExample.txt) on getdata, like a real node would.
+Blocks are also served as BIP152 compact blocks (getdata type 4, getblocktxn).
+"""
+import asyncio
+
+from Handshake import ENVELOPE_HEADER, NetworkEnvelope, PingMessage, VersionMessage, VerAckMessage
+from CompactBlocks import MSG_BLOCK, MSG_CMPCT_BLOCK, compact_block
+from MessageHandler import (BlockMessage, BlockTxnMessage, GetBlockTxnMessage, GetDataMessage, GetHeadersMessage,
+                            HeadersMessage, InvMessage)
+from Utils import hash256
+
+
+class FakePeer:
+    def __init__(self, net: str = 'main', inventory=None, delay: float = 0.0):
+        self.net = net
+        self.inventory = dict(inventory or {})  # (inv type, hash) -> payload served on getdata, None for notfound
+        self.delay = delay  # seconds to wait before answering getdata, to simulate a slow peer
+        self.extra = []  # (command, payload) sent right after the handshake
+        self.headers = []  # raw headers of the peer's chain, from genesis, served on getheaders
+        self.header_heights = {}
+        self.received = []  # commands received from clients
+        self.requested = []  # (inv type, hash) items asked for with getdata
+        self.compact_version = 2  # short IDs of the cmpctblocks we serve: 1 from txids, 2 from wtxids
+        self.server = None
+        self.port = None
+        self.writers = set()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        for writer in list(self.writers):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def headers_after(self, getheaders):
+        """ HeadersMessage with the headers following the first locator hash on our chain """
+        if len(self.header_heights) != len(self.headers):
+            self.header_heights = {hash256(header): height for height, header in enumerate(self.headers)}
+        start = 0
+        for block_hash in getheaders.locator:
+            if block_hash in self.header_heights:
+                start = self.header_heights[block_hash] + 1
+                break
+        return HeadersMessage(self.headers[start:start + HeadersMessage.MAX_HEADERS])
+
+    def send(self, writer, command, payload):
+        writer.write(NetworkEnvelope(command, bytes(payload), net=self.net).encode())
+
+    async def handle_client(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(ENVELOPE_HEADER.size)
+                command, payload_length, _ = NetworkEnvelope.decode_header(header, self.net)
+                payload = await reader.readexactly(payload_length)
+                self.received.append(command)
+                if command == VersionMessage.command:
+                    self.send(writer, VersionMessage.command, VersionMessage(
+                        timestamp=0, nonce=b'\x01' * 8, user_agent=b'/fakepeer:0.1/').encode())
+                    self.send(writer, VerAckMessage.command, b'')
+                elif command == VerAckMessage.command:
+                    for extra_command, extra_payload in self.extra:
+                        self.send(writer, extra_command, extra_payload)
+                    if self.inventory:
+                        self.send(writer, InvMessage.command, InvMessage(list(self.inventory)).encode())
+                elif command == PingMessage.command:
+                    self.send(writer, b'pong', payload)
+                elif command == GetHeadersMessage.command:
+                    self.send(writer, HeadersMessage.command, self.headers_after(
+                        GetHeadersMessage.parse(NetworkEnvelope(command, payload, self.net).stream())).encode())
+                elif command == GetDataMessage.command:
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    missing = []
+                    for item in InvMessage.parse(NetworkEnvelope(command, payload, self.net).stream()).items:
+                        self.requested.append(item)
+                        if item[0] == MSG_CMPCT_BLOCK and self.inventory.get((MSG_BLOCK, item[1])) is not None:
+                            block = BlockMessage.parse_from(self.inventory[(MSG_BLOCK, item[1])])[0]
+                            cmpct = compact_block(block, nonce=len(self.requested), use_wtxid=self.compact_version == 2)
+                            self.send(writer, cmpct.command, cmpct.encode())
+                        elif self.inventory.get(item) is not None:
+                            self.send(writer, {1: b'tx', 2: b'block'}[item[0]], self.inventory[item])
+                        else:
+                            missing.append(item)
+                    if missing:
+                        self.send(writer, b'notfound', InvMessage(missing).encode())
+                elif command == GetBlockTxnMessage.command:
+                    request = GetBlockTxnMessage.parse_from(payload)[0]
+                    if (MSG_BLOCK, request.block_hash) in self.inventory:
+                        block = BlockMessage.parse_from(self.inventory[(MSG_BLOCK, request.block_hash)])[0]
+                        reply = BlockTxnMessage(request.block_hash, [block.transactions[i] for i in request.indexes])
+                        self.send(writer, reply.command, reply.encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
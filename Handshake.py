@@ -3,10 +3,14 @@ Classes/utils for connecting to Bitcoin nodes
 Protocol Documentation: https://en.bitcoin.it/wiki/Protocol_documentation
 """
 import hashlib
+import struct
+import time
 from dataclasses import dataclass, field
 
 from io import BytesIO
 
+from Hashing import checksum as payload_checksum
+from Metrics import METRICS
 from Utils import encode_varint
 
 MAGICS = {
@@ -14,6 +18,33 @@ MAGICS = {
     'test': b'\x0b\x11\x09\x07',
 }
 
+# magic, command, payload length, checksum
+ENVELOPE_HEADER = struct.Struct('<4s12sI4s')
+
+# largest payload accepted per command; anything not listed is capped at MAX_PAYLOAD
+MAX_PAYLOAD = 32 * 1024 * 1024  # reference client nodes reject messages >= 32MB
+MAX_BLOCK_SIZE = 4_000_000  # a block can't serialize larger than its 4M weight limit
+MAX_PAYLOAD_SIZES = {
+    b'version': 1024,
+    b'verack': 0,
+    b'ping': 8,
+    b'pong': 8,
+    b'sendcmpct': 9,
+    b'feefilter': 8,
+    b'inv': 9 + 50_000 * 36,  # at most 50,000 entries
+    b'getdata': 9 + 50_000 * 36,
+    b'notfound': 9 + 50_000 * 36,
+    b'addr': 9 + 1000 * 30,
+    b'headers': 9 + 2000 * 81,  # at most 2000 headers, each followed by a 0 tx count
+    b'tx': MAX_BLOCK_SIZE,
+    b'block': MAX_BLOCK_SIZE,
+}
+DEBUG_HEX = 2  # verbose level from which received payloads are hex dumped
+
+
+def max_payload_size(command):
+    return MAX_PAYLOAD_SIZES.get(command, MAX_PAYLOAD)
+
 
 @dataclass
 class NetworkEnvelope:
@@ -26,7 +57,7 @@ class NetworkEnvelope:
             (self.command.decode('ascii'), self.payload.hex())
 
     @classmethod
-    def decode(cls, s, net):
+    def decode(cls, s, net, verbose=0):
         """ Construct a NetworkEnvelope from BytesIO stream s on a given net """
         magic = s.read(4)  # validate magic bytes
         assert magic != b'', "No magic bytes; Connection was reset?"
@@ -35,13 +66,35 @@ class NetworkEnvelope:
         command = command.strip(b'\x00')
         # decode and validate the payload
         payload_length = int.from_bytes(s.read(4), 'little')
+        if payload_length > max_payload_size(command):
+            raise ValueError("%s payload of %d bytes is too large" % (command, payload_length))
         checksum = s.read(4)
         payload = s.read(payload_length)
-        assert checksum == hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
-
-        print(f"Received {command.decode()} message: {payload.hex()}")
+        if METRICS.enabled:
+            start = time.perf_counter()
+            assert checksum == payload_checksum(payload)
+            METRICS.checksum.observe(time.perf_counter() - start)
+            METRICS.messages_received.inc(command.decode())
+            METRICS.bytes_received.inc(amount=ENVELOPE_HEADER.size + payload_length)
+        else:
+            assert checksum == payload_checksum(payload)
+
+        if verbose >= DEBUG_HEX:
+            print(f"Received {command.decode()} message: {payload.hex()}")
+        elif verbose:
+            print(f"Received {command.decode()} message ({payload_length} bytes)")
         return cls(command, payload, net)
 
+    @classmethod
+    def decode_header(cls, header, net):
+        """ Validate a 24-byte message header, return (command, payload_length, checksum) """
+        if len(header) != ENVELOPE_HEADER.size:
+            raise ValueError("No header; Connection was reset?")
+        magic, command, payload_length, checksum = ENVELOPE_HEADER.unpack(header)
+        if magic != MAGICS[net]:
+            raise ValueError("magic %s is not the %s network's" % (bytes(magic).hex(), net))
+        return command.strip(b'\x00'), payload_length, checksum
+
     def encode(self):
         """ Encode this network message as bytes """
         out = []
@@ -54,9 +107,12 @@ class NetworkEnvelope:
         # encode the payload
         assert len(self.payload) <= 2 ** 32  # in practice reference client nodes will reject >= 32MB...
         out += [len(self.payload).to_bytes(4, 'little')]  # payload length
-        out += [hashlib.sha256(hashlib.sha256(self.payload).digest()).digest()[:4]]  # checksum
+        out += [payload_checksum(self.payload)]  # checksum
         out += [self.payload]
 
+        if METRICS.enabled:
+            METRICS.messages_sent.inc(self.command.decode())
+            METRICS.bytes_sent.inc(amount=ENVELOPE_HEADER.size + len(self.payload))
         return b''.join(out)
 
     def stream(self):
@@ -64,6 +120,99 @@ class NetworkEnvelope:
         return BytesIO(self.payload)
 
 
+class EnvelopeFramer:
+    """
+    Incremental NetworkEnvelope decoder for a byte stream that arrives in arbitrary chunks.
+
+    Receive into the preallocated recv_view (e.g. sock.recv_into(framer.recv_view))
+    and pass the count to feed_received(), or feed() any bytes-like chunk. Each
+    payload is copied exactly once, into a buffer allocated at its final size as
+    soon as the header announces it, while its checksum is computed incrementally.
+    Oversized payloads are rejected from the header alone, before buffering them.
+    Completed envelopes carry a read-only memoryview of their payload.
+    """
+
+    def __init__(self, net, verbose=0, recv_buffer_size=64 * 1024, max_sizes=None):
+        self.net = net
+        self.verbose = verbose
+        self.max_sizes = MAX_PAYLOAD_SIZES if max_sizes is None else max_sizes
+        self.recv_buffer = bytearray(recv_buffer_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.header = bytearray(ENVELOPE_HEADER.size)
+        self.header_filled = 0
+        self.reset()
+
+    def reset(self):
+        """ Wait for the next header """
+        self.command = None
+        self.payload = None
+        self.payload_filled = 0
+        self.checksum = None
+        self.hasher = None
+        self.checksum_time = 0.0  # spent hashing this payload so far, when metrics are enabled
+
+    def feed_received(self, nbytes):
+        """ Decode nbytes just received into recv_view, return the completed envelopes """
+        return self.feed(self.recv_view[:nbytes])
+
+    def feed(self, data):
+        """ Decode the next chunk of the stream, return the envelopes it completed """
+        data = memoryview(data)
+        pos, end = 0, len(data)
+        envelopes = []
+        while pos < end:
+            if self.payload is None:
+                take = min(ENVELOPE_HEADER.size - self.header_filled, end - pos)
+                self.header[self.header_filled:self.header_filled + take] = data[pos:pos + take]
+                self.header_filled += take
+                pos += take
+                if self.header_filled < ENVELOPE_HEADER.size:
+                    break
+                self.header_filled = 0
+                self.start_payload(*NetworkEnvelope.decode_header(self.header, self.net))
+            else:
+                take = min(len(self.payload) - self.payload_filled, end - pos)
+                chunk = data[pos:pos + take]
+                self.payload[self.payload_filled:self.payload_filled + take] = chunk
+                if METRICS.enabled:
+                    start = time.perf_counter()
+                    self.hasher.update(chunk)
+                    self.checksum_time += time.perf_counter() - start
+                else:
+                    self.hasher.update(chunk)
+                self.payload_filled += take
+                pos += take
+            if self.payload_filled == len(self.payload):
+                envelopes.append(self.finish_payload())
+        return envelopes
+
+    def start_payload(self, command, payload_length, checksum):
+        if payload_length > self.max_sizes.get(command, MAX_PAYLOAD):
+            raise ValueError("%s payload of %d bytes is too large" % (command, payload_length))
+        self.command = command
+        self.payload = bytearray(payload_length)
+        self.checksum = checksum
+        self.hasher = hashlib.sha256()
+
+    def finish_payload(self):
+        if METRICS.enabled:
+            start = time.perf_counter()
+        if hashlib.sha256(self.hasher.digest()).digest()[:4] != self.checksum:
+            raise ValueError("bad checksum for %s message" % (self.command,))
+        if METRICS.enabled:
+            METRICS.checksum.observe(self.checksum_time + time.perf_counter() - start)
+            METRICS.messages_received.inc(self.command.decode())
+            METRICS.bytes_received.inc(amount=ENVELOPE_HEADER.size + len(self.payload))
+        payload = memoryview(self.payload).toreadonly()
+        if self.verbose >= DEBUG_HEX:
+            print(f"Received {self.command.decode()} message: {payload.hex()}")
+        elif self.verbose:
+            print(f"Received {self.command.decode()} message ({len(payload)} bytes)")
+        env = NetworkEnvelope(self.command, payload, self.net)
+        self.reset()
+        return env
+
+
 # -----------------------------------------------------------------------------
 # Specific types of commands and their payload encoder/decords follow
 # -----------------------------------------------------------------------------
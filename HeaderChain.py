@@ -0,0 +1,334 @@
+"""
+Headers-first chain sync.
+
+HeaderChain holds the best header chain as one packed bytearray of 80-byte
+headers indexed by height, a packed hash -> height index (HeightIndex) and the
+cumulative work of the tip: about 116 bytes per header, ~105 MB for the full
+mainnet chain (~900k headers).
+HeaderSync drives getheaders/headers with a peer, asking for the next batch
+before validating the current one, and saves checkpoints to resume from.
+"""
+import asyncio
+import os
+import struct
+from array import array
+
+from MessageHandler import BLOCK_HEADER, GetHeadersMessage, HeadersMessage
+from Utils import bits_to_target, hash256, target_to_work
+
+GENESIS_HEADERS = {
+    'main': bytes.fromhex('01000000' + '00' * 32 +
+                          '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c'),
+    'test': bytes.fromhex('01000000' + '00' * 32 +
+                          '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18'),
+}
+CHECKPOINT_HEADER = struct.Struct('<4sI32s')  # magic, header count, chainwork (big endian)
+CHECKPOINT_MAGIC = b'HDRS'
+EMPTY, DELETED = -1, -2  # HeightIndex slots without a height
+
+
+class HeightIndex:
+    """
+    hash -> height of a chain's headers, as an open addressing table over two
+    arrays: the first 8 bytes of each hash and its height, about 24 bytes per
+    header where a dict of 32-byte keys takes ~150. A key match is confirmed
+    against the full hash of the header at that height (hash_at), so hashes
+    must be added once their header is in the chain or right before.
+    """
+
+    def __init__(self, hash_at, capacity: int = 1024):
+        self.hash_at = hash_at
+        self.keys = array('Q', bytes(8 * capacity))
+        self.values = array('i', [EMPTY]) * capacity  # height, EMPTY or DELETED
+        self.mask = capacity - 1
+        self.count = 0
+        self.used = 0  # slots that are not EMPTY
+
+    def __len__(self):
+        return self.count
+
+    def find(self, block_hash):
+        """ Slot of block_hash, or -1 """
+        key = int.from_bytes(block_hash[:8], 'little')
+        keys, values, mask = self.keys, self.values, self.mask
+        i = key & mask
+        while True:
+            height = values[i]
+            if height == EMPTY:
+                return -1
+            if height >= 0 and keys[i] == key and self.hash_at(height) == block_hash:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, block_hash, default=None):
+        i = self.find(bytes(block_hash))
+        return default if i < 0 else self.values[i]
+
+    def __contains__(self, block_hash):
+        return self.find(bytes(block_hash)) >= 0
+
+    def __setitem__(self, block_hash, height):
+        """ Add a hash that is not in the index yet """
+        if 2 * (self.used + 1) > len(self.values):
+            self.reserve(1)
+        self.insert(int.from_bytes(block_hash[:8], 'little'), height)
+        self.count += 1
+
+    def extend(self, hashes, height):
+        """ Add hashes (not in the index yet) of consecutive heights from height """
+        hashes = list(hashes)
+        self.reserve(len(hashes))
+        keys, values, mask = self.keys, self.values, self.mask
+        used = 0
+        for block_hash in hashes:
+            key = int.from_bytes(block_hash[:8], 'little')
+            i = key & mask
+            while values[i] >= 0:
+                i = (i + 1) & mask
+            if values[i] == EMPTY:
+                used += 1
+            keys[i] = key
+            values[i] = height
+            height += 1
+        self.used += used
+        self.count += len(hashes)
+
+    def insert(self, key, height):
+        values, mask = self.values, self.mask
+        i = key & mask
+        while values[i] >= 0:
+            i = (i + 1) & mask
+        if values[i] == EMPTY:
+            self.used += 1
+        self.keys[i] = key
+        values[i] = height
+
+    def __delitem__(self, block_hash):
+        i = self.find(bytes(block_hash))
+        if i < 0:
+            raise KeyError(block_hash)
+        self.values[i] = DELETED
+        self.count -= 1
+
+    def reserve(self, n):
+        """ Make room for n more hashes at once, instead of growing step by step """
+        if 2 * (self.used + n) > len(self.values):
+            capacity = len(self.values)
+            while 2 * (self.count + n) > capacity:
+                capacity *= 2
+            self.resize(capacity)
+
+    def resize(self, capacity):
+        """ Rebuild with capacity slots, dropping deleted ones """
+        entries = [(key, height) for key, height in zip(self.keys, self.values) if height >= 0]
+        self.keys = array('Q', bytes(8 * capacity))
+        self.values = array('i', [EMPTY]) * capacity
+        self.mask = capacity - 1
+        self.used = 0
+        for key, height in entries:
+            self.insert(key, height)
+
+
+class HeaderChain:
+    def __init__(self, genesis: bytes = None, net: str = 'main', check_pow: bool = True):
+        genesis = bytes(genesis or GENESIS_HEADERS[net])
+        self.check_pow = check_pow
+        self.headers = bytearray(genesis)  # header of height h at [80 * h, 80 * h + 80)
+        self.tip = hash256(genesis)
+        self.heights = HeightIndex(self.hash_at)
+        self.heights[self.tip] = 0
+        self.work = self.header_work(genesis)
+        self.targets = {}  # bits -> target, bits only change every 2016 blocks
+
+    def __len__(self):
+        return len(self.headers) // 80
+
+    @property
+    def height(self):
+        return len(self) - 1
+
+    def header(self, height):
+        return memoryview(self.headers)[80 * height:80 * height + 80]
+
+    def hash_at(self, height):
+        return hash256(self.header(height))
+
+    def target(self, bits):
+        target = self.targets.get(bits)
+        if target is None:
+            target = self.targets[bits] = bits_to_target(bits)
+        return target
+
+    def header_work(self, header):
+        return target_to_work(bits_to_target(BLOCK_HEADER.unpack_from(header)[4]))
+
+    def locator(self):
+        """ Hashes at the tip, the 10 blocks below it, then exponentially further back, down to genesis """
+        heights, height, step = [], self.height, 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= 10:
+                step *= 2
+            height -= step
+        heights.append(0)
+        return [self.hash_at(h) for h in heights]
+
+    def add_headers(self, headers):
+        """
+        Validate headers (links and proof of work) and add them to the chain,
+        return how many became part of it. Headers forking off below the tip
+        replace the current branch only if they carry more work.
+        Raises ValueError for headers that don't connect or fail proof of work.
+        """
+        headers = list(headers)
+        while headers and hash256(headers[0]) in self.heights:
+            headers.pop(0)  # already known, e.g. overlapping batches
+        if not headers:
+            return 0
+        fork_height = self.heights.get(bytes(headers[0][4:36]))
+        if fork_height is None:
+            raise ValueError("headers do not connect to the chain")
+        hashes, work = self.validate(headers)
+        if fork_height != self.height:
+            replaced = sum(self.header_work(self.header(h)) for h in range(fork_height + 1, len(self)))
+            if work <= replaced:
+                return 0
+            self.truncate(fork_height)
+            self.work -= replaced
+        self.heights.extend(hashes, len(self))
+        for header in headers:
+            self.headers += header
+        self.tip = hashes[-1]
+        self.work += work
+        return len(headers)
+
+    def validate(self, headers):
+        """ Check that headers link up and meet their targets, return (their hashes, their total work) """
+        hashes, work = [], 0
+        prev = bytes(headers[0][4:36])
+        for header in headers:
+            if len(header) != 80 or header[4:36] != prev:
+                raise ValueError("header does not link to the previous one")
+            block_hash = hash256(header)
+            target = self.target(BLOCK_HEADER.unpack_from(header)[4])
+            if self.check_pow and int.from_bytes(block_hash, 'little') > target:
+                raise ValueError("header hash %s above its target" % (block_hash[::-1].hex(),))
+            work += target_to_work(target)
+            hashes.append(block_hash)
+            prev = block_hash
+        return hashes, work
+
+    def truncate(self, height):
+        """ Drop all headers above height """
+        for h in range(height + 1, len(self)):
+            del self.heights[self.hash_at(h)]
+        del self.headers[80 * (height + 1):]
+        self.tip = self.hash_at(height)
+
+    def save(self, path):
+        """ Write a checkpoint file: packed headers plus the tip's chainwork """
+        with open(path + '.tmp', 'wb') as f:
+            f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, len(self), self.work.to_bytes(32, 'big')))
+            f.write(self.headers)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, check_pow: bool = True):
+        """
+        Resume from a checkpoint file. The headers were validated before they were
+        saved, so only the hash index is rebuilt (and links re-checked), not the
+        proof of work.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, count, work = CHECKPOINT_HEADER.unpack_from(data)
+        if magic != CHECKPOINT_MAGIC or len(data) != CHECKPOINT_HEADER.size + 80 * count:
+            raise ValueError("not a header checkpoint file: %s" % (path,))
+        headers = memoryview(data)[CHECKPOINT_HEADER.size:]
+        chain = cls(headers[:80], check_pow=check_pow)
+        hashes = []
+        prev = chain.tip
+        for height in range(1, count):
+            header = headers[80 * height:80 * height + 80]
+            if header[4:36] != prev:
+                raise ValueError("checkpoint header %d does not link to the previous one" % (height,))
+            prev = hash256(header)
+            hashes.append(prev)
+        chain.heights.extend(hashes, 1)
+        chain.headers = bytearray(headers)
+        chain.tip = prev
+        chain.work = int.from_bytes(work, 'big')
+        return chain
+
+
+class HeaderSync:
+    """
+    Download headers from an AsyncNode into a HeaderChain. Each full batch of
+    2000 headers triggers the next getheaders before it is validated, so the
+    peer is already preparing the next response while this one is checked.
+    The sync fails if the peer disconnects or sends no headers for timeout seconds.
+    """
+
+    def __init__(self, node, chain: HeaderChain, checkpoint_path: str = None, checkpoint_every: int = 50_000,
+                 timeout: float = 30.0):
+        self.node = node
+        self.chain = chain
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpointed = len(chain)
+        self.timeout = timeout
+        self.done = asyncio.Event()
+        self.error = None
+        self.replies = 0  # headers messages received
+        node.handlers[HeadersMessage.command] = self.handle_headers
+
+    async def run(self):
+        """
+        Sync until the peer has no more headers, return the chain. Raises
+        ConnectionError if the peer goes away, asyncio.TimeoutError if it stalls.
+        """
+        await self.wait_for(self.node.handshake_done)
+        await self.node.send(GetHeadersMessage(self.chain.locator()))
+        await self.wait_for(self.done)
+        if self.error is not None:
+            raise self.error
+        return self.chain
+
+    async def wait_for(self, event):
+        """ Wait for event as long as the node stays connected and headers keep coming within timeout """
+        waiters = [asyncio.create_task(event.wait()), asyncio.create_task(self.node.closed.wait())]
+        try:
+            while not event.is_set():
+                replies = self.replies
+                await asyncio.wait(waiters, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+                if event.is_set():
+                    break
+                if self.node.closed.is_set():
+                    raise ConnectionError("peer disconnected during header sync")
+                if self.replies == replies:
+                    raise asyncio.TimeoutError("no headers for %s seconds" % (self.timeout,))
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def handle_headers(self, env):
+        self.replies += 1
+        headers = HeadersMessage.parse_from(env.payload)[0].headers
+        if len(headers) == HeadersMessage.MAX_HEADERS:
+            await self.node.send(GetHeadersMessage([hash256(headers[-1])] + self.chain.locator()))
+        try:
+            self.chain.add_headers(headers)
+        except ValueError as e:
+            self.error = e
+            self.done.set()
+            return
+        if self.checkpoint_path and len(self.chain) - self.checkpointed >= self.checkpoint_every:
+            self.save_checkpoint()
+        if len(headers) < HeadersMessage.MAX_HEADERS:
+            if self.checkpoint_path:
+                self.save_checkpoint()
+            self.done.set()
+
+    def save_checkpoint(self):
+        self.chain.save(self.checkpoint_path)
+        self.checkpointed = len(self.chain)
@@ -0,0 +1,109 @@
+"""
+Load test for ExplorerAPI: concurrent keep-alive clients, latency percentiles.
+
+Without --url it serves a temporary BlockStore of synthetic blocks in-process
+and queries that; with --url it queries a running API, using --paths (by
+default the tip, the latest transactions and the first headers).
+
+Run: python LoadTest.py [--clients 16] [--requests 4000] [--conditional 0.5]
+     python LoadTest.py --url http://127.0.0.1:8080
+"""
+import argparse
+import http.client
+import json
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from BlockStore import BlockStore
+from ExplorerAPI import Explorer, ExplorerAPI, hex_hash
+from MessageHandler import BlockMessage
+from SampleData import build_chain
+
+
+def local_api(directory, blocks=100, txs_per_block=50):
+    """ An ExplorerAPI started over a BlockStore of synthetic blocks, and paths worth querying on it """
+    store = BlockStore(directory)
+    paths = ['/tip', '/txs/latest?n=25', '/headers/0?count=50']
+    explorer = Explorer(block_store=store)
+    for height, raw in enumerate(build_chain(blocks, txs_per_block)):
+        store.put(raw, height)
+        block = BlockMessage.parse_from(raw)[0]
+        paths += [f'/block/{height}', f'/block/{hex_hash(block.hash())}']
+        paths += [f'/tx/{hex_hash(tx.txid)}' for tx in block.transactions[:5]]
+        for tx in block.transactions[-2:]:
+            explorer.add_tx(tx)
+    explorer.index_store()
+    return ExplorerAPI(explorer, port=0).start(), paths
+
+
+def client(host, port, paths, count, conditional, seed, latencies, statuses):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection(host, port)
+    etags = {}
+    for _ in range(count):
+        path = rng.choice(paths)
+        headers = {'If-None-Match': etags[path]} if path in etags and rng.random() < conditional else {}
+        start = time.perf_counter()
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status] += 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+    connection.close()
+
+
+def run(host, port, paths, clients=16, requests=4000, conditional=0.5):
+    """ Spread requests over concurrent clients; return the summary as a dict """
+    latencies, statuses = [], Counter()  # list.append and Counter updates are safe enough under the GIL
+    threads = [threading.Thread(target=client, args=(host, port, paths, requests // clients, conditional, i,
+                                                     latencies, statuses))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cuts = statistics.quantiles(latencies, n=100)
+    return {'requests': len(latencies), 'clients': clients, 'seconds': elapsed,
+            'requests_per_sec': len(latencies) / elapsed, 'p50_ms': cuts[49] * 1000, 'p99_ms': cuts[98] * 1000,
+            'statuses': dict(statuses)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ExplorerAPI load test")
+    parser.add_argument('--url', help="API to test, e.g. http://127.0.0.1:8080; default: a local synthetic one")
+    parser.add_argument('--paths', nargs='*', help="paths to query with --url")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=4000)
+    parser.add_argument('--conditional', type=float, default=0.5,
+                        help="share of repeated requests sent with If-None-Match")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        url = urlsplit(args.url)
+        paths = args.paths or ['/tip', '/txs/latest?n=25', '/headers/0?count=100']
+        result = run(url.hostname, url.port or 80, paths, args.clients, args.requests, args.conditional)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            api, paths = local_api(directory)
+            try:
+                result = run('127.0.0.1', api.port, paths, args.clients, args.requests, args.conditional)
+                result['cache_hit_rate'] = api.cache.hits / max(1, api.cache.hits + api.cache.misses)
+            finally:
+                api.close()
+                api.explorer.block_store.close()
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,85 @@
 from Connect2Net import SimpleNode
+from Metrics import METRICS  # the network code checks METRICS.enabled; HTTP server and profilers load on use
+from Snapshot import Snapshot
 
+DNS_SEED = 'seed.bitcoin.sipa.be'
+SNAPSHOT_PATH = 'session.snapshot'
 
-def main():
-    # Initialize node connections
-    node = SimpleNode(host='seed.bitcoin.sipa.be', net='main')
-    node.listen_message()
 
-    node.close()
+def load_snapshot(path):
+    """ The last session's snapshot, or an empty one if it can't be read """
+    try:
+        snapshot = Snapshot.load(path)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring snapshot {path}: {e}")
+        return Snapshot()
+    if snapshot.tip is not None:
+        print("Last session's tip: {}, {} known peers, {} known inventory items".format(
+            snapshot.tip[1][::-1].hex(), len(snapshot.peers), len(snapshot.seen)))
+    return snapshot
+
+
+def connect(snapshot, net: str = 'main', tries: int = 3, timeout: float = 3.0, **kwargs):
+    """ SimpleNode to the best scored known peer that answers, else to a peer from the DNS seed """
+    for host, port in snapshot.best_peers(tries):
+        try:
+            return SimpleNode(host=host, net=net, port=port, connect_timeout=timeout, snapshot=snapshot, **kwargs)
+        except OSError as e:
+            print(f"Could not connect to {host}:{port}: {e}")
+            snapshot.peer_failed(host, port)
+    return SimpleNode(host=DNS_SEED, net=net, snapshot=snapshot, **kwargs)
+
+
+def main(peers: int = 1, render: str = 'full', metrics_port: int = None, stats_interval: float = 10.0,
+         api_port: int = None, snapshot_path: str = SNAPSHOT_PATH):
+    if metrics_port is not None:
+        # Prometheus scrape target on localhost and a stats line every stats_interval seconds
+        METRICS.enable()
+        METRICS.serve(metrics_port)
+        METRICS.start_stats(stats_interval)
+    snapshot = load_snapshot(snapshot_path)
+    try:
+        if peers > 1:
+            import asyncio  # optional parts are imported when asked for, to keep startup short
+
+            asyncio.run(main_group(peers, snapshot))
+            return
+        from Renderer import Renderer
+
+        # Initialize node connections
+        explorer = api = None
+        if api_port is not None:
+            from ExplorerAPI import Explorer, ExplorerAPI
+
+            # JSON queries about what this session received, on http://127.0.0.1:<api_port>/; without a store or
+            # header chain, block heights come from the BIP34 coinbase height or the parent's height
+            explorer = Explorer()
+            api = ExplorerAPI(explorer, port=api_port).start()
+        node = connect(snapshot, 'main', renderer=Renderer(render), explorer=explorer)
+        try:
+            node.listen_message()
+        finally:
+            node.close()
+            if api is not None:
+                api.close()
+    finally:
+        snapshot.save(snapshot_path)
+        snapshot.close()
+
+
+async def main_group(peers: int, snapshot=None):
+    """ Connect to several peers at once, known ones first, then from the DNS seed; fetch each announced item once """
+    import asyncio
+    from PeerGroup import PeerGroup, resolve_seed
+
+    known = snapshot.best_peers(2 * peers) if snapshot is not None else []
+    group = PeerGroup(known, size=peers, net='main', verbose=1, snapshot=snapshot,
+                      fallback=lambda: resolve_seed(DNS_SEED, net='main'))
+    await group.start()
+    try:
+        await asyncio.Event().wait()  # run until interrupted
+    finally:
+        await group.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""
+In-memory mirror of the peers' mempool, built from received transactions.
+
+Entries are keyed by txid and kept in a list sorted by fee rate, so the top N
+by fee rate is a slice and eviction takes from the front; inserting is a
+bisect plus a memmove of pointers, which stays well under a millisecond at
+hundreds of thousands of entries. The total serialized size is kept within a
+byte budget by evicting the lowest fee rates first.
+
+A transaction's fee needs the values of the outputs it spends. They come from
+fee_lookup (e.g. UtxoSet.fee), or from the mempool itself when every output
+spent belongs to a mempool transaction. The live nodes keep no UTXO set, so
+without a fee_lookup most fees are unknown: those transactions rank as 0 sat/vB,
+which makes ordering and eviction among them oldest first.
+
+Two transactions spending the same output can't both stay. The first seen is
+kept, unless the new one pays a known fee rate above that of every transaction
+it conflicts with and would stay within the byte budget: then those are
+replaced, with their descendants. Eviction also takes descendants along.
+"""
+import time
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from itertools import count
+
+from MessageHandler import TxMessage
+
+DEFAULT_MAX_BYTES = 300 * 1000 * 1000  # Bitcoin Core's default -maxmempool is 300 MB
+
+
+@dataclass(slots=True)
+class MempoolEntry:
+    tx: TxMessage
+    fee: int  # satoshis, None if unknown
+    vsize: int
+    size: int
+    time: float  # when it was added
+    key: tuple  # (fee rate, sequence number, txid), its position in Mempool.by_feerate
+
+    @property
+    def feerate(self):
+        """ satoshis per virtual byte, 0 if the fee is unknown """
+        return self.key[0]
+
+
+class Mempool:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, fee_lookup=None):
+        self.max_bytes = max_bytes
+        self.fee_lookup = fee_lookup  # callable(tx) -> fee in satoshis, or None if unknown
+        self.entries = {}  # txid -> MempoolEntry
+        self.by_feerate = []  # sorted entry keys, lowest fee rate first
+        self.spends = {}  # (prevout hash, prevout index) -> txid of the mempool tx spending it
+        self.total_bytes = 0
+        self.sequence = count()  # tie breaker: among equal fee rates the oldest goes first
+        self.rejected_conflicts = 0  # transactions refused for spending an output a mempool tx already spends
+        self.replaced = 0  # transactions dropped for a conflicting one paying a higher fee rate
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def get(self, txid):
+        entry = self.entries.get(txid)
+        return None if entry is None else entry.tx
+
+    def fee_of(self, tx):
+        """ Fee of tx from fee_lookup, else from the mempool txs whose outputs it spends; None if unknown """
+        fee = None if self.fee_lookup is None else self.fee_lookup(tx)
+        if fee is not None:
+            return fee
+        spent = 0
+        for tx_in in tx.inputs:
+            parent = self.entries.get(bytes(tx_in.prevout_hash))
+            if parent is None or tx_in.prevout_index >= len(parent.tx.outputs):
+                return None
+            spent += parent.tx.outputs[tx_in.prevout_index].value
+        return spent - sum(o.value for o in tx.outputs)
+
+    def conflicts(self, tx):
+        """ txids of the mempool transactions spending an output tx spends """
+        found = {self.spends.get((bytes(tx_in.prevout_hash), tx_in.prevout_index)) for tx_in in tx.inputs}
+        found.discard(None)
+        return found
+
+    def add(self, tx, fee: int = None):
+        """
+        Add a transaction, return False if it was already there, lost to a
+        conflicting one or got evicted right away
+        """
+        txid = tx.txid
+        if txid in self.entries:
+            return False
+        if fee is None:
+            fee = self.fee_of(tx)
+        vsize = tx.vsize
+        feerate = (fee or 0) / vsize
+        key = (feerate, next(self.sequence), txid)
+        conflicts = self.conflicts(tx)
+        if conflicts:
+            if fee is None or any(feerate <= self.entries[other].feerate for other in conflicts):
+                self.rejected_conflicts += 1
+                return False
+            replaced = set().union(*(self.with_descendants(other) for other in conflicts))
+            if not self.would_keep(key, tx.size, replaced):
+                self.rejected_conflicts += 1  # it would be evicted right away, keep what it conflicts with
+                return False
+            for other in replaced:
+                self.remove(other)
+            self.replaced += len(replaced)
+        self.entries[txid] = MempoolEntry(tx, fee, vsize, tx.size, time.time(), key)
+        insort(self.by_feerate, key)
+        for tx_in in tx.inputs:
+            self.spends[(bytes(tx_in.prevout_hash), tx_in.prevout_index)] = txid
+        self.total_bytes += tx.size
+        self.evict()
+        return txid in self.entries
+
+    def remove(self, txid):
+        """ Drop a transaction, return its entry (None if it wasn't there) """
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return None
+        del self.by_feerate[bisect_left(self.by_feerate, entry.key)]
+        for tx_in in entry.tx.inputs:
+            outpoint = (bytes(tx_in.prevout_hash), tx_in.prevout_index)
+            if self.spends.get(outpoint) == txid:
+                del self.spends[outpoint]
+        self.total_bytes -= entry.size
+        return entry
+
+    def with_descendants(self, txid):
+        """ txids of a mempool transaction and of the mempool txs spending its outputs, in turn """
+        found, stack = set(), [txid]
+        while stack:
+            txid = stack.pop()
+            entry = self.entries.get(txid)
+            if entry is None or txid in found:
+                continue
+            found.add(txid)
+            spent_by = (self.spends.get((txid, i)) for i in range(len(entry.tx.outputs)))
+            stack.extend(child for child in spent_by if child is not None)
+        return found
+
+    def remove_with_descendants(self, txid):
+        """ Drop a transaction and its descendants, return their entries """
+        return [self.remove(other) for other in self.with_descendants(txid)]
+
+    def would_keep(self, key, size, replaced=()):
+        """
+        Whether a new entry at key would stay within the byte budget once the
+        txids in replaced are gone. Descendants of the entries evicted before it
+        are not counted, so this may refuse an entry that would just fit.
+        """
+        excess = self.total_bytes + size - sum(self.entries[txid].size for txid in replaced) - self.max_bytes
+        for lower in self.by_feerate:  # evicted first, lowest fee rate first
+            if excess <= 0 or lower >= key:
+                break
+            if lower[2] not in replaced:
+                excess -= self.entries[lower[2]].size
+        return excess <= 0
+
+    def evict(self):
+        """
+        Drop the lowest fee rates, with their descendants, until the byte budget
+        is met; return how many were dropped
+        """
+        evicted = 0
+        while self.total_bytes > self.max_bytes and self.by_feerate:
+            evicted += len(self.remove_with_descendants(self.by_feerate[0][2]))
+        return evicted
+
+    def remove_for_block(self, block):
+        """
+        Drop the transactions confirmed by block, and the ones that conflict with
+        them by spending the same outputs, with their descendants; return how many
+        were dropped.
+        """
+        removed = 0
+        for tx in block.transactions:
+            if self.remove(tx.txid) is not None:
+                removed += 1
+            for tx_in in tx.inputs:
+                conflict = self.spends.get((bytes(tx_in.prevout_hash), tx_in.prevout_index))
+                if conflict is not None:
+                    removed += len(self.remove_with_descendants(conflict))
+        return removed
+
+    def top(self, n: int = 10):
+        """ The n entries with the highest fee rate, highest first """
+        return [self.entries[key[2]] for key in reversed(self.by_feerate[-n:])] if n > 0 else []
@@ -1,8 +1,18 @@
+import struct
 import time
+from array import array
+import weakref
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional, Tuple
 
-from Utils import decode_varint, encode_int, encode_varint
+from Hashing import hash256_batch, hash256_parts, merkle_root
+from Metrics import METRICS
+from Utils import (UINT32, UINT64, bits_to_target, decode_int, decode_varint, encode_int, encode_varint, hash256,
+                   read_varint, varint_size, write_varint)
+
+# version, prev_block, merkle_root, timestamp, bits, nonce
+BLOCK_HEADER = struct.Struct('<I32s32sIII')
 
 
 @dataclass
@@ -42,17 +52,141 @@ class InvMessage:
         return b''.join(out)
 
 
+@dataclass
+class GetHeadersMessage:
+    """
+    https://en.bitcoin.it/wiki/Protocol_documentation#getheaders
+    Ask for up to 2000 headers following the first locator hash the peer knows.
+    """
+    locator: List[bytes]  # block hashes, newest first, ending with the genesis hash
+    hash_stop: bytes = b'\x00' * 32  # zero means "as many as possible"
+    version: int = 70015
+    command: bytes = field(init=False, default=b'getheaders')
+
+    @classmethod
+    def parse(cls, s):
+        version = int.from_bytes(s.read(4), 'little')
+        locator = [s.read(32) for _ in range(decode_varint(s))]
+        hash_stop = s.read(32)
+        return cls(locator, hash_stop, version)
+
+    def encode(self):
+        out = [encode_int(self.version, 4), encode_varint(len(self.locator))]
+        out += self.locator
+        out += [self.hash_stop]
+        return b''.join(out)
+
+
+@dataclass
+class HeadersMessage:
+    """
+    https://en.bitcoin.it/wiki/Protocol_documentation#headers
+    Serialized 80-byte block headers, each followed by a transaction count of 0.
+    """
+    headers: List[bytes]
+    command: bytes = field(init=False, default=b'headers')
+
+    MAX_HEADERS = 2000
+
+    @classmethod
+    def parse(cls, s):
+        headers = []
+        for _ in range(decode_varint(s)):
+            headers.append(s.read(80))
+            decode_varint(s)  # tx count, always 0
+        return cls(headers)
+
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        """ Parse from a bytes-like b, headers are memoryview slices of it; return (HeadersMessage, offset after it) """
+        b = memoryview(b)
+        try:
+            count, offset = read_varint(b, offset)
+            headers = []
+            for _ in range(count):
+                headers.append(b[offset:offset + 80])
+                _, offset = read_varint(b, offset + 80)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated headers message: %s" % (e,)) from e
+        return cls(headers), offset
+
+    def encode(self):
+        out = [encode_varint(len(self.headers))]
+        for header in self.headers:
+            out += [header, b'\x00']
+        return b''.join(out)
+
+
+def bytes_state(obj):
+    """ __getstate__ copying memoryview fields (slices of a parsed buffer, which can't be pickled) to bytes """
+    state = dict(obj.__dict__)
+    for name, value in state.items():
+        if isinstance(value, memoryview):
+            state[name] = value.tobytes()
+        elif isinstance(value, tuple) and any(isinstance(item, memoryview) for item in value):
+            state[name] = tuple(bytes(item) for item in value)
+    return state
+
+
 def decode_script(s):
     length = decode_varint(s)
     return s.read(length)
 
 
+def read_script(b, offset):
+    """ Zero-copy counterpart of decode_script: slice the script out of buffer b """
+    length, offset = read_varint(b, offset)
+    end = offset + length
+    return b[offset:end], end
+
+
+def script_hex(script, limit=None):
+    """ Hex of a script, or of its first limit bytes followed by how many were left out """
+    if limit is None or len(script) <= limit:
+        return script.hex()
+    return "%s... (%d more bytes)" % (bytes(script[:limit]).hex(), len(script) - limit)
+
+
+MIN_TX_SIZE = 10  # version, no inputs, no outputs, locktime
+
+
+def skip_tx(b, offset):
+    """ Return the offset just past the serialized tx starting at offset in b, without decoding it """
+    num_inputs, offset = read_varint(b, offset + 4)
+    segwit = False
+    if num_inputs == 0:
+        flag = b[offset]
+        if flag == 0:
+            return offset + 5  # no inputs and no outputs, only the locktime follows
+        if flag != 1:
+            raise ValueError("unknown transaction flag: %d" % (flag,))
+        segwit = True
+        num_inputs, offset = read_varint(b, offset + 1)
+    for _ in range(num_inputs):
+        length, offset = read_varint(b, offset + 36)
+        offset += length + 4
+    num_outputs, offset = read_varint(b, offset)
+    for _ in range(num_outputs):
+        length, offset = read_varint(b, offset + 8)
+        offset += length
+    if segwit:
+        for _ in range(num_inputs):
+            count, offset = read_varint(b, offset)
+            for _ in range(count):
+                length, offset = read_varint(b, offset)
+                offset += length
+    return offset + 4
+
+
 @dataclass
 class Input:
     prevout_hash: bytes
     prevout_index: int
     script_sig: bytes
     sequence: int
+    witness: Tuple[bytes, ...] = ()  # BIP144 witness stack, filled in when the tx is parsed
+
+    __getstate__ = bytes_state
 
     @classmethod
     def decode(cls, s):
@@ -62,18 +196,80 @@ class Input:
         sequence = int.from_bytes(s.read(4), 'little')  # product key
         return cls(prevout_hash, prevout_index, script_sig, sequence)
 
+    @classmethod
+    def decode_from(cls, b, offset):
+        """ Decode from a memoryview b at offset, return (Input, offset after it) """
+        prevout_hash = b[offset:offset + 32]
+        prevout_index = UINT32.unpack_from(b, offset + 32)[0]
+        script_sig, offset = read_script(b, offset + 36)
+        sequence = UINT32.unpack_from(b, offset)[0]
+        return cls(prevout_hash, prevout_index, script_sig, sequence), offset + 4
+
+    def encode(self):
+        """ Serialized input, without its witness (which follows the outputs in a segwit tx) """
+        return b''.join([self.prevout_hash, encode_int(self.prevout_index, 4), encode_varint(len(self.script_sig)),
+                         self.script_sig, encode_int(self.sequence, 4)])
+
+    def serialized_size(self):
+        return 40 + varint_size(len(self.script_sig)) + len(self.script_sig)
+
+    def encode_into(self, b, offset):
+        """ Write encode() into buffer b at offset, return the offset after it """
+        b[offset:offset + 32] = self.prevout_hash
+        UINT32.pack_into(b, offset + 32, self.prevout_index)
+        offset = write_varint(b, offset + 36, len(self.script_sig))
+        end = offset + len(self.script_sig)
+        b[offset:end] = self.script_sig
+        UINT32.pack_into(b, end, self.sequence)
+        return end + 4
+
+    def witness_size(self):
+        return varint_size(len(self.witness)) + sum(varint_size(len(item)) + len(item) for item in self.witness)
+
+    def encode_witness_into(self, b, offset):
+        """ Write the witness stack into buffer b at offset, return the offset after it """
+        offset = write_varint(b, offset, len(self.witness))
+        for item in self.witness:
+            offset = write_varint(b, offset, len(item))
+            b[offset:offset + len(item)] = item
+            offset += len(item)
+        return offset
+
 
 @dataclass
 class Output:
     value: int  # Value in satoshis
     script_pubkey: bytes
 
+    __getstate__ = bytes_state
+
     @classmethod
     def decode(cls, s):
         value = int.from_bytes(s.read(8), 'little')  # Amount, 8 bytes
         script_pubkey = decode_script(s)  # Lock Script
         return cls(value, script_pubkey)
 
+    @classmethod
+    def decode_from(cls, b, offset):
+        """ Decode from a memoryview b at offset, return (Output, offset after it) """
+        value = UINT64.unpack_from(b, offset)[0]
+        script_pubkey, offset = read_script(b, offset + 8)
+        return cls(value, script_pubkey), offset
+
+    def encode(self):
+        return b''.join([encode_int(self.value, 8), encode_varint(len(self.script_pubkey)), self.script_pubkey])
+
+    def serialized_size(self):
+        return 8 + varint_size(len(self.script_pubkey)) + len(self.script_pubkey)
+
+    def encode_into(self, b, offset):
+        """ Write encode() into buffer b at offset, return the offset after it """
+        UINT64.pack_into(b, offset, self.value)
+        offset = write_varint(b, offset + 8, len(self.script_pubkey))
+        end = offset + len(self.script_pubkey)
+        b[offset:end] = self.script_pubkey
+        return end
+
     def btc_value(self):
         """ Convert satoshi to BTC """
         return self.value / 100_000_000
@@ -85,37 +281,250 @@ class TxMessage:
     inputs: List[Input]
     outputs: List[Output]
     locktime: int
+    command: bytes = field(init=False, default=b'tx', repr=False, compare=False)
+    # serialized bytes the tx was parsed from (or last encoded to), and where its witness data starts in them
+    # (None if not segwit)
+    _raw: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+    _witness_offset: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    _txid: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+    _wtxid: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+
+    __getstate__ = bytes_state
 
     @classmethod
     def parse(cls, s):
+        """ Parse from a seekable stream s, including BIP144 marker/flag and witness data """
+        start = s.tell()
         version = int.from_bytes(s.read(4), 'little')
         num_inputs = decode_varint(s)
+        segwit = empty = False
+        if num_inputs == 0:
+            flag = decode_int(s, 1)
+            if flag == 1:
+                segwit = True
+                num_inputs = decode_varint(s)
+            elif flag == 0:
+                empty = True  # not a marker: the byte was the output count of a tx without inputs and outputs
+            else:
+                raise ValueError("unknown transaction flag: %d" % (flag,))
         inputs = [Input.decode(s) for _ in range(num_inputs)]
-        num_outputs = decode_varint(s)
+        num_outputs = 0 if empty else decode_varint(s)
         outputs = [Output.decode(s) for _ in range(num_outputs)]
+        witness_offset = None
+        if segwit:
+            witness_offset = s.tell() - start
+            for tx_in in inputs:
+                tx_in.witness = tuple(decode_script(s) for _ in range(decode_varint(s)))
         locktime = int.from_bytes(s.read(4), 'little')
-        return cls(version, inputs, outputs, locktime)
+        tx = cls(version, inputs, outputs, locktime)
+        # keep the serialized bytes so txid/wtxid never need a re-serialization
+        end = s.tell()
+        s.seek(start)
+        tx._raw = s.read(end - start)
+        tx._witness_offset = witness_offset
+        return tx
 
-    def print_TXreadable(self):
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        """
+        Parse from a bytes-like b starting at offset, return (TxMessage, offset after it).
+        Hashes, scripts, witness items and the raw tx are memoryview slices of b, so
+        nothing is copied; the loops are inlined because this is the hot path for large blocks.
+        """
+        b = memoryview(b)
+        unpack32, unpack64 = UINT32.unpack_from, UINT64.unpack_from
+        start = offset
+        version = unpack32(b, offset)[0]
+        # varints are almost always a single byte, so that case skips the read_varint call
+        count = b[offset + 4]
+        if count < 0xfd:
+            offset += 5
+        else:
+            count, offset = read_varint(b, offset + 4)
+        segwit = empty = False
+        if count == 0:
+            flag = b[offset]
+            if flag == 1:
+                segwit = True
+                count, offset = read_varint(b, offset + 1)
+            elif flag == 0:
+                empty = True  # not a marker: the byte was the output count of a tx without inputs and outputs
+            else:
+                raise ValueError("unknown transaction flag: %d" % (flag,))
+        inputs = []
+        append = inputs.append
+        for _ in range(count):
+            in_start = offset
+            length = b[offset + 36]
+            if length < 0xfd:
+                offset += 37
+            else:
+                length, offset = read_varint(b, offset + 36)
+            end = offset + length
+            append(Input(b[in_start:in_start + 32], unpack32(b, in_start + 32)[0], b[offset:end], unpack32(b, end)[0]))
+            offset = end + 4
+        if empty:
+            count, offset = 0, offset + 1
+        else:
+            count = b[offset]
+            if count < 0xfd:
+                offset += 1
+            else:
+                count, offset = read_varint(b, offset)
+        outputs = []
+        append = outputs.append
+        for _ in range(count):
+            value = unpack64(b, offset)[0]
+            length = b[offset + 8]
+            if length < 0xfd:
+                offset += 9
+            else:
+                length, offset = read_varint(b, offset + 8)
+            end = offset + length
+            append(Output(value, b[offset:end]))
+            offset = end
+        witness_offset = None
+        if segwit:
+            witness_offset = offset - start
+            for tx_in in inputs:
+                count, offset = read_varint(b, offset)
+                items = []
+                for _ in range(count):
+                    item, offset = read_script(b, offset)
+                    items.append(item)
+                tx_in.witness = tuple(items)
+        locktime = unpack32(b, offset)[0]
+        offset += 4
+        tx = cls(version, inputs, outputs, locktime)
+        tx._raw = b[start:offset]
+        tx._witness_offset = witness_offset
+        return tx, offset
+
+    @property
+    def is_segwit(self):
+        if self._raw is None:
+            return any(tx_in.witness for tx_in in self.inputs)
+        return self._witness_offset is not None
+
+    @property
+    def txid(self):
+        """
+        Double-SHA256 of the serialization without witness data (internal byte order,
+        as used in inv/getdata and prevouts). For a segwit tx the marker/flag and the
+        witnesses are skipped by hashing the surrounding spans of the raw bytes in place.
+        """
+        if self._txid is None:
+            self._txid = hash256_parts(self.txid_parts())
+        return self._txid
+
+    @property
+    def wtxid(self):
+        """ Double-SHA256 of the full serialization, equal to txid for non-segwit transactions """
+        if self._wtxid is None:
+            self._wtxid = hash256(self.encode()) if self.is_segwit else self.txid
+        return self._wtxid
+
+    @property
+    def size(self):
+        """ Serialized size in bytes, witness data included """
+        return len(self.encode())
+
+    @property
+    def vsize(self):
+        """ Virtual size: weight (stripped size * 3 + full size) / 4, rounded up """
+        stripped = sum(len(part) for part in self.txid_parts())
+        return (stripped * 3 + self.size + 3) // 4
+
+    def txid_parts(self):
+        """ Spans of the raw bytes whose concatenation is the serialization without witness data """
+        raw = self.encode()
+        if self._witness_offset is None:
+            return (raw,)
+        # version, then inputs and outputs after the marker and flag, then the locktime
+        return raw[:4], raw[6:self._witness_offset], raw[-4:]
+
+    def encode(self):
+        """
+        The serialized transaction. A tx that was parsed and not changed since
+        returns the bytes it was parsed from, as is (a slice of the parsed buffer
+        for parse_from); otherwise the fields are serialized into one bytearray
+        of the exact size, which is kept for the hashes and later calls.
+        """
+        if self._raw is None:
+            self._raw, self._witness_offset = self.serialize()
+        return self._raw
+
+    def invalidate(self):
+        """
+        Drop the serialized bytes and the hashes. Call it after changing a field
+        of the tx, or of one of its inputs or outputs, so that encode() and the
+        hashes pick the change up.
+        """
+        self._raw = self._witness_offset = self._txid = self._wtxid = None
+
+    def serialize(self):
+        """ (read-only memoryview of the freshly serialized fields, offset of the witness data or None) """
+        inputs, outputs = self.inputs, self.outputs
+        segwit = any(tx_in.witness for tx_in in inputs)
+        size = (8 + varint_size(len(inputs)) + varint_size(len(outputs)) +
+                sum(tx_in.serialized_size() for tx_in in inputs) + sum(tx_out.serialized_size() for tx_out in outputs))
+        if segwit:
+            size += 2 + sum(tx_in.witness_size() for tx_in in inputs)
+        b = bytearray(size)
+        UINT32.pack_into(b, 0, self.version)
+        offset = 4
+        if segwit:
+            b[4:6] = b'\x00\x01'  # marker and flag
+            offset = 6
+        offset = write_varint(b, offset, len(inputs))
+        for tx_in in inputs:
+            offset = tx_in.encode_into(b, offset)
+        offset = write_varint(b, offset, len(outputs))
+        for tx_out in outputs:
+            offset = tx_out.encode_into(b, offset)
+        witness_offset = None
+        if segwit:
+            witness_offset = offset
+            for tx_in in inputs:
+                offset = tx_in.encode_witness_into(b, offset)
+        UINT32.pack_into(b, offset, self.locktime)
+        return memoryview(b).toreadonly(), witness_offset
+
+    def readable_lines(self, script_limit: int = None, script_types: bool = False):
+        """
+        The fields of the transaction as indented text lines; scripts are cut to
+        script_limit bytes. script_types adds each output's script type and address.
+        """
         version, inputs, outputs, lock_time = self.version, self.inputs, self.outputs, self.locktime
         total_value = sum(output.value for output in outputs)
-        print("Transaction Information:")
-        print(f"  Version: {version}")
-        print(f"  Locktime: {lock_time}")
-        print(f"  Number of Inputs: {len(inputs)}")
-        print(f"  Number of Outputs: {len(outputs)}")
-        print(f"  Total Output Value: {total_value / 100_000_000:.8f} BTC")
-        print("  Transaction Inputs:")
+        lines = [
+            "Transaction Information:",
+            f"  Version: {version}",
+            f"  Locktime: {lock_time}",
+            f"  Number of Inputs: {len(inputs)}",
+            f"  Number of Outputs: {len(outputs)}",
+            f"  Total Output Value: {total_value / 100_000_000:.8f} BTC",
+            "  Transaction Inputs:",
+        ]
         for i, input in enumerate(inputs):
-            print(f"    Input {i + 1}:")
-            print(f"      Previous Output Hash: {input.prevout_hash.hex()}")
-            print(f"      Output Index: {input.prevout_index}")
-            print(f"      ScriptSig: {input.script_sig.hex()}")
-        print("  Transaction Outputs:")
+            lines += [f"    Input {i + 1}:",
+                      f"      Previous Output Hash: {input.prevout_hash.hex()}",
+                      f"      Output Index: {input.prevout_index}",
+                      f"      ScriptSig: {script_hex(input.script_sig, script_limit)}"]
+        lines.append("  Transaction Outputs:")
         for i, output in enumerate(outputs):
-            print(f"    Output {i + 1}:")
-            print(f"      Value: {output.value} Satoshis ({output.btc_value()} BTC)")
-            print(f"      ScriptPubKey: {output.script_pubkey.hex()}")
+            lines += [f"    Output {i + 1}:",
+                      f"      Value: {output.value} Satoshis ({output.btc_value()} BTC)",
+                      f"      ScriptPubKey: {script_hex(output.script_pubkey, script_limit)}"]
+            if script_types:
+                from Scripts import classify, script_to_address  # only needed for the opt-in type lines
+
+                address = script_to_address(output.script_pubkey)
+                lines.append(f"      Type: {classify(output.script_pubkey)[0]}" + (f" ({address})" if address else ""))
+        return lines
+
+    def print_TXreadable(self, script_types: bool = False):
+        print("\n".join(self.readable_lines(script_types=script_types)))
 
 
 @dataclass
@@ -127,9 +536,20 @@ class BlockMessage:
     bits: int
     nonce: int
     transactions: List[TxMessage]
+    command: bytes = field(init=False, default=b'block', repr=False, compare=False)
+    # serialized bytes the block was parsed from by parse_from, or last encoded to
+    _raw: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+
+    __getstate__ = bytes_state
 
     @classmethod
     def parse(cls, s):
+        if METRICS.enabled:
+            return METRICS.observe_block_parse(cls.parse_stream, s)
+        return cls.parse_stream(s)
+
+    @classmethod
+    def parse_stream(cls, s):
         version = int.from_bytes(s.read(4), 'little')
         prev_block = s.read(32)
         merkle_root = s.read(32)
@@ -140,28 +560,121 @@ class BlockMessage:
         transactions = [TxMessage.parse(s) for _ in range(count)]
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, transactions)
 
-    def print_blockReadable(self):
-        print("Block Information:")
-        print(f"  Version: {self.version}")
-        print(f"  Previous Block Hash: {self.prev_block[::-1].hex()}")
-        print(f"  Merkle Root: {self.merkle_root.hex()}")
-        print(f"  Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.timestamp))}")
-        print(f"  Bits: {self.bits} (Difficulty: {self.calculate_difficulty()})")
-        print(f"  Nonce: {self.nonce}")
-        print(f"  Number of Transactions: {len(self.transactions)}")
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        """
+        Parse a block from a bytes-like b (e.g. an envelope payload) without going
+        through BytesIO, return (BlockMessage, offset after it).
+        Raises ValueError if the data is truncated.
+        """
+        if METRICS.enabled:
+            return METRICS.observe_block_parse(cls.parse_buffer, b, offset)
+        return cls.parse_buffer(b, offset)
+
+    @classmethod
+    def parse_buffer(cls, b, offset=0):
+        b = memoryview(b)
+        start = offset
+        try:
+            version, prev_block, merkle_root, timestamp, bits, nonce = BLOCK_HEADER.unpack_from(b, offset)
+            count, offset = read_varint(b, offset + 80)
+            transactions = []
+            for _ in range(count):
+                tx, offset = TxMessage.parse_from(b, offset)
+                transactions.append(tx)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated block data: %s" % (e,)) from e
+        if offset > len(b):
+            raise ValueError("truncated block data: needed %d bytes, got %d" % (offset, len(b)))
+        block = cls(version, prev_block, merkle_root, timestamp, bits, nonce, transactions)
+        block._raw = b[start:offset]
+        return block, offset
+
+    def encode(self):
+        """
+        The serialized block: the parsed bytes as is for an unchanged block from
+        parse_from, otherwise the header and the encoded transactions copied into
+        one bytearray of the exact size.
+        """
+        if self._raw is None:
+            txs = [tx.encode() for tx in self.transactions]
+            b = bytearray(80 + varint_size(len(txs)) + sum(len(raw) for raw in txs))
+            BLOCK_HEADER.pack_into(b, 0, self.version, self.prev_block, self.merkle_root, self.timestamp, self.bits,
+                                   self.nonce)
+            offset = write_varint(b, 80, len(txs))
+            for raw in txs:
+                b[offset:offset + len(raw)] = raw
+                offset += len(raw)
+            self._raw = memoryview(b).toreadonly()
+        return self._raw
+
+    def invalidate(self):
+        """
+        Drop the serialized bytes of the block and of its transactions (and their
+        hashes). Call it after changing the header, the transaction list or any
+        transaction.
+        """
+        for tx in self.transactions:
+            tx.invalidate()
+        self._raw = None
+
+    def header(self):
+        """ The serialized 80-byte block header """
+        return BLOCK_HEADER.pack(self.version, self.prev_block, self.merkle_root, self.timestamp, self.bits, self.nonce)
+
+    def hash(self):
+        """ Block hash in internal byte order, as used in inv/getdata and prev_block """
+        return hash256(self.header())
+
+    def compute_merkle_root(self, workers: int = None):
+        """ Merkle root of the transactions; the txids are hashed as one batch and memoized on each tx """
+        missing = [tx for tx in self.transactions if tx._txid is None]
+        if missing:
+            txids = hash256_batch([tx.txid_parts() for tx in missing], workers=workers)
+            for i, tx in enumerate(missing):
+                tx._txid = bytes(txids[32 * i:32 * i + 32])
+        return merkle_root(b''.join(tx.txid for tx in self.transactions))
+
+    def check_merkle_root(self, workers: int = None):
+        """ Whether the header's merkle root commits to exactly these transactions """
+        return self.compute_merkle_root(workers) == self.merkle_root
+
+    def coinbase_height(self):
+        """ Height the coinbase commits to (BIP34, blocks of version 2 and up), None if it has none """
+        if self.version < 2 or not self.transactions:
+            return None
+        inputs = self.transactions[0].inputs
+        if len(inputs) != 1 or inputs[0].prevout_index != 0xffffffff or inputs[0].prevout_hash != b'\x00' * 32:
+            return None
+        script = inputs[0].script_sig
+        if script and 0x51 <= script[0] <= 0x60:  # OP_1 .. OP_16
+            return script[0] - 0x50
+        if script and 1 <= script[0] <= 8 and len(script) > script[0]:
+            return int.from_bytes(script[1:1 + script[0]], 'little')
+        return None
+
+    def readable_lines(self, script_limit: int = None, script_types: bool = False):
+        """ The header fields followed by every transaction, as indented text lines """
+        lines = [
+            "Block Information:",
+            f"  Version: {self.version}",
+            f"  Previous Block Hash: {self.prev_block[::-1].hex()}",
+            f"  Merkle Root: {self.merkle_root.hex()}",
+            f"  Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.timestamp))}",
+            f"  Bits: {self.bits} (Difficulty: {self.calculate_difficulty()})",
+            f"  Nonce: {self.nonce}",
+            f"  Number of Transactions: {len(self.transactions)}",
+        ]
         for tx in self.transactions:
-            tx.print_TXreadable()
+            lines += tx.readable_lines(script_limit, script_types)
+        return lines
+
+    def print_blockReadable(self, script_types: bool = False):
+        print("\n".join(self.readable_lines(script_types=script_types)))
 
     def calculate_difficulty(self):
         # This method converts 'bits' into a full target and then calculates the difficulty
-        exponent = (self.bits >> 24)
-        mantissa = self.bits & 0x007fffff
-
-        # Calculate the full target based on the mantissa and exponent
-        if exponent <= 3:
-            target = mantissa >> (8 * (3 - exponent))
-        else:
-            target = mantissa << (8 * (exponent - 3))
+        target = bits_to_target(self.bits)
 
         # Genesis block target based on '0x1d00ffff'
         genesis_block_target = 0x00000000FFFF * (2 ** (8 * (0x1d - 3)))
@@ -170,3 +683,261 @@ class BlockMessage:
         if target == 0:
             return float('inf')  # To avoid division by zero, though it should never happen
         return genesis_block_target / target
+
+
+# -----------------------------------------------------------------------------
+# BIP152 compact block relay, see CompactBlocks.py for block reconstruction
+# -----------------------------------------------------------------------------
+
+def read_differential_indexes(b, offset):
+    """ Indexes stored as differences (each one minus the previous one, minus 1), return (indexes, offset) """
+    count, offset = read_varint(b, offset)
+    indexes, last = [], -1
+    for _ in range(count):
+        delta, offset = read_varint(b, offset)
+        last += delta + 1
+        indexes.append(last)
+    return indexes, offset
+
+
+def encode_differential_indexes(indexes):
+    out, last = [encode_varint(len(indexes))], -1
+    for index in indexes:
+        out.append(encode_varint(index - last - 1))
+        last = index
+    return out
+
+
+@dataclass
+class SendCmpctMessage:
+    """ https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki#sendcmpct """
+    announce: bool  # True: push new blocks as cmpctblock right away, False: announce with inv/headers
+    version: int = 2  # 1: short IDs from txids, 2: from wtxids
+    command: bytes = field(init=False, default=b'sendcmpct')
+
+    @classmethod
+    def parse(cls, s):
+        return cls(bool(s.read(1)[0]), int.from_bytes(s.read(8), 'little'))
+
+    def encode(self):
+        return bytes([self.announce]) + encode_int(self.version, 8)
+
+
+@dataclass
+class CmpctBlockMessage:
+    """
+    A block header, a 6-byte short ID per transaction and the few transactions the
+    sender expects the receiver not to have (at least the coinbase), with their index.
+    """
+    header: bytes
+    nonce: int  # salts the short IDs of this message
+    short_ids: List[bytes]
+    prefilled: List[Tuple[int, TxMessage]]  # (index in the block, tx)
+    command: bytes = field(init=False, default=b'cmpctblock')
+
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        b = memoryview(b)
+        try:
+            header = bytes(b[offset:offset + 80])
+            nonce = UINT64.unpack_from(b, offset + 80)[0]
+            count, offset = read_varint(b, offset + 88)
+            short_ids = [bytes(b[i:i + 6]) for i in range(offset, offset + 6 * count, 6)]
+            count, offset = read_varint(b, offset + 6 * count)
+            prefilled, index = [], -1
+            for _ in range(count):
+                delta, offset = read_varint(b, offset)
+                index += delta + 1
+                tx, offset = TxMessage.parse_from(b, offset)
+                prefilled.append((index, tx))
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated cmpctblock message: %s" % (e,)) from e
+        if len(header) != 80 or offset > len(b):
+            raise ValueError("truncated cmpctblock message")
+        return cls(header, nonce, short_ids, prefilled), offset
+
+    def encode(self):
+        out = [self.header, encode_int(self.nonce, 8), encode_varint(len(self.short_ids))]
+        out += self.short_ids
+        out.append(encode_varint(len(self.prefilled)))
+        last = -1
+        for index, tx in self.prefilled:
+            out += [encode_varint(index - last - 1), tx.encode()]
+            last = index
+        return b''.join(out)
+
+    @property
+    def block_hash(self):
+        return hash256(self.header)
+
+    @property
+    def tx_count(self):
+        return len(self.short_ids) + len(self.prefilled)
+
+
+@dataclass
+class GetBlockTxnMessage:
+    """ Ask for the transactions of a compact block that could not be found locally """
+    block_hash: bytes
+    indexes: List[int]  # increasing
+    command: bytes = field(init=False, default=b'getblocktxn')
+
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        b = memoryview(b)
+        try:
+            indexes, end = read_differential_indexes(b, offset + 32)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated getblocktxn message: %s" % (e,)) from e
+        return cls(bytes(b[offset:offset + 32]), indexes), end
+
+    def encode(self):
+        return b''.join([self.block_hash] + encode_differential_indexes(self.indexes))
+
+
+@dataclass
+class BlockTxnMessage:
+    """ The transactions asked for by a getblocktxn, in the same order """
+    block_hash: bytes
+    transactions: List[TxMessage]
+    command: bytes = field(init=False, default=b'blocktxn')
+
+    @classmethod
+    def parse_from(cls, b, offset=0):
+        b = memoryview(b)
+        try:
+            block_hash = bytes(b[offset:offset + 32])
+            count, offset = read_varint(b, offset + 32)
+            transactions = []
+            for _ in range(count):
+                tx, offset = TxMessage.parse_from(b, offset)
+                transactions.append(tx)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated blocktxn message: %s" % (e,)) from e
+        return cls(block_hash, transactions), offset
+
+    def encode(self):
+        return b''.join([self.block_hash, encode_varint(len(self.transactions))] +
+                        [tx.encode() for tx in self.transactions])
+
+
+class LazyTransactions:
+    """
+    Sequence of the transactions of a LazyBlock. Holds only the offsets of each
+    serialized tx in the block buffer and decodes a TxMessage when it is accessed,
+    keeping up to cache_size decoded txs (least recently used are dropped,
+    None means keep them all, 0 disables the cache).
+
+    Txs leaving the cache are kept aside while something else still holds them,
+    and for good once invalidated, so an edited tx is never decoded again from
+    the stale bytes (as TxMessage asks, invalidate a tx after editing it).
+    Without a cache (cache_size 0), edits to the txs are lost.
+    """
+
+    def __init__(self, b, offsets, cache_size=64):
+        self.b = b
+        self.offsets = offsets  # array('Q') of len(self) + 1 entries, the last one is the end of the block
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.kept = {}  # index -> tx that left the cache, until a sweep finds it unused and not invalidated
+        self.sweep_at = cache_size or 0  # sweep kept when it grows past this
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("transaction index out of range")
+        tx = self.cache.get(i)
+        if tx is not None:
+            self.cache.move_to_end(i)
+            return tx
+        tx = self.kept.get(i)
+        if tx is not None:
+            return tx
+        tx, _ = TxMessage.parse_from(self.b, self.offsets[i])
+        if self.cache_size != 0:
+            self.cache[i] = tx
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
+                self.evict_oldest()
+        return tx
+
+    def evict_oldest(self):
+        j, tx = self.cache.popitem(last=False)
+        self.kept[j] = tx
+        if len(self.kept) > self.sweep_at:
+            self.sweep()
+
+    def sweep(self):
+        """ Forget the kept txs that were not invalidated and that nothing else holds anymore """
+        for j in list(self.kept):
+            tx = self.kept.pop(j)
+            if self.detached(tx):
+                self.kept[j] = tx
+                continue
+            ref = weakref.ref(tx)
+            del tx
+            if ref() is not None:  # still held elsewhere, may be edited later
+                self.kept[j] = ref()
+        self.sweep_at = max(self.cache_size, 2 * len(self.kept))  # amortized: sweeps get rarer as more are held
+
+    def detached(self, tx):
+        """ Whether tx was invalidated since it was decoded, so its bytes no longer come from the buffer """
+        return not isinstance(tx._raw, memoryview) or tx._raw.obj is not self.b.obj
+
+    def invalidate(self):
+        """ Invalidate the decoded txs """
+        for tx in list(self.cache.values()) + list(self.kept.values()):
+            tx.invalidate()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def raw(self, i):
+        """ Serialized bytes of transaction i, without decoding it unless it was edited """
+        tx = self.cache.get(i) or self.kept.get(i)
+        if tx is not None and self.detached(tx):
+            return tx.encode()
+        return self.b[self.offsets[i]:self.offsets[i + 1]]
+
+
+class LazyBlock(BlockMessage):
+    """
+    A BlockMessage that decodes only its 80-byte header up front. One cheap pass
+    over the payload records where each transaction starts, and transactions are
+    materialized on demand through LazyTransactions, e.g. to show the first page
+    of a large block.
+    """
+
+    def invalidate(self):
+        """ Like BlockMessage.invalidate, without decoding the transactions that were never accessed """
+        self.transactions.invalidate()
+        self._raw = None
+
+    @classmethod
+    def parse_from(cls, b, offset=0, cache_size=64):
+        b = memoryview(b)
+        start = offset
+        try:
+            version, prev_block, merkle_root, timestamp, bits, nonce = BLOCK_HEADER.unpack_from(b, offset)
+            count, offset = read_varint(b, offset + 80)
+            if count > (len(b) - offset) // MIN_TX_SIZE:
+                raise ValueError("block claims %d transactions in %d bytes" % (count, len(b) - offset))
+            offsets = array('Q', bytes(8 * (count + 1)))
+            for i in range(count):
+                offsets[i] = offset
+                offset = skip_tx(b, offset)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated block data: %s" % (e,)) from e
+        if offset > len(b):
+            raise ValueError("truncated block data: needed %d bytes, got %d" % (offset, len(b)))
+        offsets[count] = offset
+        transactions = LazyTransactions(b, offsets, cache_size)
+        block = cls(version, prev_block, merkle_root, timestamp, bits, nonce, transactions)
+        block._raw = b[start:offset]
+        return block, offset
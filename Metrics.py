@@ -0,0 +1,277 @@
+"""
+Counters and histograms for the hot paths, off unless enabled.
+
+Instrumented code checks METRICS.enabled before taking any timestamp, so a
+disabled registry costs one attribute lookup per message. Once enabled:
+
+ - METRICS.snapshot() returns every value as a plain dict
+ - METRICS.stats_line() is a one-line summary, printed every few seconds by
+   METRICS.start_stats(interval)
+ - METRICS.prometheus_text() is the Prometheus text format, written to a file
+   by METRICS.write_prometheus(path) or served by METRICS.serve(port) on
+   http://127.0.0.1:<port>/metrics
+ - METRICS.profile_block_parse('cprofile' or 'sampling') profiles every
+   BlockMessage.parse / parse_from until turned off; METRICS.profile_report()
+   shows the result
+"""
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Counter
+
+# upper bounds in seconds, from a microsecond (one small tx) to seconds (a big block on a slow machine)
+LATENCY_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0)
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name, self.help, self.label = name, help, label
+        self.values = {}  # label value (None without a label) -> count
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+
+class Gauge(Counter):
+    def set(self, value, label_value=None):
+        self.values[label_value] = value
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label = name, help, label
+        self.buckets = buckets
+        self.values = {}  # label value -> [count per bucket (the last one is +Inf), sum]
+
+    def observe(self, value, label_value=None):
+        series = self.values.get(label_value)
+        if series is None:
+            series = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, label_value=None):
+        series = self.values.get(label_value)
+        return 0 if series is None else sum(series[0])
+
+    def quantile(self, q, label_value=None):
+        """ Upper bound of the bucket holding quantile q, None without observations """
+        series = self.values.get(label_value)
+        if series is None:
+            return None
+        rank, seen = q * sum(series[0]), 0
+        for bound, count in zip(self.buckets + (float('inf'),), series[0]):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return float('inf')
+
+
+class SamplingProfiler:
+    """
+    Low-overhead alternative to cProfile: a thread records where the profiled
+    thread is every interval seconds. Same runcall interface as cProfile.Profile.
+    """
+
+    def __init__(self, interval: float = 0.0005):
+        self.interval = interval
+        self.samples = _Counter()  # (file, line, function) -> samples
+
+    def runcall(self, fn, *args):
+        target = threading.get_ident()
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                frame = sys._current_frames().get(target)
+                if frame is not None:
+                    code = frame.f_code
+                    self.samples[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            return fn(*args)
+        finally:
+            done.set()
+            sampler.join()
+
+    def report(self, limit=20):
+        total = sum(self.samples.values()) or 1
+        lines = [f"{count:7d} {count / total:6.1%}  {os.path.basename(f)}:{line} {name}"
+                 for (f, line, name), count in self.samples.most_common(limit)]
+        return '\n'.join(["samples  share  location"] + lines)
+
+
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self.profiler = None  # cProfile.Profile or SamplingProfiler around block parsing, when profiling
+        self.metrics = []
+        self.messages_received = self.add(Counter('btc_messages_received_total', "Messages received", 'command'))
+        self.messages_sent = self.add(Counter('btc_messages_sent_total', "Messages sent", 'command'))
+        self.bytes_received = self.add(Counter('btc_bytes_received_total', "Bytes received, headers included"))
+        self.bytes_sent = self.add(Counter('btc_bytes_sent_total', "Bytes sent, headers included"))
+        self.block_parse = self.add(Histogram('btc_block_parse_seconds', "Time to parse a block"))
+        self.tx_parse = self.add(Histogram('btc_tx_parse_seconds', "Time to parse a tx (in a block: block time / txs)",
+                                           'source'))
+        self.checksum = self.add(Histogram('btc_checksum_seconds', "Time spent checksumming a received payload"))
+        self.send_latency = self.add(Histogram('btc_send_latency_seconds', "From queuing a message to its write"))
+        self.queue_depth = self.add(Gauge('btc_queue_depth', "Items waiting in a queue", 'queue'))
+        self.stats_stop = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+        return self
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.values.clear()
+
+    def observe_block_parse(self, fn, *args):
+        """ Call fn(*args), a block parser, under the profiler if any, and record its time """
+        start = time.perf_counter()
+        result = fn(*args) if self.profiler is None else self.profiler.runcall(fn, *args)
+        elapsed = time.perf_counter() - start
+        block = result[0] if isinstance(result, tuple) else result
+        self.block_parse.observe(elapsed)
+        if block.transactions:
+            self.tx_parse.observe(elapsed / len(block.transactions), 'block')
+        return result
+
+    def time_call(self, histogram, label_value, fn, *args):
+        """ Call fn(*args) and record its time in histogram """
+        start = time.perf_counter()
+        result = fn(*args)
+        histogram.observe(time.perf_counter() - start, label_value)
+        return result
+
+    def profile_block_parse(self, mode='cprofile'):
+        """ Profile block parsing with 'cprofile' or 'sampling' (which also enables metrics), None to stop """
+        if mode is None:
+            profiler, self.profiler = self.profiler, None
+            return profiler
+        if mode not in ('cprofile', 'sampling'):
+            raise ValueError("unknown profiler %r, expected 'cprofile' or 'sampling'" % (mode,))
+        import cProfile  # profiling and serving are rare, keep their imports off the startup path
+
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else SamplingProfiler()
+        self.enabled = True
+        return self.profiler
+
+    def profile_report(self, limit=20):
+        if self.profiler is None:
+            return "block parse profiling is off"
+        if isinstance(self.profiler, SamplingProfiler):
+            return self.profiler.report(limit)
+        import io
+        import pstats
+
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def snapshot(self):
+        """ {metric name: {label value: value}}; histograms give count, sum, p50 and p99 """
+        snap = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                snap[metric.name] = {label: {'count': metric.count(label), 'sum': series[1],
+                                             'p50': metric.quantile(0.5, label), 'p99': metric.quantile(0.99, label)}
+                                     for label, series in metric.values.items()}
+            else:
+                snap[metric.name] = dict(metric.values)
+        return snap
+
+    def stats_line(self):
+        def ms(histogram, label=None):
+            p50 = histogram.quantile(0.5, label)
+            return "-" if p50 is None else f"{p50 * 1000:.3g} ms"
+
+        queues = ' '.join(f"{name}={depth}" for name, depth in sorted(self.queue_depth.values.items()))
+        return (f"msgs in {self.messages_received.total()} out {self.messages_sent.total()}"
+                f" | {self.bytes_received.total() / 1e6:.2f} MB in {self.bytes_sent.total() / 1e6:.2f} MB out"
+                f" | block parse p50 {ms(self.block_parse)} ({self.block_parse.count()} blocks)"
+                f" | tx parse p50 {ms(self.tx_parse, 'message')} | checksum p50 {ms(self.checksum)}"
+                f" | send p50 {ms(self.send_latency)}" + (f" | queues {queues}" if queues else ""))
+
+    def prometheus_text(self):
+        lines = []
+        for metric in self.metrics:
+            kind = 'histogram' if isinstance(metric, Histogram) else 'gauge' if isinstance(metric, Gauge) else 'counter'
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {kind}"]
+            for label, value in sorted(metric.values.items(), key=lambda item: str(item[0])):
+                labels = [] if label is None else [f'{metric.label}="{label}"']
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + ('+Inf',), value[0]):
+                        cumulative += count
+                        bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                        lines.append(f"{metric.name}_bucket{{{bucket_labels}}} {cumulative}")
+                    suffix = '{%s}' % ','.join(labels) if labels else ''
+                    lines += [f"{metric.name}_sum{suffix} {value[1]}", f"{metric.name}_count{suffix} {cumulative}"]
+                else:
+                    suffix = '{%s}' % ','.join(labels) if labels else ''
+                    lines.append(f"{metric.name}{suffix} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """ Write the Prometheus text to path atomically (e.g. for node_exporter's textfile collector) """
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port: int = 9108, host: str = '127.0.0.1'):
+        """ Serve /metrics over HTTP from a daemon thread, return the server (call shutdown() to stop it) """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+    def start_stats(self, interval: float = 10.0, out=None, path: str = None):
+        """ Every interval seconds print stats_line() (to out, default stdout) and rewrite path if given """
+        self.stop_stats()
+        stop = self.stats_stop = threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                print(self.stats_line(), file=out or sys.stdout, flush=True)
+                if path is not None:
+                    self.write_prometheus(path)
+
+        threading.Thread(target=report, name='metrics-stats', daemon=True).start()
+
+    def stop_stats(self):
+        if self.stats_stop is not None:
+            self.stats_stop.set()
+            self.stats_stop = None
+
+
+METRICS = Registry()
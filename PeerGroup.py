@@ -0,0 +1,233 @@
+"""
+A group of concurrent peer connections sharing one view of the inventory.
+
+Every tx/block hash announced by any peer is fetched exactly once: the first
+announcement marks it as seen, and the getdata goes to the connected peer with
+the fewest outstanding requests. Requests that are not answered within
+request_timeout mark their peer as stalled; it is disconnected, replaced by the
+next known address, and its outstanding items are handed to the other peers.
+An item a peer answers with notfound (or with a block that doesn't match its
+merkle root) goes to another peer right away; one no peer can serve yet waits
+until a peer is ready, and is forgotten once every announcer refused it.
+"""
+import asyncio
+import socket
+import time
+from collections import OrderedDict, deque
+
+from AsyncNode import AsyncNode
+from MessageHandler import GetDataMessage, InvMessage
+
+MSG_TX, MSG_BLOCK = 1, 2
+
+
+def resolve_seed(host: str, net: str = 'main'):
+    """ All IPv4 addresses behind a DNS seed, as (host, port) pairs """
+    port = {'main': 8333, 'test': 18333}[net]
+    infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+    return list(dict.fromkeys((info[4][0], port) for info in infos))
+
+
+class InventoryFilter:
+    """ Bounded set of recently seen inventory hashes; the least recently added are forgotten first """
+
+    def __init__(self, capacity: int = 200_000):
+        self.capacity = capacity
+        self.items = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def discard(self, item):
+        self.items.pop(item, None)
+
+    def add(self, item):
+        """ Add item, return False if it was already seen """
+        if item in self.items:
+            return False
+        self.items[item] = None
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+        return True
+
+
+class PeerGroup:
+    def __init__(self, addresses, size: int = 4, net: str = 'main', verbose: int = 0,
+                 request_timeout: float = 30.0, seen_capacity: int = 200_000, snapshot=None, fallback=None,
+                 connect_timeout: float = 10.0):
+        self.addresses = deque(addresses)  # candidates not connected yet, as (host, port)
+        self.fallback = fallback  # called once for more addresses (e.g. resolve_seed) when those run out
+        self.size = size
+        self.net = net
+        self.verbose = verbose
+        self.request_timeout = request_timeout
+        self.connect_timeout = connect_timeout
+        self.seen = InventoryFilter(seen_capacity)
+        self.snapshot = snapshot  # optional Snapshot.Snapshot: peer latency, inventory seen in the last session
+        self.peers = []  # connected AsyncNodes
+        self.outstanding = {}  # AsyncNode -> {(inv type, hash): deadline}
+        self.announcers = {}  # (inv type, hash) -> AsyncNodes that announced it, while it is outstanding
+        self.refused = {}  # (inv type, hash) -> AsyncNodes that answered it with notfound or a bad block
+        self.waiting = set()  # items no peer could be asked for yet
+        self.retries = set()  # request tasks for refused items
+        self.watchdog = None
+
+    async def start(self):
+        await asyncio.gather(*(self.add_peer() for _ in range(self.size - len(self.peers))))
+        self.watchdog = asyncio.create_task(self.watch_stalls())
+        return self
+
+    async def add_peer(self):
+        """ Connect to the next candidate address that answers, return the node or None if there are none left """
+        while self.addresses or self.fallback is not None:
+            if not self.addresses:
+                fallback, self.fallback = self.fallback, None
+                try:  # e.g. a DNS lookup, off the event loop
+                    self.addresses.extend(await asyncio.wait_for(
+                        asyncio.get_running_loop().run_in_executor(None, fallback), self.connect_timeout))
+                except (OSError, asyncio.TimeoutError) as e:
+                    if self.verbose:
+                        print(f"Could not get more peer addresses: {e!r}")
+                continue
+            host, port = self.addresses.popleft()
+            node = AsyncNode(host, port, net=self.net, verbose=self.verbose, snapshot=self.snapshot)
+            node.handlers[InvMessage.command] = lambda env, node=node: self.handle_inv(node, env)
+            node.handlers[b'notfound'] = lambda env, node=node: self.handle_notfound(node, env)
+            node.on_tx = lambda tx, node=node: self.received(node, (MSG_TX, tx.txid), tx)
+            node.on_block = lambda block, node=node: self.received(node, (MSG_BLOCK, block.hash()), block)
+            node.on_bad_block = lambda block_hash, node=node: self.refuse(node, [(MSG_BLOCK, block_hash)])
+            try:
+                await asyncio.wait_for(node.connect(), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                if self.verbose:
+                    print(f"Could not connect to {host}:{port}: {e!r}")
+                if self.snapshot is not None:
+                    self.snapshot.peer_failed(host, port)
+                await node.close()
+                continue
+            self.peers.append(node)
+            self.outstanding[node] = {}
+            return node
+        return None
+
+    def ready_peers(self):
+        return [node for node in self.peers if node.handshake_done.is_set() and not node.closed.is_set()]
+
+    async def handle_inv(self, node, env):
+        inv = InvMessage.parse(env.stream())
+        for item in inv.items:
+            if item[0] not in (MSG_TX, MSG_BLOCK):
+                continue
+            if item in self.announcers:
+                self.announcers[item].add(node)
+                if item in self.waiting:
+                    await self.request([item])
+            elif self.seen.add(item) and (self.snapshot is None or self.snapshot.seen.add(item[1])):
+                self.announcers[item] = {node}
+                await self.request([item])
+
+    async def request(self, items, exclude=()):
+        """ Send getdata for items, each to the least loaded ready peer """
+        batches = {}
+        deadline = time.monotonic() + self.request_timeout
+        for item in items:
+            excluded = set(exclude) | self.refused.get(item, set())
+            candidates = [node for node in self.ready_peers() if node not in excluded] or \
+                [node for node in self.announcers.get(item, ()) if node in self.outstanding and node not in excluded]
+            if not candidates:
+                self.waiting.add(item)  # retried when a peer is ready or announces it
+                continue
+            self.waiting.discard(item)
+            node = min(candidates, key=lambda n: len(self.outstanding[n]))
+            self.outstanding[node][item] = deadline
+            batches.setdefault(node, []).append(item)
+        for node, batch in batches.items():
+            await node.send(GetDataMessage(batch))
+
+    async def handle_notfound(self, node, env):
+        self.refuse(node, InvMessage.parse(env.stream()).items)
+
+    def refuse(self, node, items):
+        """ node couldn't deliver items: ask another peer now, or forget them if every announcer refused """
+        owed = self.outstanding.get(node, {})
+        retry = []
+        for item in items:
+            if owed.pop(item, None) is None:
+                continue
+            refused = self.refused.setdefault(item, set())
+            refused.add(node)
+            if self.announcers.get(item, set()) <= refused:
+                self.forget(item)
+            else:
+                retry.append(item)
+        if retry:
+            task = asyncio.get_running_loop().create_task(self.request(retry))
+            self.retries.add(task)
+            task.add_done_callback(self.retries.discard)
+
+    def forget(self, item):
+        """ Drop an item no announcer could deliver, so a later announcement fetches it again """
+        self.announcers.pop(item, None)
+        self.refused.pop(item, None)
+        self.waiting.discard(item)
+        self.seen.discard(item)
+
+    def received(self, node, item, obj):
+        self.announcers.pop(item, None)
+        self.refused.pop(item, None)
+        self.outstanding.get(node, {}).pop(item, None)
+        if item[0] == MSG_TX:
+            self.on_tx(obj)
+        else:
+            self.on_block(obj)
+
+    def on_tx(self, tx):
+        """ Called once per transaction, whichever peer delivered it """
+        if self.verbose:
+            tx.print_TXreadable()
+
+    def on_block(self, block):
+        """ Called once per block, whichever peer delivered it """
+        if self.verbose:
+            block.print_blockReadable()
+
+    async def watch_stalls(self, interval: float = None):
+        interval = interval or min(1.0, self.request_timeout / 4)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for node in list(self.peers):
+                if node.closed.is_set() or any(deadline < now for deadline in self.outstanding[node].values()):
+                    try:
+                        await self.replace_peer(node)
+                    except Exception as e:  # keep watching the other peers
+                        if self.verbose:
+                            print(f"Could not replace peer {node.host}:{node.port}: {e!r}")
+            if self.waiting and self.ready_peers():
+                await self.request(list(self.waiting))
+
+    async def replace_peer(self, node):
+        """ Drop a stalled or disconnected peer, connect a new one and re-request what it still owed """
+        if self.verbose:
+            print(f"Replacing peer {node.host}:{node.port}")
+        self.peers.remove(node)
+        items = list(self.outstanding.pop(node))
+        for nodes in (*self.announcers.values(), *self.refused.values()):
+            nodes.discard(node)
+        await node.close()
+        await self.add_peer()
+        if items:
+            await self.request(items, exclude=(node,))
+
+    async def close(self):
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        for task in self.retries:
+            task.cancel()
+        await asyncio.gather(*[task for task in (self.watchdog,) if task is not None], *self.retries,
+                             return_exceptions=True)
+        await asyncio.gather(*(node.close() for node in self.peers))
+        self.peers.clear()
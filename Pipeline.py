@@ -0,0 +1,137 @@
+"""
+Parallel block decoding.
+
+Raw block payloads are copied once into shared memory and decoded (parse +
+txid hashing) by a ProcessPoolExecutor, so only the shared memory name goes
+through pickling and the listen loop's process never spends time parsing.
+Results come back as compact DecodedBlock summaries, released strictly in
+height order through a bounded reorder buffer.
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+
+from MessageHandler import BlockMessage
+
+
+@dataclass
+class DecodedBlock:
+    height: int
+    block_hash: bytes
+    prev_block: bytes
+    timestamp: int
+    size: int
+    txids: bytes  # 32 bytes per transaction, in block order
+    input_count: int
+    output_count: int
+    total_value: int  # satoshis in all outputs
+    merkle_valid: bool
+
+    @property
+    def tx_count(self):
+        return len(self.txids) // 32
+
+
+def summarize(b, height):
+    """ Decode a block and reduce it to a picklable DecodedBlock """
+    block, size = BlockMessage.parse_from(b)
+    merkle_valid = block.check_merkle_root()  # hashes every txid as one batch
+    return DecodedBlock(height, block.hash(), block.prev_block, block.timestamp, size,
+                        b''.join(tx.txid for tx in block.transactions),
+                        sum(len(tx.inputs) for tx in block.transactions),
+                        sum(len(tx.outputs) for tx in block.transactions),
+                        sum(o.value for tx in block.transactions for o in tx.outputs), merkle_valid)
+
+
+def decode_shared(name, size, height):
+    """ Worker entry point: decode the block held in shared memory segment name """
+    # workers report to the submitting process's resource tracker, which already
+    # tracks the segment, so attaching doesn't change who unlinks it
+    shm = SharedMemory(name=name)
+    try:
+        # every view into shm.buf dies with summarize's frame, so the segment can be closed after
+        return summarize(shm.buf[:size], height)
+    finally:
+        shm.close()
+
+
+class ReorderBuffer:
+    """ Holds results that arrived early and releases them in height order """
+
+    def __init__(self, next_height: int, capacity: int):
+        self.next_height = next_height
+        self.capacity = capacity
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, height, item):
+        """ Add an item, return the items that are now in order (possibly none) """
+        if len(self.items) >= self.capacity and height != self.next_height:
+            raise ValueError("reorder buffer full while waiting for height %d" % (self.next_height,))
+        self.items[height] = item
+        ready = []
+        while self.next_height in self.items:
+            ready.append(self.items.pop(self.next_height))
+            self.next_height += 1
+        return ready
+
+
+class DecodePipeline:
+    def __init__(self, workers: int = None, window: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.window = window or 2 * self.workers  # blocks in flight plus blocks waiting to be reordered
+        self.executor = ProcessPoolExecutor(self.workers)
+
+    def submit(self, height, raw):
+        shm = SharedMemory(create=True, size=max(len(raw), 1))
+        shm.buf[:len(raw)] = raw
+        future = self.executor.submit(decode_shared, shm.name, len(raw), height)
+        future.shm = shm
+        return future
+
+    def collect(self, futures, reorder, timeout=None):
+        """ Wait for at least one future, feed finished ones to reorder and return what it releases """
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        ready = []
+        for future in done:
+            futures.discard(future)
+            future.shm.close()
+            future.shm.unlink()
+            result = future.result()
+            ready += reorder.put(result.height, result)
+        return ready
+
+    def decode(self, blocks, start_height: int = 0):
+        """
+        Decode (height, raw block) pairs, which may arrive in any order, and yield
+        DecodedBlocks by increasing height starting at start_height. At most window
+        blocks are in flight or buffered, beyond that the input is not consumed.
+        """
+        reorder = ReorderBuffer(start_height, self.window)
+        futures = set()
+        try:
+            for height, raw in blocks:
+                while futures and len(futures) + len(reorder) >= self.window:
+                    yield from self.collect(futures, reorder)
+                futures.add(self.submit(height, raw))
+            while futures:
+                yield from self.collect(futures, reorder)
+        finally:
+            for future in futures:  # abandoned early: free the segments once the workers are done with them
+                wait([future])
+                future.shm.close()
+                future.shm.unlink()
+        if len(reorder):
+            raise ValueError("missing block at height %d" % (reorder.next_height,))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,164 @@
+"""
+Background rendering of received blocks and transactions.
+
+The network loop only hands items to Renderer.submit, which never blocks: a
+bounded queue feeds a daemon thread that formats them and writes whole batches
+to the output stream with one write and one flush. When the console falls
+behind and the queue is full, new items are dropped and counted, and a single
+"skipped" line reports them once the renderer catches up.
+
+Modes:
+ - summary: one line per block or transaction
+ - json: JSON lines, one object per block header and per transaction
+ - truncated: the full readable layout with scripts cut to script_limit bytes
+ - full: the full readable layout, as print_blockReadable / print_TXreadable
+"""
+import json
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+from MessageHandler import BlockMessage, TxMessage
+from Metrics import METRICS
+from Scripts import classify, script_to_address
+
+MODES = ('summary', 'json', 'truncated', 'full')
+BATCH_SIZE = 256  # items formatted per write
+_STOP = object()
+
+
+def item_kind(item):
+    if isinstance(item, BlockMessage):
+        return 'blocks'
+    if isinstance(item, TxMessage):
+        return 'transactions'
+    return 'messages'
+
+
+def format_summary(item):
+    if isinstance(item, BlockMessage):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(item.timestamp))
+        return f"block {item.hash()[::-1].hex()}  {stamp}  {len(item.transactions)} txs\n"
+    if isinstance(item, TxMessage):
+        value = sum(output.value for output in item.outputs)
+        return (f"tx {item.txid[::-1].hex()}  {len(item.inputs)} in  {len(item.outputs)} out"
+                f"  {value / 100_000_000:.8f} BTC\n")
+    return f"{item}\n"
+
+
+def tx_dict(tx, net='main'):
+    return {
+        'type': 'tx',
+        'txid': tx.txid[::-1].hex(),
+        'version': tx.version,
+        'locktime': tx.locktime,
+        'inputs': [{'prevout': tx_in.prevout_hash[::-1].hex(), 'index': tx_in.prevout_index,
+                    'script_sig': tx_in.script_sig.hex(), 'sequence': tx_in.sequence} for tx_in in tx.inputs],
+        'outputs': [{'value': output.value, 'script_pubkey': output.script_pubkey.hex(),
+                     'type': classify(output.script_pubkey)[0],
+                     'address': script_to_address(output.script_pubkey, net)} for output in tx.outputs],
+    }
+
+
+def block_dict(block):
+    return {
+        'type': 'block',
+        'hash': block.hash()[::-1].hex(),
+        'version': block.version,
+        'prev_block': block.prev_block[::-1].hex(),
+        'merkle_root': block.merkle_root[::-1].hex(),
+        'timestamp': block.timestamp,
+        'bits': block.bits,
+        'nonce': block.nonce,
+        'tx_count': len(block.transactions),
+    }
+
+
+def format_json(item, net='main'):
+    if isinstance(item, BlockMessage):
+        lines = [json.dumps(block_dict(item))]
+        lines += [json.dumps(tx_dict(tx, net)) for tx in item.transactions]
+        return '\n'.join(lines) + '\n'
+    if isinstance(item, TxMessage):
+        return json.dumps(tx_dict(item, net)) + '\n'
+    return json.dumps({'type': 'message', 'text': str(item)}) + '\n'
+
+
+def format_readable(item, script_limit=None):
+    if isinstance(item, (BlockMessage, TxMessage)):
+        return '\n'.join(item.readable_lines(script_limit)) + '\n'
+    return f"{item}\n"
+
+
+class Renderer:
+    def __init__(self, mode: str = 'summary', out=None, queue_size: int = 256, script_limit: int = 32,
+                 net: str = 'main'):
+        if mode not in MODES:
+            raise ValueError("unknown render mode %r, expected one of %s" % (mode, ', '.join(MODES)))
+        self.mode = mode
+        self.out = out or sys.stdout
+        self.script_limit = script_limit
+        self.net = net
+        self.queue = queue.Queue(queue_size)
+        self.skipped = Counter()  # items dropped since the last "skipped" line, by kind
+        self.lock = threading.Lock()  # guards skipped, which both threads update
+        self.thread = threading.Thread(target=self.run, name='renderer', daemon=True)
+        self.thread.start()
+
+    def format(self, item):
+        if self.mode == 'summary':
+            return format_summary(item)
+        if self.mode == 'json':
+            return format_json(item, self.net)
+        return format_readable(item, self.script_limit if self.mode == 'truncated' else None)
+
+    def submit(self, item):
+        """ Queue a block, transaction or text line; return False if it was dropped because the queue is full """
+        try:
+            self.queue.put_nowait(item)
+            if METRICS.enabled:
+                METRICS.queue_depth.set(self.queue.qsize(), 'render')
+            return True
+        except queue.Full:
+            with self.lock:
+                self.skipped[item_kind(item)] += 1
+            return False
+
+    def skipped_line(self):
+        with self.lock:
+            skipped, self.skipped = self.skipped, Counter()
+        if not skipped:
+            return None
+        text = ', '.join(f"{count} {kind}" for kind, count in sorted(skipped.items()))
+        if self.mode == 'json':
+            return json.dumps({'type': 'skipped', **skipped}) + '\n'
+        return f"... skipped {text} (output can't keep up)\n"
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = batch[:batch.index(_STOP)]
+            texts = [self.format(item) for item in batch]
+            skipped = self.skipped_line()
+            if skipped is not None:
+                texts.append(skipped)
+            if texts:
+                self.out.write(''.join(texts))
+                self.out.flush()
+
+    def close(self, timeout: float = None):
+        """ Render what is queued, then stop the thread """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
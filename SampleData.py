@@ -0,0 +1,187 @@
+"""
+Sample data for tests and benchmarks.
+
+BlockExample.txt is a hex dump cut out of a real block: it starts with the last
+32 bytes of one transaction, followed by complete (non-witness) transactions up
+to the end of the file. load_block_example() wraps those transactions in an
+80-byte header so they can be parsed as a well-formed block.
+"""
+import os
+import random
+from functools import lru_cache
+from io import BytesIO
+
+from MessageHandler import BLOCK_HEADER, TxMessage
+from Utils import UINT32, UINT64, bits_to_target, encode_varint, hash256
+
+BLOCK_EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BlockExample.txt')
+FRAGMENT_LENGTH = 32  # tail of a transaction that was cut off at the start of the dump
+
+
+def load_block_example_raw():
+    """ The raw bytes of BlockExample.txt, as embedded in test.py """
+    with open(BLOCK_EXAMPLE) as f:
+        return bytes.fromhex(f.read().strip())
+
+
+def split_transactions(data):
+    """ Split a concatenation of serialized transactions into a list of their raw bytes """
+    s = BytesIO(data)
+    txs = []
+    while s.tell() < len(data):
+        start = s.tell()
+        TxMessage.parse(s)
+        txs.append(data[start:s.tell()])
+    return txs
+
+
+def merkle_root(txids):
+    """ Plain merkle root over a list of 32-byte txids """
+    level = list(txids)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hash256(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def build_block(raw_txs, prev_block=b'\x00' * 32, timestamp=1715000000, bits=0x17034219, nonce=0):
+    """ Serialize a block from a list of raw transactions """
+    root = merkle_root([hash256(tx) for tx in raw_txs])
+    header = BLOCK_HEADER.pack(0x20000000, prev_block, root, timestamp, bits, nonce)
+    return b''.join([header, encode_varint(len(raw_txs))] + raw_txs)
+
+
+@lru_cache(maxsize=1)
+def sample_transactions():
+    """ Raw bytes of each complete transaction in BlockExample.txt """
+    return tuple(split_transactions(load_block_example_raw()[FRAGMENT_LENGTH:]))
+
+
+def load_block_example():
+    """ A well-formed block built from the transactions in BlockExample.txt """
+    return build_block(list(sample_transactions()))
+
+
+def build_chain(count, txs_per_block=4):
+    """ count small blocks linked by prev_block, filled with transactions from BlockExample.txt """
+    txs = sample_transactions()
+    blocks, prev_block = [], b'\x00' * 32
+    for i in range(count):
+        start = (i * txs_per_block) % (len(txs) - txs_per_block)
+        raw = build_block(list(txs[start:start + txs_per_block]), prev_block=prev_block,
+                          timestamp=1715000000 + 600 * i, nonce=i)
+        blocks.append(raw)
+        prev_block = hash256(raw[:80])
+    return blocks
+
+
+def build_tx(inputs, outputs, locktime=0):
+    """
+    Serialize a non-witness version 2 tx from (prevout hash, index, script_sig)
+    inputs and (value, script) outputs.
+    """
+    parts = [UINT32.pack(2), encode_varint(len(inputs))]
+    for prevout_hash, index, script_sig in inputs:
+        parts += [prevout_hash, UINT32.pack(index), encode_varint(len(script_sig)), script_sig, b'\xff\xff\xff\xff']
+    parts.append(encode_varint(len(outputs)))
+    for value, script in outputs:
+        parts += [UINT64.pack(value), encode_varint(len(script)), script]
+    parts.append(UINT32.pack(locktime))
+    return b''.join(parts)
+
+
+def p2pkh_script(seed):
+    return b'\x76\xa9\x14' + hash256(seed)[:20] + b'\x88\xac'
+
+
+def build_spending_chain(count, txs_per_block=100):
+    """
+    count blocks whose transactions spend outputs of earlier blocks, for UTXO set
+    tests and benchmarks. Each block has a coinbase with txs_per_block outputs;
+    tx j of a block spends output j of the previous coinbase and output 0 of tx j
+    in the previous block, and creates two outputs.
+    """
+    blocks, prev_block, prev_coinbase, prev_txids = [], b'\x00' * 32, None, []
+    for height in range(count):
+        coinbase = build_tx([(b'\x00' * 32, 0xffffffff, UINT32.pack(height))],
+                            [(50_000, p2pkh_script(b'cb%d' % j)) for j in range(txs_per_block)])
+        raw_txs, txids = [coinbase], []
+        if prev_coinbase is not None:
+            for j in range(txs_per_block):
+                inputs = [(prev_coinbase, j, b'')]
+                if prev_txids:
+                    inputs.append((prev_txids[j], 0, b''))
+                total = 50_000 + (20_000 if prev_txids else 0) - 1000  # pays a 1000 sat fee
+                raw_txs.append(build_tx(inputs, [(20_000, p2pkh_script(b'a%d' % j)),
+                                                 (total - 20_000, p2pkh_script(b'b%d' % height))]))
+                txids.append(hash256(raw_txs[-1]))
+        raw = build_block(raw_txs, prev_block=prev_block, timestamp=1715000000 + 600 * height, nonce=height)
+        blocks.append(raw)
+        prev_block, prev_coinbase, prev_txids = hash256(raw[:80]), hash256(coinbase), txids
+    return blocks
+
+
+def build_witness_tx(inputs, outputs, witnesses, locktime=0):
+    """ Like build_tx with a witness stack (list of items) per input; return (raw tx, txid) """
+    stripped = build_tx(inputs, outputs, locktime)
+    parts = [stripped[:4], b'\x00\x01', stripped[4:-4]]
+    for stack in witnesses:
+        parts.append(encode_varint(len(stack)))
+        for item in stack:
+            parts += [encode_varint(len(item)), item]
+    parts.append(stripped[-4:])
+    return b''.join(parts), hash256(stripped)
+
+
+def synthetic_block(seed=0, tx_count=2000, inputs=(1, 3), outputs=(1, 4), witness_share=0.5, witness_items=2,
+                    witness_size=(64, 73)):
+    """
+    A block of random but reproducible transactions: the same arguments always
+    give the same bytes. Each tx after the coinbase gets a number of inputs and
+    outputs drawn from the inputs and outputs ranges; a witness_share fraction of
+    them are segwit, with witness_items stack items per input of a size drawn from
+    witness_size. Non-witness inputs get a P2PKH-sized scriptSig.
+    """
+    rng = random.Random(seed)
+    randbytes = rng.randbytes
+    coinbase = build_tx([(b'\x00' * 32, 0xffffffff, randbytes(8))], [(625_000_000, p2pkh_script(b'cb'))])
+    raw_txs, txids = [coinbase], [hash256(coinbase)]
+    for _ in range(tx_count - 1):
+        segwit = rng.random() < witness_share
+        tx_inputs = [(randbytes(32), rng.randrange(4), b'' if segwit else randbytes(rng.randint(106, 108)))
+                     for _ in range(rng.randint(*inputs))]
+        tx_outputs = [(rng.randrange(546, 10 ** 9),
+                       b'\x00\x14' + randbytes(20) if segwit else p2pkh_script(randbytes(8)))
+                      for _ in range(rng.randint(*outputs))]
+        if segwit:
+            stacks = [[randbytes(rng.randint(*witness_size)) for _ in range(witness_items)] for _ in tx_inputs]
+            raw, txid = build_witness_tx(tx_inputs, tx_outputs, stacks)
+        else:
+            raw = build_tx(tx_inputs, tx_outputs)
+            txid = hash256(raw)
+        raw_txs.append(raw)
+        txids.append(txid)
+    header = BLOCK_HEADER.pack(0x20000000, randbytes(32), merkle_root(txids), 1715000000, 0x17034219, seed)
+    return b''.join([header, encode_varint(len(raw_txs))] + raw_txs)
+
+
+def mine_headers(count, bits=0x207fffff, prev_block=b'\x00' * 32, timestamp=1296688602):
+    """
+    count linked block headers that meet their proof of work, the first one on top
+    of prev_block. The default bits is regtest's easiest target, so about every
+    second nonce works.
+    """
+    target = bits_to_target(bits)
+    headers = []
+    for i in range(count):
+        nonce = 0
+        while True:
+            header = BLOCK_HEADER.pack(1, prev_block, hash256(prev_block), timestamp + 600 * i, bits, nonce)
+            block_hash = hash256(header)
+            if int.from_bytes(block_hash, 'little') <= target:
+                break
+            nonce += 1
+        headers.append(header)
+        prev_block = block_hash
+    return headers
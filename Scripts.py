@@ -0,0 +1,180 @@
+"""
+Standard output script templates and addresses.
+
+classify() recognizes the standard scriptPubKey forms by their fixed byte
+layout (no script interpreter): P2PKH, P2SH, P2WPKH, P2WSH, P2TR and OP_RETURN.
+Addresses are encoded and decoded with base58check (P2PKH, P2SH) and bech32 /
+bech32m (segwit v0 / v1+, BIP173 and BIP350).
+"""
+import hashlib
+
+from Utils import hash256
+
+P2PKH = 'p2pkh'
+P2SH = 'p2sh'
+P2WPKH = 'p2wpkh'
+P2WSH = 'p2wsh'
+P2TR = 'p2tr'
+OP_RETURN = 'op_return'
+NONSTANDARD = 'nonstandard'
+
+BASE58_PREFIXES = {'main': {P2PKH: 0x00, P2SH: 0x05}, 'test': {P2PKH: 0x6f, P2SH: 0xc4}}
+BECH32_HRPS = {'main': 'bc', 'test': 'tb'}
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_CONST, BECH32M_CONST = 1, 0x2bc830a3
+
+
+def classify(script):
+    """ (type, payload) of a scriptPubKey: the hash, witness program or OP_RETURN data it carries """
+    n = len(script)
+    if n == 25 and script[0] == 0x76 and script[1] == 0xa9 and script[2] == 0x14 and script[23] == 0x88 \
+            and script[24] == 0xac:
+        return P2PKH, bytes(script[3:23])
+    if n == 23 and script[0] == 0xa9 and script[1] == 0x14 and script[22] == 0x87:
+        return P2SH, bytes(script[2:22])
+    if n == 22 and script[0] == 0x00 and script[1] == 0x14:
+        return P2WPKH, bytes(script[2:])
+    if n == 34 and script[1] == 0x20:
+        if script[0] == 0x00:
+            return P2WSH, bytes(script[2:])
+        if script[0] == 0x51:
+            return P2TR, bytes(script[2:])
+    if n and script[0] == 0x6a:
+        return OP_RETURN, bytes(script[1:])
+    return NONSTANDARD, b''
+
+
+def script_hash(script):
+    """ Key under which a script is indexed (SHA256, as used by Electrum servers) """
+    return hashlib.sha256(script).digest()
+
+
+def base58check_encode(payload):
+    payload = bytes(payload)
+    data = payload + hash256(payload)[:4]
+    n = int.from_bytes(data, 'big')
+    chars = []
+    while n:
+        n, r = divmod(n, 58)
+        chars.append(BASE58_ALPHABET[r])
+    zeros = len(data) - len(data.lstrip(b'\x00'))
+    return '1' * zeros + ''.join(reversed(chars))
+
+
+def base58check_decode(s):
+    n = 0
+    for c in s:
+        if c not in BASE58_ALPHABET:
+            raise ValueError("invalid base58 character %r" % (c,))
+        n = n * 58 + BASE58_ALPHABET.index(c)
+    zeros = len(s) - len(s.lstrip('1'))
+    data = b'\x00' * zeros + (n.to_bytes((n.bit_length() + 7) // 8, 'big') if n else b'')
+    payload, checksum = data[:-4], data[-4:]
+    if len(data) < 5 or hash256(payload)[:4] != checksum:
+        raise ValueError("bad base58check checksum")
+    return payload
+
+
+BECH32_GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+
+
+def bech32_table():
+    """ For each value of the 5 bits shifted out of the checksum, the XOR of the generator terms they select """
+    table = []
+    for top in range(32):
+        term = 0
+        for i in range(5):
+            if (top >> i) & 1:
+                term ^= BECH32_GENERATOR[i]
+        table.append(term)
+    return tuple(table)
+
+
+BECH32_TABLE = bech32_table()
+
+
+def bech32_polymod(values):
+    chk = 1
+    table = BECH32_TABLE
+    for v in values:
+        chk = ((chk & 0x1ffffff) << 5 ^ v) ^ table[chk >> 25]
+    return chk
+
+
+def bech32_hrp_expand(hrp):
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def convert_bits(data, from_bits, to_bits, pad=True):
+    acc, bits, out = 0, 0, []
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            out.append((acc >> bits) & ((1 << to_bits) - 1))
+    if pad and bits:
+        out.append((acc << (to_bits - bits)) & ((1 << to_bits) - 1))
+    elif not pad and (bits >= from_bits or (acc << (to_bits - bits)) & ((1 << to_bits) - 1)):
+        raise ValueError("invalid padding in bech32 data")
+    return out
+
+
+def segwit_encode(hrp, version, program):
+    data = [version] + convert_bits(program, 8, 5)
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def segwit_decode(address):
+    """ (hrp, witness version, witness program) of a bech32/bech32m address """
+    if address.lower() != address and address.upper() != address:
+        raise ValueError("mixed case bech32 address")
+    address = address.lower()
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address) or len(address) > 90:
+        raise ValueError("malformed bech32 address")
+    hrp = address[:pos]
+    if any(c not in BECH32_CHARSET for c in address[pos + 1:]):
+        raise ValueError("invalid bech32 character")
+    data = [BECH32_CHARSET.index(c) for c in address[pos + 1:]]
+    version = data[0]
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    if bech32_polymod(bech32_hrp_expand(hrp) + data) != const:
+        raise ValueError("bad bech32 checksum")
+    program = bytes(convert_bits(data[1:-6], 5, 8, pad=False))
+    if version > 16 or not 2 <= len(program) <= 40 or (version == 0 and len(program) not in (20, 32)):
+        raise ValueError("invalid witness program")
+    return hrp, version, program
+
+
+def script_to_address(script, net='main'):
+    """ Address of a standard scriptPubKey, or None for OP_RETURN and nonstandard scripts """
+    kind, payload = classify(script)
+    if kind in (P2PKH, P2SH):
+        return base58check_encode(bytes([BASE58_PREFIXES[net][kind]]) + payload)
+    if kind in (P2WPKH, P2WSH):
+        return segwit_encode(BECH32_HRPS[net], 0, payload)
+    if kind == P2TR:
+        return segwit_encode(BECH32_HRPS[net], 1, payload)
+    return None
+
+
+def address_to_script(address, net='main'):
+    """ The scriptPubKey paying to address; raises ValueError for invalid addresses """
+    hrp = BECH32_HRPS[net]
+    if address.lower().startswith(hrp + '1'):
+        _, version, program = segwit_decode(address)
+        return bytes([version + 0x50 if version else 0, len(program)]) + program
+    payload = base58check_decode(address)
+    if len(payload) != 21:
+        raise ValueError("invalid base58 address length")
+    prefixes = BASE58_PREFIXES[net]
+    if payload[0] == prefixes[P2PKH]:
+        return b'\x76\xa9\x14' + payload[1:] + b'\x88\xac'
+    if payload[0] == prefixes[P2SH]:
+        return b'\xa9\x14' + payload[1:] + b'\x87'
+    raise ValueError("address is not for the %s network" % (net,))
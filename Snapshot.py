@@ -0,0 +1,222 @@
+"""
+Session snapshot for warm restarts.
+
+Written on shutdown and mapped back with mmap on the next start, it holds:
+
+ - the peers this client completed a handshake with, with a latency score
+   (moving average of handshake times, counting failed connections against
+   the peer), so the next session dials the fastest known peers before
+   asking a DNS seed
+ - the last tip seen, as (height or -1 if unknown, block hash)
+ - up to capacity inventory hashes, this session's newest first, so items
+   fetched before are not requested again
+
+File layout: a header, fixed-size peer records, then the inventory hashes
+sorted, 32 bytes each. Membership is a binary search over the mapping, so
+loading costs the same whatever the number of hashes. The file is replaced
+atomically; a missing file is an empty snapshot.
+"""
+import mmap
+import os
+import socket
+import struct
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from itertools import islice
+
+SNAPSHOT_MAGIC = b'BVSS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sB3xIIi32s')  # magic, version, peer count, hash count, tip height, tip hash
+PEER_RECORD = struct.Struct('<16sHfII')  # IPv6 (or IPv4-mapped) address, port, latency, last seen, failures
+HASH_SIZE = 32
+IPV4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+LATENCY_WEIGHT = 0.3  # weight of a new handshake time in the moving average
+FAILURE_PENALTY = 3.0  # seconds added to a peer's score per failed connection, about what a connect timeout costs
+
+
+def pack_address(host):
+    """ 16-byte form of an IPv4 or IPv6 address """
+    try:
+        return IPV4_MAPPED + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        return socket.inet_pton(socket.AF_INET6, host)
+
+
+def unpack_address(packed):
+    if packed[:12] == IPV4_MAPPED:
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+@dataclass(slots=True)
+class PeerScore:
+    host: str
+    port: int
+    latency: float  # seconds, moving average of handshake times
+    last_seen: int = 0  # unix time of the last handshake
+    failures: int = 0  # failed connections since the last handshake
+
+    def score(self):
+        """ Lower is better """
+        return self.latency + FAILURE_PENALTY * self.failures
+
+
+class SortedHashes:
+    """ Read-only sequence over the sorted 32-byte hashes of a buffer, for bisect """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.count = len(buf) // HASH_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.buf[i * HASH_SIZE:(i + 1) * HASH_SIZE].tobytes()
+
+    def __contains__(self, h):
+        i = bisect_left(self, h)
+        return i < self.count and self[i] == h
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+
+class SeenInventory:
+    """
+    Inventory hashes of the last session (mapped, sorted) plus up to capacity
+    added in this one; the oldest added are forgotten first.
+    """
+
+    def __init__(self, previous=None, capacity: int = 50_000):
+        self.previous = SortedHashes(previous if previous is not None else memoryview(b''))
+        self.capacity = capacity
+        self.added = {}  # hash -> None, in the order added
+
+    def __contains__(self, h):
+        return h in self.added or h in self.previous
+
+    def __len__(self):
+        return len(self.previous) + len(self.added)
+
+    def add(self, h):
+        """ Add a hash, return False if it was already seen """
+        h = bytes(h)
+        if h in self:
+            return False
+        self.added[h] = None
+        if len(self.added) > self.capacity:
+            del self.added[next(iter(self.added))]
+        return True
+
+    def kept(self):
+        """
+        Sorted hashes to save, up to capacity: all added in this session, then
+        the last session's. Those are stored sorted, without their order, so when
+        they don't all fit the ones kept are simply the first in hash order.
+        """
+        keep = list(self.added)
+        room = self.capacity - len(keep)
+        if room > 0:
+            keep += islice(self.previous, room)  # never in added: add() skips hashes seen last session
+        return sorted(keep)
+
+
+class Snapshot:
+    def __init__(self, peers=(), tip=None, inventory=None, capacity: int = 50_000, max_peers: int = 64):
+        self.peers = {(peer.host, peer.port): peer for peer in peers}
+        self.tip = tip  # (height or -1, block hash) of the last block seen
+        self.seen = SeenInventory(inventory, capacity)
+        self.max_peers = max_peers
+        self.mapping = None  # mmap of the loaded file, while its hashes are used
+
+    @classmethod
+    def load(cls, path, capacity: int = 50_000):
+        """ Map a snapshot file; a missing or empty file gives an empty snapshot, a damaged one raises ValueError """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return cls(capacity=capacity)
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(capacity=capacity)
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        try:
+            if len(view) < SNAPSHOT_HEADER.size:
+                raise ValueError("truncated snapshot header")
+            magic, version, peer_count, hash_count, tip_height, tip_hash = SNAPSHOT_HEADER.unpack_from(view)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(f"not a version {SNAPSHOT_VERSION} snapshot: {path}")
+            hashes_at = SNAPSHOT_HEADER.size + peer_count * PEER_RECORD.size
+            if len(view) != hashes_at + hash_count * HASH_SIZE:
+                raise ValueError(f"snapshot size doesn't match its header: {path}")
+            peers = []
+            for offset in range(SNAPSHOT_HEADER.size, hashes_at, PEER_RECORD.size):
+                address, port, latency, last_seen, failures = PEER_RECORD.unpack_from(view, offset)
+                peers.append(PeerScore(unpack_address(address), port, latency, last_seen, failures))
+        except ValueError:
+            view.release()
+            mapping.close()
+            raise
+        tip = None if tip_hash == b'\x00' * 32 else (tip_height, tip_hash)
+        snapshot = cls(peers, tip, view[hashes_at:], capacity)
+        snapshot.mapping = mapping
+        return snapshot
+
+    def record_peer(self, host, port, latency):
+        """ A completed handshake with host:port that took latency seconds; host names are not recorded """
+        try:
+            pack_address(host)
+        except OSError:
+            return
+        peer = self.peers.get((host, port))
+        if peer is None:
+            self.peers[(host, port)] = PeerScore(host, port, latency, int(time.time()))
+            return
+        peer.latency += LATENCY_WEIGHT * (latency - peer.latency)
+        peer.last_seen = int(time.time())
+        peer.failures = 0
+
+    def peer_failed(self, host, port):
+        peer = self.peers.get((host, port))
+        if peer is not None:
+            peer.failures += 1
+
+    def best_peers(self, n: int = None):
+        """ (host, port) of known peers, best score first """
+        ranked = sorted(self.peers.values(), key=PeerScore.score)
+        return [(peer.host, peer.port) for peer in ranked[:n]]
+
+    def set_tip(self, block_hash, height: int = None):
+        self.tip = (-1 if height is None else height, bytes(block_hash))
+
+    def encode(self):
+        peers = sorted(self.peers.values(), key=PeerScore.score)[:self.max_peers]
+        hashes = self.seen.kept()
+        height, tip_hash = self.tip or (-1, b'\x00' * 32)
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(peers), len(hashes), height, tip_hash)]
+        parts += [PEER_RECORD.pack(pack_address(peer.host), peer.port, peer.latency, peer.last_seen, peer.failures)
+                  for peer in peers]
+        parts += hashes
+        return b''.join(parts)
+
+    def save(self, path):
+        """ Write the snapshot to path atomically """
+        data = self.encode()
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return len(data)
+
+    def close(self):
+        """ Release the mapping; hashes of the last session are no longer known afterwards """
+        if self.mapping is not None:
+            self.seen.previous.buf.release()
+            self.seen.previous = SortedHashes(memoryview(b''))
+            self.mapping.close()
+            self.mapping = None
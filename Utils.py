@@ -1,4 +1,13 @@
 
+import hashlib
+import struct
+
+# precompiled fixed-width decoders for the buffer (offset cursor) parse path
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+
 # helper functions
 def decode_int(s, nbytes, encoding='little'):
     return int.from_bytes(s.read(nbytes), encoding)
@@ -20,6 +29,19 @@ def decode_varint(s):
         return i
 
 
+def read_varint(b, offset):
+    """ Decode a varint from buffer b at offset, return (value, offset after it) """
+    i = b[offset]
+    if i < 0xfd:
+        return i, offset + 1
+    elif i == 0xfd:
+        return UINT16.unpack_from(b, offset + 1)[0], offset + 3
+    elif i == 0xfe:
+        return UINT32.unpack_from(b, offset + 1)[0], offset + 5
+    else:
+        return UINT64.unpack_from(b, offset + 1)[0], offset + 9
+
+
 def encode_varint(i):
     if i < 0xfd:
         return bytes([i])
@@ -32,4 +54,40 @@ def encode_varint(i):
     else:
         raise ValueError("integer too large: %d" % (i,))
 
+
+def varint_size(i):
+    """ Length of encode_varint(i) """
+    return 1 if i < 0xfd else 3 if i < 0x10000 else 5 if i < 0x100000000 else 9
+
+
+def write_varint(b, offset, i):
+    """ Encode a varint into buffer b at offset, return the offset after it """
+    if i < 0xfd:
+        b[offset] = i
+        return offset + 1
+    encoded = encode_varint(i)
+    b[offset:offset + len(encoded)] = encoded
+    return offset + len(encoded)
+
 # -----------------------------------------------------------------------------
+
+
+def hash256(b):
+    """ Bitcoin's double-SHA256 """
+    return hashlib.sha256(hashlib.sha256(b).digest()).digest()
+
+
+def bits_to_target(bits):
+    """ Expand the compact 'bits' encoding of a block header into the full target """
+    exponent = (bits >> 24)
+    mantissa = bits & 0x007fffff
+
+    # Calculate the full target based on the mantissa and exponent
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def target_to_work(target):
+    """ Expected number of hashes to find a block at this target, as summed up in chainwork """
+    return (1 << 256) // (target + 1)
@@ -0,0 +1,222 @@
+"""
+UTXO set: the unspent outputs left by the blocks applied so far, so inputs can
+be resolved to the value and script they spend.
+
+Outputs are keyed by the first 12 bytes of their txid plus the output index as
+a varint, and stored as an 8-byte amount followed by the script. The set lives
+in a sqlite file; a write-back cache in front of it collects the changes of
+several blocks and writes them in one transaction. Outputs created and spent
+between two flushes never reach the file.
+
+Each applied block leaves an undo journal (the outputs it created and the ones
+it spent, in order), so blocks can be disconnected from the tip on a reorg.
+"""
+import sqlite3
+
+from MessageHandler import Output
+from Utils import UINT64, encode_varint, read_varint
+
+KEY_TXID_BYTES = 12  # 96 bits of txid: collisions are not a practical concern
+NULL_HASH = b'\x00' * 32
+OP_RETURN = 0x6a
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS utxo (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS undo (height INTEGER PRIMARY KEY, block_hash BLOB, prev_block BLOB, journal BLOB);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB);
+"""
+
+
+def outpoint_key(txid, index):
+    return bytes(txid[:KEY_TXID_BYTES]) + encode_varint(index)
+
+
+def pack_output(value, script):
+    return UINT64.pack(value) + bytes(script)
+
+
+def unpack_output(packed):
+    return Output(UINT64.unpack_from(packed)[0], packed[8:])
+
+
+def is_coinbase(tx):
+    return len(tx.inputs) == 1 and tx.inputs[0].prevout_index == 0xffffffff and tx.inputs[0].prevout_hash == NULL_HASH
+
+
+def encode_journal(ops):
+    """ ops is a list of (key, packed output) for spent outputs and (key, None) for created ones """
+    parts = []
+    for key, value in ops:
+        parts += [encode_varint(len(key)), key]
+        parts += [b'\x00'] if value is None else [encode_varint(len(value) + 1), value]
+    return b''.join(parts)
+
+
+def decode_journal(b):
+    ops, offset = [], 0
+    while offset < len(b):
+        length, offset = read_varint(b, offset)
+        key = bytes(b[offset:offset + length])
+        length, offset = read_varint(b, offset + length)
+        value = bytes(b[offset:offset + length - 1]) if length else None
+        ops.append((key, value))
+        offset += max(length - 1, 0)
+    return ops
+
+
+class UtxoSet:
+    def __init__(self, path: str, flush_every: int = 100, max_dirty: int = 500_000,
+                 cache_size: int = 2_000_000, keep_undo: int = 288):
+        self.flush_every = flush_every  # flush after this many blocks...
+        self.max_dirty = max_dirty  # ...or once this many outputs changed, whichever comes first
+        self.cache_size = cache_size  # entries kept in memory after a flush
+        self.keep_undo = keep_undo  # blocks below the tip that can still be disconnected
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.cache = {}  # key -> packed output, or None if spent but still in the file
+        self.dirty = set()  # keys whose cache entry is not in the file yet
+        self.fresh = set()  # dirty keys that were never in the file
+        self.pending_undo = {}  # height -> (block hash, prev block, journal), not in the file yet
+        self.blocks_since_flush = 0
+        meta = dict(self.db.execute('SELECT name, value FROM meta'))
+        self.height = int(meta.get('height', -1))
+        self.tip = meta.get('tip', NULL_HASH)
+
+    def lookup(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        row = self.db.execute('SELECT value FROM utxo WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.cache[key] = row[0]
+        return row[0]
+
+    def get(self, txid, index):
+        """ The unspent Output at (txid, index), or None """
+        packed = self.lookup(outpoint_key(txid, index))
+        return None if packed is None else unpack_output(packed)
+
+    def input_values(self, tx):
+        """ Value of each output tx spends, None for a coinbase or if one isn't in the set """
+        if is_coinbase(tx):
+            return None
+        values = []
+        for tx_in in tx.inputs:
+            packed = self.lookup(outpoint_key(tx_in.prevout_hash, tx_in.prevout_index))
+            if packed is None:
+                return None
+            values.append(UINT64.unpack_from(packed)[0])
+        return values
+
+    def fee(self, tx):
+        """ Fee paid by tx in satoshis, or None if its inputs are unknown; usable as Mempool's fee_lookup """
+        values = self.input_values(tx)
+        return None if values is None else sum(values) - sum(o.value for o in tx.outputs)
+
+    def create(self, key, packed):
+        if key not in self.cache:
+            self.fresh.add(key)
+        self.cache[key] = packed
+        self.dirty.add(key)
+
+    def remove(self, key):
+        if key in self.fresh:
+            del self.cache[key]
+            self.fresh.discard(key)
+            self.dirty.discard(key)
+        else:
+            self.cache[key] = None
+            self.dirty.add(key)
+
+    def revert(self, ops):
+        """ Undo journal ops, last first """
+        for key, packed in reversed(ops):
+            if packed is None:
+                self.remove(key)
+            else:
+                self.cache[key] = packed
+                self.dirty.add(key)
+
+    def apply_block(self, block):
+        """
+        Spend the inputs and add the outputs of every transaction in block, on top of
+        the current tip. Raises ValueError, leaving the set unchanged, if the block
+        doesn't extend the tip or spends an output that isn't in the set.
+        """
+        if self.height >= 0 and block.prev_block != self.tip:
+            raise ValueError("block does not extend the tip")
+        ops = []
+        try:
+            for tx in block.transactions:
+                if not is_coinbase(tx):
+                    for tx_in in tx.inputs:
+                        key = outpoint_key(tx_in.prevout_hash, tx_in.prevout_index)
+                        packed = self.lookup(key)
+                        if packed is None:
+                            raise ValueError("input spends unknown output %s:%d"
+                                             % (bytes(tx_in.prevout_hash)[::-1].hex(), tx_in.prevout_index))
+                        self.remove(key)
+                        ops.append((key, packed))
+                txid = tx.txid
+                for index, tx_out in enumerate(tx.outputs):
+                    if tx_out.script_pubkey[:1] == bytes([OP_RETURN]):
+                        continue  # provably unspendable
+                    key = outpoint_key(txid, index)
+                    self.create(key, pack_output(tx_out.value, tx_out.script_pubkey))
+                    ops.append((key, None))
+        except ValueError:
+            self.revert(ops)
+            raise
+        self.height += 1
+        self.pending_undo[self.height] = (block.hash(), bytes(block.prev_block), encode_journal(ops))
+        self.tip = block.hash()
+        self.blocks_since_flush += 1
+        if self.blocks_since_flush >= self.flush_every or len(self.dirty) >= self.max_dirty:
+            self.flush()
+
+    def undo_block(self):
+        """ Disconnect the tip block, return the hash of the new tip """
+        undo = self.pending_undo.pop(self.height, None)
+        if undo is None:
+            undo = self.db.execute('SELECT block_hash, prev_block, journal FROM undo WHERE height = ?',
+                                   (self.height,)).fetchone()
+            if undo is None or undo[0] != self.tip:
+                raise ValueError("no undo data for height %d" % (self.height,))
+        block_hash, prev_block, journal = undo
+        self.revert(decode_journal(journal))
+        self.height -= 1
+        self.tip = prev_block
+        return self.tip
+
+    def flush(self):
+        """ Write all cached changes, undo journals and the tip in one transaction """
+        upserts = [(key, self.cache[key]) for key in self.dirty if self.cache[key] is not None]
+        deletes = [(key,) for key in self.dirty if self.cache[key] is None]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO utxo VALUES (?, ?)', upserts)
+            self.db.executemany('DELETE FROM utxo WHERE key = ?', deletes)
+            self.db.executemany('INSERT OR REPLACE INTO undo VALUES (?, ?, ?, ?)',
+                                [(height,) + undo for height, undo in self.pending_undo.items()])
+            self.db.execute('DELETE FROM undo WHERE height < ? OR height > ?',
+                            (self.height - self.keep_undo, self.height))
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                [('height', str(self.height)), ('tip', self.tip)])
+        for (key,) in deletes:
+            del self.cache[key]
+        self.dirty.clear()
+        self.fresh.clear()
+        self.pending_undo.clear()
+        self.blocks_since_flush = 0
+        if len(self.cache) > self.cache_size:
+            self.cache.clear()
+
+    def __len__(self):
+        """ Number of unspent outputs (flushes first) """
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM utxo').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.db.close()
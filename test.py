@@ -21,3 +21,1072 @@ def test_block_parse():
 
 # Run the test function
 test_block_parse()
+
+
+def test_block_parse_from_matches_parse():
+    import io
+    import pytest
+    from SampleData import load_block_example
+
+    data = load_block_example()
+    block, end = BlockMessage.parse_from(data)
+    assert end == len(data)
+    assert block == BlockMessage.parse(io.BytesIO(data))
+    assert isinstance(block.transactions[0].inputs[0].script_sig, memoryview)
+
+    with pytest.raises(ValueError):
+        BlockMessage.parse_from(data[:-1])
+
+
+def test_segwit_tx_parse_and_hashes():
+    import io
+    from MessageHandler import TxMessage
+    from SampleData import load_block_example_raw, split_transactions, FRAGMENT_LENGTH
+    from Utils import encode_varint, hash256
+
+    legacy = split_transactions(load_block_example_raw()[FRAGMENT_LENGTH:])[0]
+    tx, _ = TxMessage.parse_from(legacy)
+    # turn it into a segwit serialization: marker/flag after the version, witnesses before the locktime
+    witness = b''.join(encode_varint(2) + b'\x01\xaa' + b'\x02\xbb\xcc' for _ in tx.inputs)
+    segwit = legacy[:4] + b'\x00\x01' + legacy[4:-4] + witness + legacy[-4:]
+
+    for parsed in (TxMessage.parse(io.BytesIO(segwit)), TxMessage.parse_from(segwit)[0]):
+        assert parsed.is_segwit and not tx.is_segwit
+        assert parsed.outputs == tx.outputs
+        assert [i.prevout_hash for i in parsed.inputs] == [i.prevout_hash for i in tx.inputs]
+        assert parsed.inputs[0].witness == (b'\xaa', b'\xbb\xcc')
+        assert parsed.txid == tx.txid == hash256(legacy)
+        assert parsed.wtxid == hash256(segwit) != parsed.txid
+        assert tx.wtxid == tx.txid
+
+
+def test_lazy_block():
+    import pytest
+    from MessageHandler import LazyBlock
+    from SampleData import load_block_example
+    from Utils import encode_varint
+
+    data = load_block_example()
+    eager, _ = BlockMessage.parse_from(data)
+    lazy, end = LazyBlock.parse_from(data, cache_size=2)
+    assert end == len(data)
+    assert lazy.merkle_root == eager.merkle_root
+    assert len(lazy.transactions) == len(eager.transactions)
+    assert lazy.transactions[-1] == eager.transactions[-1]
+    assert list(lazy.transactions) == eager.transactions
+    assert len(lazy.transactions.cache) == 2
+    assert lazy.transactions.raw(0) == eager.transactions[0]._raw
+    lazy.transactions.sweep()
+    assert not lazy.transactions.kept  # nothing else holds the evicted txs anymore
+
+    # edits survive eviction: held txs and invalidated ones are kept outside the cache
+    held = lazy.transactions[1]
+    lazy.transactions[2].version = 3
+    lazy.transactions[2].invalidate()
+    for tx in lazy.transactions[3:6]:
+        pass
+    lazy.transactions.sweep()
+    assert sorted(lazy.transactions.kept) == [1, 2]  # 1 is still held, 2 was edited
+    held.locktime = 7
+    held.invalidate()
+    del held
+    lazy.transactions.sweep()
+    assert sorted(lazy.transactions.kept) == [1, 2]
+    lazy.invalidate()
+    edited = BlockMessage.parse_from(lazy.encode())[0]
+    assert edited.transactions[1].locktime == 7 and edited.transactions[2].version == 3
+    assert edited.transactions[3] == eager.transactions[3]
+
+    # a tx count the payload can't hold is rejected before anything is allocated
+    for count in (2 ** 40, 2 ** 62):
+        with pytest.raises(ValueError):
+            LazyBlock.parse_from(data[:80] + encode_varint(count) + b'\x00' * 8)
+
+
+def test_compact_tx_roundtrip():
+    from CompactTx import FrozenTxMessage, SlotTxMessage, TxBatch
+    from MessageHandler import Input, Output, TxMessage
+    from SampleData import load_block_example
+
+    txs = BlockMessage.parse_from(load_block_example())[0].transactions[:50]
+    txs.append(TxMessage(2, [Input(b'\x11' * 32, 3, b'', 0xfffffffd, (b'\x01', b''))], [Output(5, b'\x6a')], 0))
+    batch = TxBatch.from_txs(txs)
+    assert len(batch) == len(txs)
+    assert list(batch) == txs
+    assert batch.total_value(0) == sum(o.value for o in txs[0].outputs)
+    for tx in txs:
+        assert SlotTxMessage.from_tx(tx).to_tx() == tx
+        assert FrozenTxMessage.from_tx(tx).to_tx() == tx
+    assert hash(FrozenTxMessage.from_tx(txs[0])) == hash(FrozenTxMessage.from_tx(txs[0]))
+
+
+def test_async_node_against_fake_peer():
+    import asyncio
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+    from SampleData import load_block_example
+    from Utils import hash256
+
+    data = load_block_example()
+    expected, _ = BlockMessage.parse_from(data)
+    tx_raw = expected.transactions[1]._raw
+
+    async def run():
+        inventory = {(2, hash256(data[:80])): data, (1, expected.transactions[1].txid): tx_raw}
+        peer = await FakePeer(inventory=inventory).start()
+        peer.extra = [(b'ping', b'\x07' * 8)]
+        node = AsyncNode('127.0.0.1', peer.port)
+        blocks, txs = asyncio.Queue(), asyncio.Queue()
+        node.on_block, node.on_tx = blocks.put_nowait, txs.put_nowait
+        await node.connect()
+        try:
+            await asyncio.wait_for(node.handshake_done.wait(), 5)
+            block = await asyncio.wait_for(blocks.get(), 5)
+            tx = await asyncio.wait_for(txs.get(), 5)
+        finally:
+            await node.close()
+            await peer.close()
+        return block, tx, peer.received
+
+    block, tx, received = asyncio.run(run())
+    assert block == expected
+    assert tx == expected.transactions[1]
+    assert received.count(b'getdata') == 1 and b'pong' in received and b'verack' in received
+
+
+def test_peer_group_fetches_each_item_once_and_replaces_stalled_peers():
+    import asyncio
+    from FakePeer import FakePeer
+    from PeerGroup import PeerGroup
+    from SampleData import load_block_example
+    from Utils import hash256
+
+    data = load_block_example()
+    block, _ = BlockMessage.parse_from(data)
+    inventory = {(2, hash256(data[:80])): data}
+    inventory.update({(1, tx.txid): tx._raw for tx in block.transactions[:10]})
+
+    async def run(delays):
+        peers = [await FakePeer(inventory=inventory, delay=delay).start() for delay in delays]
+        group = PeerGroup([('127.0.0.1', peer.port) for peer in peers], size=3, request_timeout=0.5)
+        got = []
+        group.on_tx = group.on_block = got.append
+        await group.start()
+        try:
+            for _ in range(200):
+                if len(got) == len(inventory):
+                    break
+                await asyncio.sleep(0.05)
+            connected = {node.port for node in group.peers}
+        finally:
+            await group.close()
+            for peer in peers:
+                await peer.close()
+        return got, peers, connected
+
+    got, peers, _ = asyncio.run(run([0, 0, 0]))
+    assert len(got) == len(inventory)
+    assert sorted(item for peer in peers for item in peer.requested) == sorted(inventory)
+
+    # the first peer never answers in time: its items go elsewhere and the spare address replaces it
+    got, peers, connected = asyncio.run(run([30, 0, 0, 0]))
+    assert len(got) == len(inventory)
+    assert peers[0].port not in connected and peers[3].port in connected
+
+
+def test_peer_group_reassigns_notfound_and_bad_blocks_without_stalling():
+    import asyncio
+    from FakePeer import FakePeer
+    from PeerGroup import PeerGroup
+    from SampleData import build_chain
+    from Utils import hash256
+
+    raws = build_chain(3, 4)
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in raws]
+    txs = blocks[0].transactions
+    good = {(1, tx.txid): tx.encode() for tx in txs}
+    good.update({(2, block.hash()): raw for block, raw in zip(blocks, raws)})
+    # the first peer has none of the transactions and serves blocks with a transaction missing
+    bad = {(1, tx.txid): None for tx in txs}
+    bad.update({(2, block.hash()): raw[:80] + b'\x03' + bytes(block.transactions[0].encode())
+                + b''.join(bytes(tx.encode()) for tx in block.transactions[2:])
+                for block, raw in zip(blocks, raws)})
+    bad[(1, b'\x07' * 32)] = None  # nobody has this one
+
+    async def run():
+        peers = [await FakePeer(inventory=bad).start(), await FakePeer(inventory=good).start()]
+        group = PeerGroup([('127.0.0.1', peer.port) for peer in peers], size=2, request_timeout=30)
+        got = []
+        group.on_tx = group.on_block = got.append
+        await group.start()
+        try:
+            for _ in range(100):
+                if len(got) == len(good) and (1, b'\x07' * 32) not in group.seen:
+                    break
+                await asyncio.sleep(0.05)
+            connected = {node.port for node in group.peers}
+        finally:
+            await group.close()
+            for peer in peers:
+                await peer.close()
+        return got, peers, connected
+
+    got, peers, connected = asyncio.run(run())
+    assert sorted(hash256(bytes(obj.encode()[:80])) if isinstance(obj, BlockMessage) else obj.txid for obj in got) \
+        == sorted(item[1] for item in good)
+    assert connected == {peer.port for peer in peers}  # refusals are not stalls: nobody was replaced
+    assert peers[0].requested  # the bad peer was asked and refused
+
+
+def test_envelope_framer():
+    import pytest
+    from Handshake import EnvelopeFramer, NetworkEnvelope
+    from SampleData import load_block_example
+
+    data = load_block_example()
+    stream = b''.join(NetworkEnvelope(command, payload, 'main').encode()
+                      for command, payload in [(b'ping', b'\x01' * 8), (b'verack', b''), (b'block', data)])
+    framer = EnvelopeFramer('main', recv_buffer_size=1000)
+    envelopes = []
+    for i in range(0, len(stream), 997):
+        chunk = stream[i:i + 997]
+        framer.recv_view[:len(chunk)] = chunk
+        envelopes += framer.feed_received(len(chunk))
+    assert [env.command for env in envelopes] == [b'ping', b'verack', b'block']
+    assert isinstance(envelopes[2].payload, memoryview) and envelopes[2].payload == data
+    assert BlockMessage.parse_from(envelopes[2].payload)[0] == BlockMessage.parse_from(data)[0]
+
+    with pytest.raises(ValueError):
+        EnvelopeFramer('main').feed(NetworkEnvelope(b'ping', b'\x01' * 9, 'main').encode()[:24])
+    corrupted = bytearray(NetworkEnvelope(b'ping', b'\x01' * 8, 'main').encode())
+    corrupted[-1] ^= 1
+    with pytest.raises(ValueError):
+        EnvelopeFramer('main').feed(corrupted)
+    with pytest.raises(ValueError, match="magic"):  # a peer on another network
+        EnvelopeFramer('main').feed(NetworkEnvelope(b'ping', b'\x01' * 8, 'test').encode())
+
+
+def test_block_store(tmp_path):
+    import os
+    from BlockStore import BlockStore
+    from SampleData import build_chain
+    from Utils import hash256
+
+    chain = build_chain(30)
+    store = BlockStore(str(tmp_path), max_segment_size=20_000)
+    hashes = [store.put(raw) for raw in chain]
+    assert store.put(chain[0]) == hashes[0] and len(store) == 30
+    assert os.path.exists(tmp_path / 'blk00001.dat')
+    store.close()
+
+    store = BlockStore(str(tmp_path))
+    assert bytes(store.get_raw(hashes[17])) == chain[17]
+    assert store.get_by_height(29).hash() == hashes[29] == hash256(chain[29][:80])
+    assert store.get_block(hashes[3]).transactions[1] == BlockMessage.parse_from(chain[3])[0].transactions[1]
+    os.remove(tmp_path / 'index.dat')
+    store.close()
+
+    store = BlockStore(str(tmp_path))
+    assert len(store) == 0
+    assert store.rebuild_index() == 30
+    assert bytes(store.get_raw(hashes[29])) == chain[29] and store.index[hashes[29]].height == 29
+    store.close()
+
+
+def test_block_store_late_parents_and_writes_after_rebuild(tmp_path):
+    import os
+    import pytest
+    from BlockStore import UNKNOWN_HEIGHT, BlockStore
+    from SampleData import build_chain
+    from Utils import hash256
+
+    chain = build_chain(12)
+    hashes = [hash256(raw[:80]) for raw in chain]
+    store = BlockStore(str(tmp_path), max_segment_size=5_000)
+    for raw in chain[5:10]:  # descendants first, their heights unknown until the parents arrive
+        store.put(raw)
+    assert store.index[hashes[9]].height == UNKNOWN_HEIGHT and store.get_by_height(9) is None
+    for raw in chain[:5]:
+        store.put(raw)
+    assert [store.index[h].height for h in hashes[:10]] == list(range(10)) and not store.orphans
+    store.close()
+    store = BlockStore(str(tmp_path))
+    assert store.get_by_height(9).hash() == hashes[9]
+
+    # a torn record at the end of the last segment is cut off, new blocks follow the last whole one
+    last = store.segment_path(store.file_number)
+    store.close()
+    with open(last, 'ab') as f:
+        f.write(chain[10][:50])
+    os.remove(tmp_path / 'index.dat')
+    store = BlockStore(str(tmp_path))
+    assert store.rebuild_index() == 10 and store.file_number > 0 and store.segment.name == last
+    store.put(chain[10])
+    store.put(chain[11])
+    assert store.rebuild_index() == 12 and store.get_by_height(11).hash() == hashes[11]
+
+    # a malformed block is refused before anything is written; a failed rebuild leaves the store usable
+    sizes = [os.path.getsize(store.segment_path(store.file_number)), os.path.getsize(tmp_path / 'index.dat')]
+    with pytest.raises(ValueError):
+        store.put(chain[11][:76] + b'\x99' * 4 + b'\xff' * 30)  # a new header over garbage
+    assert [os.path.getsize(store.segment_path(store.file_number)), os.path.getsize(tmp_path / 'index.dat')] == sizes
+
+    def broken_scan(out):
+        raise OSError("disk went away")
+    store.scan_segments = broken_scan
+    with pytest.raises(OSError):
+        store.rebuild_index()
+    assert len(store) == 12 and not os.path.exists(tmp_path / 'index.dat.tmp')
+    store.put(build_chain(13)[12])
+    store.close()
+    store = BlockStore(str(tmp_path))
+    assert len(store) == 13
+    store.close()
+
+def test_header_chain_sync_and_checkpoint(tmp_path):
+    import asyncio
+    import pytest
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+    from HeaderChain import HeaderChain, HeaderSync
+    from SampleData import mine_headers
+    from Utils import hash256
+
+    headers = mine_headers(4500)
+    checkpoint = str(tmp_path / 'headers.dat')
+
+    async def run():
+        peer = await FakePeer().start()
+        peer.headers = headers
+        node = AsyncNode('127.0.0.1', peer.port)
+        await node.connect()
+        try:
+            chain = await asyncio.wait_for(HeaderSync(node, HeaderChain(headers[0]), checkpoint).run(), 30)
+        finally:
+            await node.close()
+            await peer.close()
+        return chain, peer.received.count(b'getheaders')
+
+    chain, requests = asyncio.run(run())
+    assert chain.height == 4499 and chain.tip == hash256(headers[-1])
+
+    # a peer that goes away or stops answering ends the sync instead of hanging it
+    async def stalled(disconnect):
+        peer = await FakePeer().start()
+        peer.headers = headers
+        node = AsyncNode('127.0.0.1', peer.port)
+        await node.connect()
+        sync = HeaderSync(node, HeaderChain(headers[0]), timeout=0.3)
+        await asyncio.wait_for(node.handshake_done.wait(), 5)
+        if disconnect:
+            await peer.close()
+        else:
+            node.handlers[b'headers'] = lambda env: asyncio.sleep(0)  # headers arrive but are never handled
+        try:
+            await asyncio.wait_for(sync.run(), 5)
+        finally:
+            await node.close()
+            await peer.close()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(stalled(True))
+    with pytest.raises(asyncio.TimeoutError, match="no headers"):
+        asyncio.run(stalled(False))
+    assert requests == 3
+    assert chain.locator()[0] == chain.tip and chain.locator()[-1] == hash256(headers[0])
+
+    resumed = HeaderChain.load(checkpoint)
+    assert resumed.tip == chain.tip and resumed.work == chain.work and len(resumed.heights) == len(chain)
+    assert all(resumed.heights.get(chain.hash_at(h)) == h for h in range(len(chain)))
+
+    # a heavier fork replaces the last blocks, a lighter one is ignored
+    fork = mine_headers(4, prev_block=hash256(headers[4496]), timestamp=1)
+    assert resumed.add_headers(fork[:3]) == 0
+    assert resumed.add_headers(fork) == 4 and resumed.tip == hash256(fork[-1]) and resumed.height == 4500
+    assert hash256(headers[-1]) not in resumed.heights
+    with pytest.raises(ValueError):
+        resumed.add_headers([headers[5][:4] + b'\xee' * 32 + headers[5][36:]])
+
+
+def test_decode_pipeline_in_height_order():
+    import pytest
+    from Pipeline import DecodePipeline, ReorderBuffer
+    from SampleData import build_chain
+    from Utils import hash256
+
+    chain = build_chain(12, txs_per_block=30)
+    shuffled = [(h, chain[h]) for h in (3, 0, 2, 1, 5, 4, 7, 6, 9, 8, 11, 10)]
+    with DecodePipeline(workers=2, window=4) as pipeline:
+        decoded = list(pipeline.decode(shuffled))
+    assert [d.height for d in decoded] == list(range(12))
+    block = BlockMessage.parse_from(chain[7])[0]
+    assert decoded[7].block_hash == hash256(chain[7][:80]) and decoded[7].size == len(chain[7])
+    assert decoded[7].txids == b''.join(tx.txid for tx in block.transactions) and decoded[7].tx_count == 30
+
+    reorder = ReorderBuffer(0, 2)
+    assert reorder.put(1, 'b') == [] and reorder.put(2, 'c') == []
+    with pytest.raises(ValueError):
+        reorder.put(3, 'd')
+    assert reorder.put(0, 'a') == ['a', 'b', 'c']
+
+
+def test_merkle_root_and_batch_hashing():
+    from Hashing import hash256_batch, merkle_root
+    from SampleData import load_block_example, merkle_root as naive_merkle_root, sample_transactions
+    from Utils import hash256
+
+    txs = list(sample_transactions()[:7])
+    batch = hash256_batch(txs)
+    assert [bytes(batch[32 * i:32 * i + 32]) for i in range(7)] == [hash256(tx) for tx in txs]
+    big = [i.to_bytes(2, 'little') * 2048 for i in range(300)]  # large enough for the threaded path
+    assert hash256_batch(big, workers=4) == hash256_batch(big) == b''.join(map(hash256, big))
+    for n in (1, 2, 3, 7):
+        assert merkle_root(batch[:32 * n]) == naive_merkle_root([hash256(tx) for tx in txs[:n]])
+
+    block = BlockMessage.parse_from(load_block_example())[0]
+    assert block.check_merkle_root()
+    block.transactions.pop()
+    assert not block.check_merkle_root()
+
+
+def test_mempool_fee_rate_eviction_and_block_removal():
+    from Mempool import Mempool
+    from MessageHandler import TxMessage
+    from SampleData import build_block, build_tx, p2pkh_script, sample_transactions
+
+    raw_txs = sample_transactions()[:6]
+    txs = [TxMessage.parse_from(raw)[0] for raw in raw_txs]
+    mempool = Mempool(max_bytes=sum(tx.size for tx in txs[:5]), fee_lookup=lambda tx: 1000)
+    for i, tx in enumerate(txs[:5]):
+        assert mempool.add(tx, fee=(i + 1) * tx.vsize)  # fee rate i + 1 sat/vB
+    assert not mempool.add(txs[0])
+    assert [entry.feerate for entry in mempool.top(2)] == [5, 4]
+
+    # over budget: the lowest fee rate goes first, until the new one is the lowest
+    assert mempool.add(txs[5], fee=10 * txs[5].vsize)
+    assert txs[0].txid not in mempool and mempool.top(1)[0].tx is txs[5]
+    assert mempool.total_bytes <= mempool.max_bytes
+
+    # a block confirming txs[2] and a double spend of txs[3]'s inputs (same inputs, other locktime)
+    conflict = raw_txs[3][:-4] + b'\x01\x00\x00\x00'
+    block = BlockMessage.parse_from(build_block([raw_txs[2], conflict]))[0]
+    removed = mempool.remove_for_block(block)
+    assert txs[2].txid not in mempool and txs[3].txid not in mempool and removed == 2
+    assert sorted(mempool.entries) == sorted(tx.txid for tx in txs if tx.txid in mempool)
+    assert len(mempool.by_feerate) == len(mempool) and mempool.get(txs[4].txid) is txs[4]
+
+    # fees of txs spending mempool outputs are known without a fee_lookup; conflicts keep the first seen
+    # unless the newcomer pays a higher fee rate, and then the replaced tx goes with its descendants
+    def tx(inputs, values):
+        return TxMessage.parse_from(build_tx(inputs, [(value, p2pkh_script(b'x')) for value in values]))[0]
+
+    mempool = Mempool()
+    parent = tx([(b'\x11' * 32, 0, b'')], [10_000, 5_000])
+    child = tx([(parent.txid, 0, b'')], [9_000])
+    assert mempool.add(parent) and mempool.add(child)
+    assert mempool.entries[parent.txid].fee is None and mempool.entries[child.txid].fee == 1000
+    assert not mempool.add(tx([(b'\x11' * 32, 0, b'')], [14_000]))  # unknown fee
+    assert not mempool.add(tx([(parent.txid, 0, b'')], [9_500]), fee=500)  # lower fee rate than child
+    assert mempool.rejected_conflicts == 2 and len(mempool) == 2
+    replacement = tx([(b'\x11' * 32, 0, b''), (b'\x22' * 32, 1, b'')], [1_000])
+    assert mempool.add(replacement, fee=20_000)
+    assert list(mempool.entries) == [replacement.txid] and mempool.replaced == 2
+    assert mempool.spends == {(b'\x11' * 32, 0): replacement.txid, (b'\x22' * 32, 1): replacement.txid}
+
+    # eviction takes the descendants along; a replacement that wouldn't fit keeps what it conflicts with
+    mempool = Mempool(max_bytes=parent.size + child.size + 10)
+    assert mempool.add(parent, fee=100) and mempool.add(child)
+    other = tx([(b'\x33' * 32, 0, b'')], [1_000])
+    assert mempool.add(other, fee=50 * other.vsize)
+    assert list(mempool.entries) == [other.txid] and list(mempool.spends) == [(b'\x33' * 32, 0)]
+    mempool = Mempool(max_bytes=parent.size + child.size + 10)
+    assert mempool.add(parent, fee=100) and mempool.add(child)
+    big = tx([(parent.txid, 0, b'')], [1_000] * 20)
+    assert not mempool.add(big, fee=50 * big.vsize)
+    assert list(mempool.entries) == [parent.txid, child.txid] and mempool.rejected_conflicts == 1
+
+
+def test_utxo_set_apply_flush_and_undo(tmp_path):
+    import pytest
+    from Mempool import Mempool
+    from MessageHandler import TxMessage
+    from SampleData import build_spending_chain
+    from UtxoSet import UtxoSet
+
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in build_spending_chain(6, txs_per_block=5)]
+    utxos = UtxoSet(str(tmp_path / 'utxo.sqlite'), flush_every=2)
+    for block in blocks[:5]:
+        utxos.apply_block(block)
+    assert utxos.height == 4 and utxos.tip == blocks[4].hash()
+    tx = blocks[5].transactions[1]
+    assert utxos.input_values(tx) == [50_000, 20_000] and utxos.fee(tx) == 1000
+    assert utxos.get(blocks[3].transactions[0].txid, 0) is None  # spent by block 4
+    assert len(utxos) == 5 + 4 * 5 + 5  # coinbase, unspent "b" outputs, block 4's "a" outputs
+
+    # a block spending a missing output is rejected and leaves the set unchanged
+    with pytest.raises(ValueError):
+        utxos.apply_block(blocks[4])
+    bad = BlockMessage.parse_from(build_spending_chain(3, txs_per_block=5)[2])[0]
+    bad.prev_block = utxos.tip
+    bad.transactions[2].inputs[0].prevout_index = 99
+    with pytest.raises(ValueError):
+        utxos.apply_block(bad)
+    assert len(utxos) == 30
+
+    # undo across a flush, then reapply; state survives reopening
+    utxos.apply_block(blocks[5])
+    assert utxos.undo_block() == blocks[4].hash() and utxos.undo_block() == blocks[3].hash()
+    assert utxos.get(blocks[3].transactions[0].txid, 0).value == 50_000
+    assert utxos.get(blocks[4].transactions[1].txid, 0) is None
+    utxos.apply_block(blocks[4])
+    utxos.close()
+    utxos = UtxoSet(str(tmp_path / 'utxo.sqlite'))
+    assert utxos.tip == blocks[4].hash() and len(utxos) == 30
+    mempool = Mempool(fee_lookup=utxos.fee)
+    spend = TxMessage.parse_from(blocks[5].transactions[1].encode())[0]
+    mempool.add(spend)
+    assert mempool.entries[spend.txid].fee == 1000
+    utxos.close()
+
+
+def test_script_classifier_and_address_index(tmp_path):
+    from AddressIndex import AddressIndex, load_tx
+    from BlockStore import BlockStore
+    from SampleData import build_spending_chain, p2pkh_script
+    from Scripts import P2PKH, P2TR, P2WSH, address_to_script, classify, script_to_address
+    from UtxoSet import UtxoSet
+
+    # BIP173 / BIP350 and well-known base58 vectors
+    for address, kind in (('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', P2PKH),
+                          ('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3', P2WSH),
+                          ('bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0', P2TR)):
+        script = address_to_script(address)
+        assert classify(script)[0] == kind and script_to_address(script) == address
+    assert classify(b'\x6a\x04abcd') == ('op_return', b'\x04abcd') and script_to_address(b'\x6a') is None
+
+    raw_blocks = build_spending_chain(4, txs_per_block=3)
+    store = BlockStore(str(tmp_path / 'blocks'))
+    utxos = UtxoSet(str(tmp_path / 'utxo.sqlite'))
+    index = AddressIndex(str(tmp_path / 'index.sqlite'), flush_every=2)
+    for raw in raw_blocks:
+        store.put(raw)
+        block = BlockMessage.parse_from(raw)[0]
+        index.add_block(block, utxos)
+        utxos.apply_block(block)
+
+    # output 1 of each coinbase pays to cb1 and is spent by tx 2 of the next block
+    script = p2pkh_script(b'cb1')
+    entries = index.history(script_to_address(script))
+    assert [height for height, _ in entries] == [0, 1, 1, 2, 2, 3, 3]
+    assert index.history(script, limit=3) + index.history(script, after=entries[2]) == entries
+    coinbase = BlockMessage.parse_from(raw_blocks[0])[0].transactions[0]
+    assert not any('Type:' in line for line in coinbase.readable_lines())  # opt-in
+    assert f"      Type: p2pkh ({script_to_address(script)})" in coinbase.readable_lines(script_types=True)
+    tx = load_tx(store, *entries[2])
+    assert any(o.script_pubkey == script for o in load_tx(store, *entries[1]).outputs)
+    assert tx.txid == BlockMessage.parse_from(raw_blocks[1])[0].transactions[2].txid
+
+    top = BlockMessage.parse_from(raw_blocks[3])[0]
+    utxos.undo_block()
+    index.remove_block(top, utxos)
+    assert [height for height, _ in index.history(script)] == [0, 1, 1, 2, 2]
+    index.close()
+    utxos.close()
+    store.close()
+
+
+def test_renderer_modes_and_dropping():
+    import io
+    import json
+    import threading
+    from Renderer import Renderer
+    from SampleData import build_chain
+
+    block = BlockMessage.parse_from(build_chain(1, txs_per_block=3)[0])[0]
+    out = io.StringIO()
+    renderer = Renderer('json', out)
+    renderer.submit(block)
+    renderer.close()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r['type'] for r in records] == ['block', 'tx', 'tx', 'tx']
+    assert records[0]['hash'] == block.hash()[::-1].hex()
+    assert records[1]['txid'] == block.transactions[0].txid[::-1].hex()
+
+    out = io.StringIO()
+    renderer = Renderer('truncated', out, script_limit=4)
+    renderer.submit(block.transactions[0])
+    renderer.close()
+    assert "more bytes)" in out.getvalue() and out.getvalue().startswith("Transaction Information:")
+
+    class SlowOutput(io.StringIO):
+        def __init__(self):
+            super().__init__()
+            self.release = threading.Event()
+
+        def write(self, text):
+            self.release.wait()
+            return super().write(text)
+
+    out = SlowOutput()
+    renderer = Renderer('summary', out, queue_size=2)
+    submitted = [renderer.submit(tx) for tx in block.transactions * 5]
+    assert not all(submitted)  # a stuck console never blocks submit
+    out.release.set()
+    renderer.close()
+    lines = out.getvalue().splitlines()
+    assert sum(line.startswith("tx ") for line in lines) == submitted.count(True)
+    assert any(line.startswith("... skipped") for line in lines)
+
+
+def test_compact_block_reconstruction_against_fake_peer():
+    import asyncio
+    import time
+    from AsyncNode import AsyncNode
+    from CompactBlocks import CompactBlockRelay, compact_block
+    from FakePeer import FakePeer
+    from Hashing import siphash24, siphash24_hashes
+    from Mempool import Mempool
+    from MessageHandler import BlockTxnMessage, CmpctBlockMessage, GetBlockTxnMessage, SendCmpctMessage, TxMessage
+    from SampleData import build_block, sample_transactions
+    from Utils import hash256
+
+    # SipHash-2-4 reference vector, and the batch version against the scalar one
+    k0, k1 = 0x0706050403020100, 0x0f0e0d0c0b0a0908
+    assert siphash24(k0, k1, bytes(range(15))) == 0xa129ca6149be45e5
+    hashes = [hash256(bytes([i])) for i in range(50)]
+    assert siphash24_hashes(k0, k1, hashes, 6) == [(siphash24(k0, k1, h) & (1 << 48) - 1).to_bytes(6, 'little')
+                                                   for h in hashes]
+
+    raw_txs = list(sample_transactions()[:300])
+    data = build_block(raw_txs)
+    expected = BlockMessage.parse_from(data)[0]
+    cmpct = compact_block(expected, nonce=9)
+    assert CmpctBlockMessage.parse_from(cmpct.encode())[0].short_ids == cmpct.short_ids and cmpct.tx_count == 300
+    assert GetBlockTxnMessage.parse_from(GetBlockTxnMessage(b'\x01' * 32, [2, 3, 7]).encode())[0].indexes == [2, 3, 7]
+
+    mempool = Mempool()
+    for raw in raw_txs[1:280]:  # the node has seen all but the coinbase slot and the last 20 txs
+        mempool.add(TxMessage.parse_from(raw)[0])
+
+    async def run():
+        peer = await FakePeer(inventory={(2, hash256(data[:80])): data}).start()
+        peer.extra = [(SendCmpctMessage.command, SendCmpctMessage(False, 2).encode())]
+        node = AsyncNode('127.0.0.1', peer.port, mempool=mempool)
+        blocks = asyncio.Queue()
+        node.on_block = blocks.put_nowait
+        await node.connect()
+        try:
+            block = await asyncio.wait_for(blocks.get(), 5)
+        finally:
+            await node.close()
+            await peer.close()
+        return block, peer, node.compact
+
+    block, peer, relay = asyncio.run(run())
+    assert block.hash() == expected.hash() and block.check_merkle_root()
+    assert [tx.txid for tx in block.transactions] == [tx.txid for tx in expected.transactions]
+    assert peer.requested == [(4, expected.hash())]
+    assert b'getblocktxn' in peer.received and b'sendcmpct' in peer.received
+    assert len(mempool) == 0  # all confirmed by the block
+    assert relay.bytes_full == len(data) and relay.bytes_received < len(data) * 0.2
+    assert relay.bytes_received < relay.bytes_full and not relay.pending
+
+    # reconstructions whose blocktxn never comes are capped, then expire
+    waiting = CompactBlockRelay(Mempool(), pending_timeout=30.0, max_pending=2)
+    waiting.version = 2
+    others = [BlockMessage.parse_from(build_block(raw_txs[:n]))[0] for n in (2, 3, 4)]
+    for other in others:
+        _, reply = waiting.on_cmpctblock(compact_block(other, nonce=1).encode())
+        assert isinstance(reply, GetBlockTxnMessage)
+    assert list(waiting.pending) == [others[1].hash(), others[2].hash()] and waiting.expired == 1
+    waiting.expire(time.monotonic() + 31)
+    assert not waiting.pending and waiting.expired == 3
+    assert waiting.on_blocktxn(BlockTxnMessage(others[2].hash(), others[2].transactions[1:]).encode()) == (None, None)
+
+    # a cmpctblock nobody asked for (compact blocks off, no mempool) is answered with a getdata for the full block
+    unasked = compact_block(others[0], nonce=1).encode()
+    block, reply = CompactBlockRelay(None).on_cmpctblock(unasked)
+    assert block is None and reply.items == [(2, others[0].hash())]
+
+    async def unsolicited():
+        peer = await FakePeer(inventory={(2, others[0].hash()): build_block(raw_txs[:2])}).start()
+        peer.extra = [(CmpctBlockMessage.command, unasked)]
+        node = AsyncNode('127.0.0.1', peer.port)
+        blocks = asyncio.Queue()
+        node.on_block = blocks.put_nowait
+        await node.connect()
+        try:
+            await asyncio.wait_for(blocks.get(), 5)
+            while len(peer.requested) < 2:
+                await asyncio.sleep(0.01)
+        finally:
+            await node.close()
+            await peer.close()
+        return peer.requested, node.malformed
+
+    requested, malformed = asyncio.run(unsolicited())
+    assert requested == [(2, others[0].hash())] * 2 and malformed == 0
+
+
+def test_metrics_snapshot_prometheus_and_profiling(tmp_path):
+    import urllib.request
+    from Handshake import EnvelopeFramer, NetworkEnvelope
+    from Metrics import METRICS
+    from SampleData import load_block_example
+
+    data = load_block_example()
+    wire = NetworkEnvelope(b'block', data, 'main').encode()
+    EnvelopeFramer('main').feed(wire)
+    assert METRICS.snapshot()['btc_messages_received_total'] == {}  # nothing is recorded while disabled
+
+    METRICS.enable()
+    try:
+        for env in EnvelopeFramer('main').feed(wire[:1000]) + EnvelopeFramer('main').feed(wire):
+            block, _ = BlockMessage.parse_from(env.payload)
+        METRICS.profile_block_parse('cprofile')
+        BlockMessage.parse_from(data)
+        assert 'parse_buffer' in METRICS.profile_report()
+        METRICS.profile_block_parse(None)
+
+        snap = METRICS.snapshot()
+        assert snap['btc_messages_received_total'] == {'block': 1}
+        assert snap['btc_bytes_received_total'] == {None: len(wire)}
+        assert snap['btc_block_parse_seconds'][None]['count'] == 2
+        assert snap['btc_tx_parse_seconds']['block']['count'] == 2
+        assert "msgs in 1 out 0" in METRICS.stats_line()
+
+        text = METRICS.prometheus_text()
+        assert 'btc_messages_received_total{command="block"} 1' in text
+        assert 'btc_block_parse_seconds_bucket{le="+Inf"} 2' in text
+        METRICS.write_prometheus(str(tmp_path / 'node.prom'))
+        assert (tmp_path / 'node.prom').read_text() == text
+        server = METRICS.serve(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                assert 'btc_block_parse_seconds_count 2' in response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        METRICS.enable(False)
+        METRICS.reset()
+
+
+def test_synthetic_blocks_and_benchmark_compare():
+    from BenchSuite import compare, run
+    from SampleData import synthetic_block
+
+    data = synthetic_block(7, tx_count=50, inputs=(2, 2), witness_share=1.0, witness_items=3)
+    assert data == synthetic_block(7, tx_count=50, inputs=(2, 2), witness_share=1.0, witness_items=3)
+    assert data != synthetic_block(8, tx_count=50)
+    block = BlockMessage.parse_from(data)[0]
+    assert len(block.transactions) == 50 and block.check_merkle_root()
+    assert all(tx.wtxid != tx.txid and len(tx.inputs) == 2 for tx in block.transactions[1:])
+    assert all(len(tx_in.witness) == 3 for tx_in in block.transactions[1].inputs)
+
+    current = run(quick=True, only={'inv_parse'}, rounds=1)
+    assert set(current['results']) == {'inv_parse'} and current['results']['inv_parse']['ops_per_sec'] > 0
+    lines, regressed = compare(current, current)
+    assert not regressed and len(lines) == 1
+    baseline = {'results': {'inv_parse': dict(current['results']['inv_parse'])}}
+    baseline['results']['inv_parse']['ops_per_sec'] *= 2
+    lines, regressed = compare(current, baseline)
+    assert regressed and 'SLOWER' in lines[0]
+
+
+def test_encode_round_trip():
+    from io import BytesIO
+    from MessageHandler import TxMessage
+    from SampleData import load_block_example, synthetic_block
+
+    data = load_block_example()
+    block = BlockMessage.parse_from(data)[0]
+    assert block.encode() == data and block.encode().obj is data  # the parsed bytes, not a copy
+    assert BlockMessage.parse(BytesIO(data)).encode() == data
+    rebuilt = BlockMessage(block.version, block.prev_block, block.merkle_root, block.timestamp, block.bits,
+                           block.nonce, [TxMessage(tx.version, tx.inputs, tx.outputs, tx.locktime)
+                                         for tx in block.transactions])
+    assert rebuilt.encode() == data and rebuilt.hash() == block.hash()
+
+    tx = block.transactions[1]
+    raw = bytes(tx.encode())
+    assert all(part.encode() in raw for part in tx.inputs + tx.outputs)
+    txid = tx.txid
+    tx.outputs[0].value += 1
+    assert tx.encode() == raw  # not noticed until invalidated
+    tx.invalidate()
+    changed = TxMessage.parse_from(tx.encode())[0]
+    assert changed.outputs[0].value == tx.outputs[0].value and tx.txid != txid
+    tx.outputs[0].value -= 1
+    tx.invalidate()
+    assert tx.encode() == raw and tx.txid == txid
+
+    segwit = BlockMessage.parse_from(synthetic_block(3, tx_count=40, witness_share=1.0))[0]
+    for parsed in segwit.transactions[1:]:
+        copy = TxMessage(parsed.version, parsed.inputs, parsed.outputs, parsed.locktime)
+        assert copy.encode() == parsed.encode() and copy.is_segwit
+        assert (copy.txid, copy.wtxid, copy.vsize) == (parsed.txid, parsed.wtxid, parsed.vsize)
+
+
+    # invalidating the block invalidates its transactions
+    block_raw, txid = bytes(block.encode()), block.transactions[2].txid
+    block.transactions[2].inputs[0].prevout_index ^= 1
+    block.invalidate()
+    assert bytes(block.encode()) != block_raw and block.transactions[2].txid != txid
+    assert not block.check_merkle_root()
+    block.transactions[2].inputs[0].prevout_index ^= 1
+    block.invalidate()
+    assert block.encode() == block_raw and block.check_merkle_root()
+
+    # parsed (memoryview backed) and encoded objects pickle as bytes
+    import pickle
+    for obj in (block, segwit, rebuilt, segwit.transactions[1]):
+        obj.encode()
+        copy = pickle.loads(pickle.dumps(obj))
+        assert copy == obj and copy.encode() == obj.encode()
+
+
+def test_explorer_api_queries_cache_and_etags(tmp_path):
+    import http.client
+    import json
+    from BlockStore import BlockStore
+    from ExplorerAPI import Explorer, ExplorerAPI, hex_hash
+    from SampleData import build_chain
+
+    store = BlockStore(str(tmp_path))
+    raws = build_chain(6)
+    for height, raw in enumerate(raws[:5]):
+        store.put(raw, height)
+    explorer = Explorer(block_store=store)
+    assert explorer.index_store() == 5
+    last = BlockMessage.parse_from(raws[5])[0]
+    explorer.add_tx(last.transactions[1])
+    api = ExplorerAPI(explorer, port=0).start()
+    connection = http.client.HTTPConnection('127.0.0.1', api.port)
+
+    def get(path, etag=None):
+        connection.request('GET', path, headers={'If-None-Match': etag} if etag else {})
+        response = connection.getresponse()
+        body = response.read()
+        return response.status, json.loads(body) if body else None, response.getheader('ETag')
+
+    try:
+        block = BlockMessage.parse_from(raws[2])[0]
+        status, by_height, etag = get('/block/2')
+        assert status == 200 and by_height['hash'] == hex_hash(block.hash()) and by_height['height'] == 2
+        assert by_height['txids'] == [hex_hash(tx.txid) for tx in block.transactions]
+        assert get(f"/block/{by_height['hash']}")[1] == by_height
+        assert get('/block/2', etag)[0] == 304
+        status, tx, _ = get(f"/tx/{by_height['txids'][1]}")
+        assert status == 200 and tx['block'] == by_height['hash'] and tx['height'] == 2
+        status, pending, _ = get(f"/tx/{hex_hash(last.transactions[1].txid)}")
+        assert status == 200 and pending['block'] is None
+        assert [h['height'] for h in get('/headers/1?count=10')[1]] == [1, 2, 3, 4]
+        assert get('/tip')[1]['height'] == 4
+        assert get('/block/9')[0] == 404 and get('/tx/00')[0] == 400
+
+        explorer.add_block(last, height=5)  # answers that can change are recomputed, the others stay cached
+        hits = api.cache.hits
+        assert get('/tip')[1] == {'height': 5, 'hash': hex_hash(last.hash())}
+        assert api.cache.hits == hits
+        status, tx, _ = get(f"/tx/{hex_hash(last.transactions[1].txid)}")
+        assert tx['block'] == hex_hash(last.hash())
+        get(f"/block/{by_height['hash']}")
+        assert api.cache.hits == hits + 1
+        assert [tx['txid'] for tx in get('/txs/latest?n=5')[1]] == [hex_hash(last.transactions[1].txid)]
+
+        # new transactions replace the cached /txs/latest instead of piling up versions; /tip and blocks stay cached
+        entries, hits = len(api.cache.entries), api.cache.hits
+        for tx in block.transactions:
+            explorer.add_tx(tx)
+            assert get('/txs/latest?n=5')[1][0]['txid'] == hex_hash(tx.txid)
+            get('/tip')
+            get(f"/block/{by_height['hash']}")
+        assert len(api.cache.entries) == entries and api.cache.hits == hits + 2 * len(block.transactions)
+    finally:
+        connection.close()
+        api.close()
+        store.close()
+
+
+def test_explorer_heights_without_a_store_and_bad_requests():
+    from ExplorerAPI import Explorer, ExplorerAPI, hex_hash
+    from SampleData import build_block, build_tx, sample_transactions
+
+    coinbase = build_tx([(b'\x00' * 32, 0xffffffff, b'\x03\x40\x0d\x03')], [(50, b'')])  # BIP34 height 200000
+    first = BlockMessage.parse_from(build_block([coinbase]))[0]
+    second = BlockMessage.parse_from(build_block(list(sample_transactions()[:2]), prev_block=first.hash()))[0]
+    orphan = BlockMessage.parse_from(build_block(list(sample_transactions()[2:4])))[0]
+    assert first.coinbase_height() == 200000 and second.coinbase_height() is None
+
+    explorer = Explorer()  # what main() builds: no store, no header chain
+    api = ExplorerAPI(explorer)
+    explorer.add_block(first)
+    explorer.add_block(second)  # one above its parent
+    explorer.add_block(orphan)
+    assert explorer.tip_dict() == {'height': 200001, 'hash': hex_hash(second.hash())}
+    assert api.respond('/block/200001')[1] == api.respond(f'/block/{hex_hash(second.hash())}')[1]
+
+    # a block whose height isn't known yet is not cached for good
+    target = f'/block/{hex_hash(orphan.hash())}'
+    assert b'"height":null' in api.respond(target)[1]
+    explorer.add_block(orphan, height=7)
+    assert b'"height":7' in api.respond(target)[1]
+
+    for target in ('/headers/-3', '/headers/0?count=-1', '/txs/latest?n=-5', '/block/-1'):
+        assert api.respond(target)[0] == 400, target
+    explorer.tip_dict = lambda: 1 / 0
+    status, body, _ = api.respond('/tip')
+    assert status == 500 and b'ZeroDivisionError' in body
+
+
+def test_snapshot_warm_restart_skips_seen_inventory(tmp_path):
+    import asyncio
+    import pytest
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+    from SampleData import load_block_example
+    from Snapshot import Snapshot
+
+    txs = BlockMessage.parse_from(load_block_example())[0].transactions[1:4]
+    path = tmp_path / 'session.snapshot'
+
+    async def session(snapshot):
+        peer = await FakePeer(inventory={(1, tx.txid): tx.encode() for tx in txs}).start()
+        node = AsyncNode('localhost', peer.port, snapshot=snapshot)  # recorded under the address connected to
+        received = asyncio.Queue()
+        node.on_tx = received.put_nowait
+        await node.connect()
+        try:
+            await asyncio.wait_for(node.handshake_done.wait(), 5)
+            tx = await asyncio.wait_for(received.get(), 5)
+        finally:
+            await node.close()
+            await peer.close()
+        return tx, peer.requested, peer.port
+
+    first = Snapshot.load(path)  # no file yet: empty
+    assert not first.peers and first.tip is None and len(first.seen) == 0
+    first.seen.add(txs[0].txid)
+    first.seen.add(txs[1].txid)
+    first.set_tip(b'\x05' * 32, 7)
+    first.save(path)
+
+    second = Snapshot.load(path)
+    assert second.tip == (7, b'\x05' * 32) and txs[0].txid in second.seen and txs[2].txid not in second.seen
+    tx, requested, port = asyncio.run(session(second))
+    assert tx == txs[2] and requested == [(1, txs[2].txid)]  # the two seen last time are not asked for
+    assert second.best_peers() == [('127.0.0.1', port)] and second.peers[('127.0.0.1', port)].latency > 0
+    second.record_peer('seed.bitcoin.sipa.be', 8333, 0.5)  # not an address: ignored, so saving still works
+    second.save(path)
+    second.close()
+
+    third = Snapshot.load(path)
+    assert len(third.seen) == 3 and third.best_peers() == [('127.0.0.1', port)]
+    third.close()
+    # this session's hashes are capped at capacity, oldest dropped first, and saved before the last session's
+    small = Snapshot(inventory=memoryview(b''.join(sorted(bytes([i]) * 32 for i in range(10, 14)))), capacity=5)
+    for i in range(7):
+        small.seen.add(bytes([i]) * 32)
+    assert len(small.seen.added) == 5 and bytes([1]) * 32 not in small.seen and bytes([10]) * 32 in small.seen
+    assert small.seen.kept() == [bytes([i]) * 32 for i in range(2, 7)]
+    small.seen.added.clear()
+    small.seen.add(b'\x20' * 32)
+    assert small.seen.kept() == [bytes([i]) * 32 for i in (10, 11, 12, 13, 0x20)]
+
+    path.write_bytes(b'nonsense' * 10)
+    with pytest.raises(ValueError):
+        Snapshot.load(path)
+
+
+def test_async_node_survives_malformed_messages_and_bounds_decoding():
+    import asyncio
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+    from SampleData import build_chain
+
+    raws = build_chain(6, 4)
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in raws]
+    inventory = {(1, b'\x01' * 32): b'\x01\x00', (2, b'\x02' * 32): b'\xff' * 100}
+    inventory.update({(2, block.hash()): raw for block, raw in zip(blocks, raws)})
+
+    async def run():
+        peer = await FakePeer(inventory=inventory).start()
+        node = AsyncNode('127.0.0.1', peer.port, max_decoding=1)
+        received, most_pending = asyncio.Queue(), 0
+        node.on_block = received.put_nowait
+        await node.connect()
+        try:
+            got = []
+            while len(got) < len(blocks):
+                most_pending = max(most_pending, len(node.pending))
+                got.append(await asyncio.wait_for(received.get(), 5))
+        finally:
+            await node.close()
+            await peer.close()
+        return got, node.malformed, most_pending
+
+    got, malformed, most_pending = asyncio.run(run())
+    assert sorted(block.hash() for block in got) == sorted(block.hash() for block in blocks)
+    assert malformed == 2 and most_pending <= 1
+
+
+def test_async_node_decodes_blocks_in_a_process_pool():
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    from AsyncNode import AsyncNode
+    from FakePeer import FakePeer
+    from SampleData import build_chain
+
+    raws = build_chain(3, 4)
+    blocks = [BlockMessage.parse_from(raw)[0] for raw in raws]
+
+    async def run(executor):
+        peer = await FakePeer(inventory={(2, block.hash()): raw for block, raw in zip(blocks, raws)}).start()
+        node = AsyncNode('127.0.0.1', peer.port, executor=executor)
+        received = asyncio.Queue()
+        node.on_block = received.put_nowait
+        await node.connect()
+        try:
+            return [await asyncio.wait_for(received.get(), 10) for _ in blocks], node.malformed
+        finally:
+            await node.close()
+            await peer.close()
+
+    with ProcessPoolExecutor(1) as executor:
+        got, malformed = asyncio.run(run(executor))
+    assert sorted(block.hash() for block in got) == sorted(block.hash() for block in blocks) and malformed == 0
+    assert all(block.check_merkle_root() for block in got)
+
+def test_blocks_with_a_bad_merkle_root_are_not_stored(tmp_path):
+    import asyncio
+    from AsyncNode import AsyncNode
+    from BlockStore import BlockStore
+    from FakePeer import FakePeer
+    from SampleData import build_chain
+    from Utils import hash256
+
+    good, bad = build_chain(2, 4)
+    bad = bad[:36] + b'\x00' * 32 + bad[68:]  # wrong merkle root
+    store = BlockStore(tmp_path)
+
+    async def run():
+        peer = await FakePeer(inventory={(2, hash256(bad[:80])): bad, (2, hash256(good[:80])): good}).start()
+        node = AsyncNode('127.0.0.1', peer.port, block_store=store)
+        received = asyncio.Queue()
+        node.on_block = received.put_nowait
+        await node.connect()
+        try:
+            block = await asyncio.wait_for(received.get(), 5)
+            while node.pending:  # the bad block may still be decoding
+                await asyncio.sleep(0.01)
+            return block
+        finally:
+            await node.close()
+            await peer.close()
+
+    try:
+        assert asyncio.run(run()).hash() == hash256(good[:80])
+        assert hash256(good[:80]) in store and hash256(bad[:80]) not in store
+    finally:
+        store.close()